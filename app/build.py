@@ -0,0 +1,92 @@
+"""Build a static site without starting the web server.
+
+Runs the same pipeline as POST /generate/static directly against the gallery
+database, for nightly CI and other scheduled builds. Run it from the project
+root, like the server, so `static/` and `static_templates/` resolve:
+
+    python -m app.build 1 3 --theme grid --workers 8
+    python -m app.build --output directory --deploy-dir /srv/www/portfolio
+"""
+import argparse
+import logging
+import sys
+import time
+
+from app import main
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m app.build', description=__doc__.splitlines()[0])
+    parser.add_argument('gallery_ids', nargs='*', type=int,
+                        help='galleries to include, in order (default: all galleries)')
+    parser.add_argument('--theme', default='minimal', help='theme directory under static_templates (default: minimal)')
+    parser.add_argument('--title', default='My Photo Gallery', help='site title')
+    parser.add_argument('--description', default='', help='site description')
+    parser.add_argument('--page-size', type=int, default=None,
+                        help='images per gallery page, 0 for a single page (default: the gallery_page_size setting)')
+    parser.add_argument('--output', choices=['zip', 'directory'], default='zip',
+                        help='write a zip to static/generated_sites or sync into --deploy-dir (default: zip)')
+    parser.add_argument('--deploy-dir', default='', help='target for --output directory (default: the deploy_directory setting)')
+    parser.add_argument('--workers', type=int, default=None, help='threads per parallel stage (default: executor default)')
+    parser.add_argument('--db', default=None, help=f'database file (default: {main.DB_PATH})')
+    parser.add_argument('--verbose', '-v', action='store_true', help='log every image as it is processed')
+    return parser.parse_args(argv)
+
+
+def all_gallery_ids():
+    conn = main.get_db()
+    ids = [row['id'] for row in conn.execute('SELECT id FROM galleries ORDER BY id')]
+    conn.close()
+    return ids
+
+
+def format_bytes(count):
+    for unit in ('B', 'KB', 'MB'):
+        if count < 1024:
+            return f'{count:.0f} {unit}' if unit == 'B' else f'{count:.1f} {unit}'
+        count /= 1024
+    return f'{count:.1f} GB'
+
+
+def print_profile(profile, total):
+    width = max([len(stage['name']) for stage in profile['stages']] + [len('total')])
+    for stage in profile['stages']:
+        size = format_bytes(stage['bytes']) if stage['bytes'] is not None else ''
+        print(f"  {stage['name']:<{width}}  {stage['seconds']:8.3f}s  {size:>10}")
+    print(f'  {"total":<{width}}  {total:8.3f}s')
+    if profile['slowest_images']:
+        print('Slowest images:')
+        for image in profile['slowest_images']:
+            print(f"  {image['seconds']:8.3f}s  {format_bytes(image['bytes']):>10}  {image['filename']}")
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format='%(levelname)s %(message)s')
+    if args.db:
+        main.DB_PATH = args.db
+    main.startup()
+
+    started = time.perf_counter()
+    try:
+        build = main.build_static_site(args.gallery_ids or all_gallery_ids(), args.title, args.description, args.theme,
+                                       page_size=args.page_size, output_mode=args.output,
+                                       deploy_dir=args.deploy_dir, workers=args.workers)
+    except ValueError as e:
+        print(f'error: {e}', file=sys.stderr)
+        return 2
+    total = time.perf_counter() - started
+
+    print(f"Built {build['gallery_count']} galleries, {build['image_count']} images with the {build['theme']} theme")
+    if args.output == 'directory':
+        changes = build['changes']
+        print(f"Synced to {build['deploy_dir']}: {len(changes['added'])} added, {len(changes['changed'])} changed, "
+              f"{len(changes['removed'])} removed, {changes['unchanged']} unchanged")
+    else:
+        print(f"Wrote {main.GENERATED_SITES_DIR}/{build['zip_filename']} ({build['file_size'] / (1024 * 1024):.1f} MB)")
+    print_profile(build['profile'], total)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
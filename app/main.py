@@ -1,23 +1,37 @@
-from fastapi import FastAPI, Request, Form, UploadFile, File
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse
+from fastapi import FastAPI, Request, Form, UploadFile, File, BackgroundTasks
+from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import sqlite3
 import os
 import shutil
-from PIL import Image, ImageDraw, ImageFont
-import exifread
 import json
 import io
-from datetime import datetime
-import zipfile
-import zipfile
-import tempfile
+import base64
+import hashlib
+import heapq
+import logging
+import random
+import re
+import zlib
+import threading
+import asyncio
+import contextvars
+import functools
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from typing import List
+from urllib.parse import quote
 
 app = FastAPI()
 
+# Per-image build messages go through this logger at DEBUG/WARNING so they are
+# silent unless a handler asks for them (e.g. `python -m app.build --verbose`)
+logger = logging.getLogger(__name__)
+
 # Custom Jinja2 filter to parse JSON
 def from_json(value):
     try:
@@ -31,17 +45,269 @@ templates.env.filters['from_json'] = from_json
 
 DB_PATH = 'gallery.db'
 
+# Gap between neighbouring sort_order values. Sparse ranks let a single image
+# be moved between two others by rewriting only its own row.
+RANK_STEP = 1024
+
+# Request metrics
+#
+# MetricsMiddleware records per-route latency histograms, status counts,
+# response bytes and in-flight requests; every query through get_db() is
+# counted and timed against the route that issued it (via a context variable,
+# which follows sync routes into the threadpool). Updates are a few dict
+# increments under one lock; /metrics renders them in Prometheus text format.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics:
+    """In-process counters and histograms exposed at /metrics"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self.lock:
+            self.in_flight = 0
+            self.requests = {}         # (method, route, status) -> count
+            self.latency = {}          # (method, route) -> [bucket counts..., sum, count]
+            self.response_bytes = {}   # (method, route) -> bytes
+            self.queries = {}          # route -> [count, seconds]
+    
+    def observe_request(self, method, route, status, seconds, body_bytes, queries):
+        with self.lock:
+            key = (method, route)
+            self.requests[(method, route, status)] = self.requests.get((method, route, status), 0) + 1
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+            self.response_bytes[key] = self.response_bytes.get(key, 0) + body_bytes
+            if queries[0]:
+                self.add_queries(route, queries[0], queries[1], locked=True)
+    
+    def add_queries(self, route, count, seconds, locked=False):
+        if not locked:
+            with self.lock:
+                return self.add_queries(route, count, seconds, locked=True)
+        totals = self.queries.setdefault(route, [0, 0.0])
+        totals[0] += count
+        totals[1] += seconds
+    
+    def render(self):
+        """Prometheus text exposition format"""
+        def labels(**values):
+            return '{' + ','.join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                                  for k, v in values.items()) + '}'
+        with self.lock:
+            lines = ['# HELP http_requests_in_flight Requests currently being served',
+                     '# TYPE http_requests_in_flight gauge',
+                     f'http_requests_in_flight {self.in_flight}',
+                     '# HELP http_requests_total Requests served, by route and status',
+                     '# TYPE http_requests_total counter']
+            lines += [f'http_requests_total{labels(method=m, route=r, status=s)} {n}'
+                      for (m, r, s), n in sorted(self.requests.items())]
+            lines += ['# HELP http_request_duration_seconds Request latency, by route',
+                      '# TYPE http_request_duration_seconds histogram']
+            for (m, r), histogram in sorted(self.latency.items()):
+                for bound, count in zip(LATENCY_BUCKETS, histogram):
+                    lines.append(f'http_request_duration_seconds_bucket{labels(method=m, route=r, le=bound)} {count}')
+                lines.append(f'http_request_duration_seconds_bucket{labels(method=m, route=r, le="+Inf")} {histogram[-1]}')
+                lines.append(f'http_request_duration_seconds_sum{labels(method=m, route=r)} {histogram[-2]:.6f}')
+                lines.append(f'http_request_duration_seconds_count{labels(method=m, route=r)} {histogram[-1]}')
+            lines += ['# HELP http_response_bytes_total Response body bytes sent, by route',
+                      '# TYPE http_response_bytes_total counter']
+            lines += [f'http_response_bytes_total{labels(method=m, route=r)} {n}'
+                      for (m, r), n in sorted(self.response_bytes.items())]
+            lines += ['# HELP sqlite_queries_total SQLite statements executed, by route ("background" outside requests)',
+                      '# TYPE sqlite_queries_total counter']
+            lines += [f'sqlite_queries_total{labels(route=r)} {count}' for r, (count, _) in sorted(self.queries.items())]
+            lines += ['# HELP sqlite_query_seconds_total Time spent executing SQLite statements, by route',
+                      '# TYPE sqlite_query_seconds_total counter']
+            lines += [f'sqlite_query_seconds_total{labels(route=r)} {seconds:.6f}'
+                      for r, (_, seconds) in sorted(self.queries.items())]
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# [query count, seconds] of the request being served, if any
+_request_queries = contextvars.ContextVar('request_queries', default=None)
+
+class MetricsMiddleware:
+    """Pure ASGI middleware feeding `metrics`; cheaper than BaseHTTPMiddleware"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        
+        status = 500
+        body_bytes = 0
+        
+        async def send_wrapper(message):
+            nonlocal status, body_bytes
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                body_bytes += len(message.get('body', b''))
+            await send(message)
+        
+        queries = [0, 0.0]
+        token = _request_queries.set(queries)
+        with metrics.lock:
+            metrics.in_flight += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            seconds = time.perf_counter() - start
+            _request_queries.reset(token)
+            with metrics.lock:
+                metrics.in_flight -= 1
+            # The router fills in the matched route (or mount) on the shared scope
+            route = scope.get('route')
+            if route is not None:
+                label = route.path
+            elif scope.get('endpoint') is not None:
+                label = scope.get('root_path') or 'mount'
+            else:
+                label = 'unmatched'
+            metrics.observe_request(scope['method'], label, status, seconds, body_bytes, queries)
+
+app.add_middleware(MetricsMiddleware)
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that counts and times its statements for the metrics"""
+    
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            seconds = time.perf_counter() - start
+            queries = _request_queries.get()
+            if queries is None:
+                metrics.add_queries('background', 1, seconds)
+            else:
+                queries[0] += 1
+                queries[1] += seconds
+    
+    def execute(self, *args):
+        return self._timed(sqlite3.Cursor.execute, *args)
+    
+    def executemany(self, *args):
+        return self._timed(sqlite3.Cursor.executemany, *args)
+    
+    def executescript(self, *args):
+        return self._timed(sqlite3.Cursor.executescript, *args)
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors (including execute() shortcuts) are TimedCursors"""
+    
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+    
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+    
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+    
+    def executescript(self, *args):
+        return self.cursor().executescript(*args)
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, factory=TimedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
+# Async routes must not block the event loop on sqlite3 or file I/O. They hand
+# that work to run_db(), which runs it on a small dedicated pool so a slow
+# reorder or settings save never stalls other requests (or starves the
+# threadpool that serves the sync routes).
+DB_WORKERS = 4
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='gallery-db')
+
+async def run_db(func, *args, **kwargs):
+    """Await func(*args, **kwargs) run on DB_EXECUTOR, keeping the caller's context (request metrics)"""
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, call)
+
+# Settings created with their default values on first start
+DEFAULT_SETTINGS = [
+    # Storage & File Management
+    ('storage_cleanup_threshold_gb', '10', 'integer', 'storage', 'Auto-cleanup when storage exceeds this size (GB)'),
+    ('image_quality_compression', '85', 'integer', 'storage', 'Default JPEG compression quality (1-100)'),
+    ('thumbnail_size_px', '300', 'integer', 'storage', 'Thumbnail size in pixels'),
+    ('file_retention_days', '365', 'integer', 'storage', 'Auto-delete old generated sites after this many days (0 = never)'),
+    
+    # Image Processing
+    ('downscale_uploads_enabled', 'false', 'boolean', 'image_processing', 'Downscale uploads larger than the maximum width/height'),
+    ('max_image_width', '2048', 'integer', 'image_processing', 'Maximum width for uploaded images (pixels)'),
+    ('max_image_height', '2048', 'integer', 'image_processing', 'Maximum height for uploaded images (pixels)'),
+    ('archive_original_uploads', 'true', 'boolean', 'image_processing', 'Keep the untouched original in the originals archive when an upload is resized'),
+    ('strip_exif_data', 'false', 'boolean', 'image_processing', 'Remove EXIF metadata from uploaded images'),
+    ('convert_heic_to_jpeg', 'true', 'boolean', 'image_processing', 'Convert HEIC files to JPEG format'),
+    ('auto_featured_image', 'true', 'boolean', 'image_processing', 'Automatically set first image as gallery featured image'),
+    
+    # Portfolio Generation
+    ('default_analytics_code', '', 'text', 'portfolio', 'Default Google Analytics tracking code'),
+    ('default_meta_description', 'A beautiful portfolio showcasing my photography work', 'text', 'portfolio', 'Default meta description for portfolios'),
+    ('include_social_meta', 'true', 'boolean', 'portfolio', 'Include Open Graph meta tags for social sharing'),
+    ('gallery_page_size', '48', 'integer', 'portfolio', 'Images per generated gallery page (0 = whole site on one page)'),
+    ('optimize_site_assets', 'true', 'boolean', 'portfolio', 'Minify generated pages and move inline theme CSS/JS into cacheable hashed files'),
+    ('deploy_directory', '', 'text', 'portfolio', 'Default target directory for the deploy-directory output mode'),
+    ('precompress_site_files', 'false', 'boolean', 'portfolio', 'Write .gz (and .br when brotli is installed) copies of generated HTML/CSS/JS/JSON files'),
+    ('watermark_enabled', 'false', 'boolean', 'portfolio', 'Add watermark to portfolio images'),
+    ('watermark_text', '', 'text', 'portfolio', 'Watermark text to overlay on images'),
+    ('watermark_opacity', '30', 'integer', 'portfolio', 'Watermark opacity percentage (1-100)'),
+    ('watermark_font_size', '24', 'integer', 'portfolio', 'Watermark font size in pixels'),
+    ('watermark_font_family', 'Roboto', 'text', 'portfolio', 'Google Font family for watermark text'),
+    ('watermark_position_vertical', 'bottom', 'text', 'portfolio', 'Watermark vertical position (top/bottom)'),
+    ('watermark_position_horizontal', 'right', 'text', 'portfolio', 'Watermark horizontal position (left/center/right)')
+]
+
+# Columns added to existing tables since they were created
+ADDED_COLUMNS = [
+    ('images', 'file_size INTEGER'),
+    ('images', 'thumb_size INTEGER'),
+    ('images', 'archive_size INTEGER'),
+    ('images', 'placeholder TEXT'),
+    ('images', 'dominant_color TEXT'),
+    ('images', 'width INTEGER'),
+    ('images', 'height INTEGER'),
+    ('images', 'orientation INTEGER'),
+    ('images', 'phash TEXT'),
+    ('images', 'palette TEXT'),
+    ('generated_sites', 'last_accessed_at DATETIME'),
+    ('generated_sites', 'manifest TEXT'),
+    ('generated_sites', 'build_profile TEXT')
+]
+
+# Bump when table definitions change or startup() gains a one-off migration.
+# Together with the default settings and added columns it forms the fingerprint
+# stored in the database's user_version, so startup() can skip initialization
+# entirely when nothing has changed.
+#   4: respace dense image ranks
+#   5: move derivative caches out of static/
+#   6: index images by (enabled, id)
+SCHEMA_VERSION = 6
+SCHEMA_FINGERPRINT = zlib.crc32(repr((SCHEMA_VERSION, DEFAULT_SETTINGS, ADDED_COLUMNS)).encode()) & 0x7fffffff
+
 @app.on_event('startup')
 def startup():
-    """Initialize database and create tables on startup"""
+    """Initialize database and create tables on startup; a no-op when the schema is current"""
     try:
         conn = get_db()
         c = conn.cursor()
+        if c.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_FINGERPRINT:
+            conn.close()
+            return
         
         # Create galleries table
         c.execute('''CREATE TABLE IF NOT EXISTS galleries (
@@ -94,39 +360,58 @@ def startup():
         )''')
         
         # Insert default settings if they don't exist
-        default_settings = [
-            # Storage & File Management
-            ('storage_cleanup_threshold_gb', '10', 'integer', 'storage', 'Auto-cleanup when storage exceeds this size (GB)'),
-            ('image_quality_compression', '85', 'integer', 'storage', 'Default JPEG compression quality (1-100)'),
-            ('thumbnail_size_px', '300', 'integer', 'storage', 'Thumbnail size in pixels'),
-            ('file_retention_days', '365', 'integer', 'storage', 'Auto-delete old generated sites after this many days (0 = never)'),
-            
-            # Image Processing
-            ('auto_resize_enabled', 'true', 'boolean', 'image_processing', 'Automatically resize large uploaded images'),
-            ('max_image_width', '2048', 'integer', 'image_processing', 'Maximum width for uploaded images (pixels)'),
-            ('max_image_height', '2048', 'integer', 'image_processing', 'Maximum height for uploaded images (pixels)'),
-            ('strip_exif_data', 'false', 'boolean', 'image_processing', 'Remove EXIF metadata from uploaded images'),
-            ('convert_heic_to_jpeg', 'true', 'boolean', 'image_processing', 'Convert HEIC files to JPEG format'),
-            ('auto_featured_image', 'true', 'boolean', 'image_processing', 'Automatically set first image as gallery featured image'),
-            
-            # Portfolio Generation
-            ('default_analytics_code', '', 'text', 'portfolio', 'Default Google Analytics tracking code'),
-            ('default_meta_description', 'A beautiful portfolio showcasing my photography work', 'text', 'portfolio', 'Default meta description for portfolios'),
-            ('include_social_meta', 'true', 'boolean', 'portfolio', 'Include Open Graph meta tags for social sharing'),
-            ('watermark_enabled', 'false', 'boolean', 'portfolio', 'Add watermark to portfolio images'),
-            ('watermark_text', '', 'text', 'portfolio', 'Watermark text to overlay on images'),
-            ('watermark_opacity', '30', 'integer', 'portfolio', 'Watermark opacity percentage (1-100)'),
-            ('watermark_font_size', '24', 'integer', 'portfolio', 'Watermark font size in pixels'),
-            ('watermark_font_family', 'Roboto', 'text', 'portfolio', 'Google Font family for watermark text'),
-            ('watermark_position_vertical', 'bottom', 'text', 'portfolio', 'Watermark vertical position (top/bottom)'),
-            ('watermark_position_horizontal', 'right', 'text', 'portfolio', 'Watermark horizontal position (left/center/right)')
-        ]
         
-        for setting_key, default_value, setting_type, category, description in default_settings:
-            c.execute('''INSERT OR IGNORE INTO app_settings 
-                        (setting_key, setting_value, setting_type, category, description) 
-                        VALUES (?, ?, ?, ?, ?)''', 
-                     (setting_key, default_value, setting_type, category, description))
+        c.executemany('''INSERT OR IGNORE INTO app_settings 
+                         (setting_key, setting_value, setting_type, category, description) 
+                         VALUES (?, ?, ?, ?, ?)''', DEFAULT_SETTINGS)
+        
+        # Create pending_deletions table (durable queue for the file reaper)
+        c.execute('''CREATE TABLE IF NOT EXISTS pending_deletions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT,
+            attempts INTEGER DEFAULT 0,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )''')
+        
+        # Create derivative_cache table (byte ledger for regenerable cache files)
+        c.execute('''CREATE TABLE IF NOT EXISTS derivative_cache (
+            path TEXT PRIMARY KEY,
+            kind TEXT,
+            bytes INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_accessed_at DATETIME
+        )''')
+        
+        # Create upload_sessions table (resumable chunked uploads in progress)
+        c.execute('''CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            gallery_id INTEGER,
+            filename TEXT,
+            total_size INTEGER,
+            received INTEGER DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )''')
+        
+        # Create image_colors table (palette swatches indexed by RGB grid cell for colour search)
+        c.execute('''CREATE TABLE IF NOT EXISTS image_colors (
+            image_id INTEGER,
+            color_bin INTEGER,
+            r INTEGER,
+            g INTEGER,
+            b INTEGER,
+            weight REAL,
+            FOREIGN KEY(image_id) REFERENCES images(id)
+        )''')
+        # Sample picks seek enabled images by id
+        c.execute('CREATE INDEX IF NOT EXISTS idx_images_enabled ON images(enabled, id)')
+        
+        c.execute('CREATE INDEX IF NOT EXISTS idx_image_colors_bin ON image_colors(color_bin)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_image_colors_image ON image_colors(image_id)')
+        # Swatches go with their image, whichever code path deletes it
+        c.execute('''CREATE TRIGGER IF NOT EXISTS image_colors_on_delete AFTER DELETE ON images
+                     BEGIN DELETE FROM image_colors WHERE image_id = OLD.id; END''')
         
         # Add sort_order column if it doesn't exist (for existing databases)
         try:
@@ -134,6 +419,34 @@ def startup():
         except:
             pass  # Column already exists
         
+        # Columns added after the tables were first created (NULL values are backfilled in the background)
+        for table, column in ADDED_COLUMNS:
+            try:
+                c.execute(f'ALTER TABLE {table} ADD COLUMN {column}')
+            except:
+                pass  # Column already exists
+        
+        # Galleries still ranked densely (0, 1, 2... from before sparse ranks)
+        # are respaced once here, so their first move doesn't have to
+        dense_galleries = [row[0] for row in c.execute(
+            '''SELECT DISTINCT gallery_id FROM (
+                   SELECT gallery_id, sort_order - LAG(sort_order) OVER
+                          (PARTITION BY gallery_id ORDER BY sort_order, id) AS gap
+                   FROM images)
+               WHERE gap < ?''', (RANK_STEP,)).fetchall()]
+        for gallery_id in dense_galleries:
+            respace_gallery_ranks(c, gallery_id)
+        
+        # auto_resize_enabled was seeded 'true' while it did nothing; downscaling
+        # is opt-in under its own setting, so existing installs don't start resizing
+        c.execute("DELETE FROM app_settings WHERE setting_key='auto_resize_enabled'")
+        
+        # Caches written under static/ before CACHE_DIR were publicly reachable
+        if os.path.isdir(LEGACY_CACHE_DIR):
+            c.execute('DELETE FROM derivative_cache WHERE path LIKE ?', (os.path.join(LEGACY_CACHE_DIR, '%'),))
+            trash_files(c, [LEGACY_CACHE_DIR])
+        
+        c.execute(f'PRAGMA user_version = {SCHEMA_FINGERPRINT}')
         conn.commit()
         conn.close()
         
@@ -152,129 +465,788 @@ def startup():
             print("🔄 Created empty database file, retrying...")
             startup()  # Retry once
 
+# Deferred file deletion
+#
+# Request handlers rename the paths they want gone into TRASH_DIR (cheap, and
+# it frees the live path at once for a re-upload or a new gallery with the same
+# id) and record the trash paths in pending_deletions, inside the same
+# transaction as the row changes. A background reaper thread removes them in
+# batches; a row is cleared only after its path is gone, so the queue survives
+# crashes and restarts and simply resumes.
+TRASH_DIR = '.trash'
+DELETION_BATCH_SIZE = 500
+DELETION_MAX_ATTEMPTS = 5
+DELETION_REAPER_INTERVAL = 30  # seconds between idle passes
+
+_deletion_lock = threading.Lock()
+_database_generation = 0  # bumped by reset_database, which replaces the database file
+_deletion_wakeup = threading.Event()
+_deletion_reaper_thread = None
+
+def queue_file_deletions(cur, paths):
+    """Queue files or directories for removal as part of the caller's transaction"""
+    cur.executemany('INSERT INTO pending_deletions (path) VALUES (?)', [(path,) for path in paths])
+
+def move_to_trash(path):
+    """Rename a path into TRASH_DIR so it disappears immediately; returns the new path"""
+    os.makedirs(TRASH_DIR, exist_ok=True)
+    trash_path = os.path.join(TRASH_DIR, f'{time.time_ns()}_{uuid.uuid4().hex[:8]}_{os.path.basename(path)}')
+    os.replace(path, trash_path)
+    return trash_path
+
+def trash_files(cur, paths):
+    """Move paths into TRASH_DIR now and queue them for the reaper in the caller's transaction"""
+    trashed = []
+    for path in paths:
+        try:
+            trashed.append(move_to_trash(path))
+        except FileNotFoundError:
+            pass  # Nothing to delete
+        except OSError as e:
+            print(f"Error moving {path} to trash: {e}")
+    if any(path.startswith(GENERATED_SITES_DIR) for path in paths):
+        invalidate_archive_snapshot()
+    queue_file_deletions(cur, trashed)
+    return trashed
+
+def wake_deletion_reaper():
+    """Ask the reaper to run now instead of at its next interval"""
+    _deletion_wakeup.set()
+
+def process_deletion_queue(batch_size=DELETION_BATCH_SIZE):
+    """Remove one batch of queued paths and return how many were cleared"""
+    with _deletion_lock:
+        generation = _database_generation
+        conn = get_db()
+        rows = conn.execute('''SELECT id, path FROM pending_deletions 
+                               WHERE attempts < ? ORDER BY id LIMIT ?''',
+                            (DELETION_MAX_ATTEMPTS, batch_size)).fetchall()
+        conn.close()
+    
+    # Remove files without the lock, so a reset request never waits on a batch
+    done = []
+    failed = []
+    for row in rows:
+        path = row['path']
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass  # Already gone, e.g. removed before a crash
+        except OSError as e:
+            failed.append((str(e), row['id']))
+            continue
+        done.append((row['id'],))
+    
+    with _deletion_lock:
+        if generation != _database_generation:
+            return 0  # The database was reset; these row ids mean nothing in the new one
+        conn = get_db()
+        cur = conn.cursor()
+        cur.executemany('DELETE FROM pending_deletions WHERE id=?', done)
+        cur.executemany('UPDATE pending_deletions SET attempts = attempts + 1, last_error=? WHERE id=?', failed)
+        conn.commit()
+        conn.close()
+        return len(done)
+
+def recover_trash():
+    """Queue anything left in TRASH_DIR that never made it into the queue"""
+    if not os.path.isdir(TRASH_DIR):
+        return
+    with _deletion_lock:
+        conn = get_db()
+        cur = conn.cursor()
+        queued = {row['path'] for row in cur.execute('SELECT path FROM pending_deletions')}
+        orphans = [os.path.join(TRASH_DIR, name) for name in os.listdir(TRASH_DIR)]
+        queue_file_deletions(cur, [path for path in orphans if path not in queued])
+        conn.commit()
+        conn.close()
+
+def get_deletion_backlog():
+    """Summarize the deletion queue for monitoring"""
+    conn = get_db()
+    row = conn.execute('''SELECT COUNT(*) AS pending, 
+                                 COALESCE(SUM(attempts >= ?), 0) AS failed, 
+                                 MIN(created_at) AS oldest 
+                          FROM pending_deletions''', (DELETION_MAX_ATTEMPTS,)).fetchone()
+    conn.close()
+    return {
+        'pending': row['pending'],
+        'failed': row['failed'],
+        'oldest': row['oldest'],
+        'reaper_running': _deletion_reaper_thread is not None and _deletion_reaper_thread.is_alive()
+    }
+
+def _deletion_reaper():
+    try:
+        recover_trash()
+    except Exception as e:
+        print(f"Error recovering trash: {e}")
+    while True:
+        try:
+            while process_deletion_queue():
+                pass
+        except Exception as e:
+            print(f"Deletion reaper error: {e}")
+        _deletion_wakeup.wait(timeout=DELETION_REAPER_INTERVAL)
+        _deletion_wakeup.clear()
+
+# Generated site archive listing
+#
+# Pages that list archives compare DB rows against a cached snapshot of the
+# generated sites directory instead of probing each file. The snapshot is one
+# os.scandir pass, refreshed when archives are written or deleted, or when the
+# directory's own mtime shows that something else changed it.
+GENERATED_SITES_DIR = os.path.join('static', 'generated_sites')
+
+_archive_snapshot = None  # (directory mtime_ns, {filename: (size, mtime)})
+_archive_snapshot_lock = threading.Lock()
+
+def invalidate_archive_snapshot():
+    """Force the next listing to rescan the generated sites directory"""
+    global _archive_snapshot
+    _archive_snapshot = None
+
+def get_archive_snapshot():
+    """Return {filename: (size, mtime)} for every .zip in the generated sites directory"""
+    global _archive_snapshot
+    try:
+        dir_mtime = os.stat(GENERATED_SITES_DIR).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    with _archive_snapshot_lock:
+        if _archive_snapshot is None or _archive_snapshot[0] != dir_mtime:
+            archives = {}
+            with os.scandir(GENERATED_SITES_DIR) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.zip') and entry.is_file():
+                        stat = entry.stat()
+                        archives[entry.name] = (stat.st_size, stat.st_mtime)
+            _archive_snapshot = (dir_mtime, archives)
+        return _archive_snapshot[1]
+
+# Storage accounting
+#
+# Byte counts are recorded when files are written: originals and thumbnails on
+# the images row, archives on generated_sites and regenerable caches in
+# derivative_cache. Usage totals are plain SUM queries, and a janitor thread
+# evicts archives and caches (least recently used first) past the configured
+# retention and size limits.
+STORAGE_CHECK_INTERVAL = 3600  # seconds between janitor passes
+# Derivative caches live outside the public static/ mount; they are only
+# reached through the endpoints that check and serve them
+CACHE_DIR = 'cache'
+LEGACY_CACHE_DIR = os.path.join('static', 'cache')
+
+_storage_wakeup = threading.Event()
+_storage_janitor_thread = None
+
+def record_cache_file(cur, kind, path, size):
+    """Add or refresh a derivative cache file in the storage ledger"""
+    cur.execute('''INSERT OR REPLACE INTO derivative_cache (path, kind, bytes, last_accessed_at) 
+                   VALUES (?, ?, ?, CURRENT_TIMESTAMP)''', (path, kind, size))
+
+def touch_cache_file(cur, path):
+    """Mark a cache file as used so LRU eviction keeps it longer"""
+    cur.execute('UPDATE derivative_cache SET last_accessed_at=CURRENT_TIMESTAMP WHERE path=?', (path,))
+
+def get_storage_usage(cur):
+    """Return tracked storage usage in bytes, without touching the filesystem"""
+    originals, thumbnails, archived = cur.execute(
+        'SELECT COALESCE(SUM(file_size), 0), COALESCE(SUM(thumb_size), 0), COALESCE(SUM(archive_size), 0) FROM images').fetchone()
+    generated = cur.execute('SELECT COALESCE(SUM(file_size), 0) FROM generated_sites').fetchone()[0]
+    caches = {row['kind']: row['total'] for row in cur.execute(
+        'SELECT kind, SUM(bytes) AS total FROM derivative_cache GROUP BY kind')}
+    return {
+        'originals': originals,
+        'thumbnails': thumbnails,
+        'archived_originals': archived,
+        'generated_sites': generated,
+        'caches': caches,
+        'total': originals + thumbnails + archived + generated + sum(caches.values())
+    }
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def backfill_storage_sizes():
+    """Record sizes for images uploaded before storage accounting existed"""
+    conn = get_db()
+    cur = conn.cursor()
+    rows = cur.execute('SELECT id, gallery_id, filename FROM images WHERE file_size IS NULL OR thumb_size IS NULL').fetchall()
+    cur.executemany('UPDATE images SET file_size=?, thumb_size=? WHERE id=?',
+                    [(_file_size(f'static/gallery_{row["gallery_id"]}/{row["filename"]}'),
+                      _file_size(f'static/thumbs/{row["filename"]}'), row['id']) for row in rows])
+    conn.commit()
+    conn.close()
+    return len(rows)
+
+def enforce_storage_limits():
+    """Evict generated sites and cache files past file_retention_days or storage_cleanup_threshold_gb.
+
+    Originals and thumbnails are never evicted. Archives past retention go first;
+    then, while tracked usage exceeds the threshold, archives and caches are
+    evicted least recently used first. Files go through the deletion queue.
+    """
+    retention_days = get_setting('file_retention_days', 0)
+    threshold_gb = get_setting('storage_cleanup_threshold_gb', 0)
+    
+    conn = get_db()
+    cur = conn.cursor()
+    evicted_sites = []
+    evicted_caches = []
+    
+    if retention_days > 0:
+        evicted_sites = [(row['id'], row['filename'], row['file_size'] or 0) for row in cur.execute(
+            "SELECT id, filename, file_size FROM generated_sites WHERE created_at < datetime('now', ?)",
+            (f'-{retention_days} days',))]
+    
+    if threshold_gb > 0:
+        excess = get_storage_usage(cur)['total'] - sum(size for _, _, size in evicted_sites) - threshold_gb * 1024 ** 3
+        already_evicted = {site_id for site_id, _, _ in evicted_sites}
+        candidates = cur.execute('''
+            SELECT 'site' AS kind, id, filename AS path, file_size AS bytes, 
+                   COALESCE(last_accessed_at, created_at) AS used_at 
+            FROM generated_sites
+            UNION ALL
+            SELECT 'cache', NULL, path, bytes, COALESCE(last_accessed_at, created_at) 
+            FROM derivative_cache
+            ORDER BY used_at ASC
+        ''').fetchall() if excess > 0 else []
+        for row in candidates:
+            if excess <= 0:
+                break
+            if row['kind'] == 'site':
+                if row['id'] in already_evicted:
+                    continue
+                evicted_sites.append((row['id'], row['path'], row['bytes'] or 0))
+            else:
+                evicted_caches.append((row['path'], row['bytes'] or 0))
+            excess -= row['bytes'] or 0
+    
+    cur.executemany('DELETE FROM generated_sites WHERE id=?', [(site_id,) for site_id, _, _ in evicted_sites])
+    cur.executemany('DELETE FROM derivative_cache WHERE path=?', [(path,) for path, _ in evicted_caches])
+    trash_files(cur, [os.path.join(GENERATED_SITES_DIR, filename) for _, filename, _ in evicted_sites] +
+                     [path for path, _ in evicted_caches])
+    conn.commit()
+    conn.close()
+    
+    if evicted_sites or evicted_caches:
+        wake_deletion_reaper()
+    return {
+        'evicted_sites': len(evicted_sites),
+        'evicted_caches': len(evicted_caches),
+        'freed_bytes': sum(size for _, _, size in evicted_sites) + sum(size for _, size in evicted_caches)
+    }
+
+def wake_storage_janitor():
+    """Ask the janitor to check storage limits now"""
+    _storage_wakeup.set()
+
+def _storage_janitor():
+    try:
+        backfill_storage_sizes()
+    except Exception as e:
+        print(f"Error backfilling storage sizes: {e}")
+    while True:
+        try:
+            enforce_storage_limits()
+        except Exception as e:
+            print(f"Storage janitor error: {e}")
+        _storage_wakeup.wait(timeout=STORAGE_CHECK_INTERVAL)
+        _storage_wakeup.clear()
+
+@app.on_event('startup')
+def start_storage_janitor():
+    """Start the background storage janitor (once per process)"""
+    global _storage_janitor_thread
+    if _storage_janitor_thread is None or not _storage_janitor_thread.is_alive():
+        _storage_janitor_thread = threading.Thread(target=_storage_janitor, name='storage-janitor', daemon=True)
+        _storage_janitor_thread.start()
+
+@app.on_event('startup')
+def start_deletion_reaper():
+    """Start the background file reaper (once per process)"""
+    global _deletion_reaper_thread
+    if _deletion_reaper_thread is None or not _deletion_reaper_thread.is_alive():
+        _deletion_reaper_thread = threading.Thread(target=_deletion_reaper, name='deletion-reaper', daemon=True)
+        _deletion_reaper_thread.start()
+
+# Untouched originals of resized uploads are kept here, outside of static/
+ORIGINALS_ARCHIVE_DIR = 'originals'
+
+def image_file_paths(gallery_id, filename):
+    """Return the (image, thumbnail, archived original) paths for an image"""
+    return (f'static/gallery_{gallery_id}/{filename}',
+            f'static/thumbs/{filename}',
+            os.path.join(ORIGINALS_ARCHIVE_DIR, f'gallery_{gallery_id}', filename))
+
+def available_image_filename(cur, gallery_id, filename):
+    """Return filename, or the first 'name-2.ext', 'name-3.ext'... not already used by an image.
+    
+    Thumbnails share one directory across galleries, so any gallery's image
+    with the same name counts as taken.
+    """
+    stem, ext = os.path.splitext(filename)
+    candidate, n = filename, 1
+    while (any(os.path.exists(path) for path in image_file_paths(gallery_id, candidate)) or
+           cur.execute('SELECT 1 FROM images WHERE filename=? LIMIT 1', (candidate,)).fetchone()):
+        n += 1
+        candidate = f'{stem}-{n}{ext}'
+    return candidate
+
+def get_upload_resize_config():
+    """Get the downscale-on-upload settings, or None unless downscaling is turned on"""
+    if not get_setting('downscale_uploads_enabled', False):
+        return None
+    return {
+        'max_width': get_setting('max_image_width', 2048),
+        'max_height': get_setting('max_image_height', 2048),
+        'quality': get_setting('image_quality_compression', 85),
+        'keep_original': get_setting('archive_original_uploads', True)
+    }
+
+def downscale_image_bytes(content, resize_config):
+    """Downscale encoded image bytes (or the image file at a path) to fit the configured bounds.
+
+    Returns the re-encoded bytes, or None when the image already fits or cannot
+    be decoded, in which case the upload is stored untouched.
+    """
+    from PIL import Image
+    if not resize_config:
+        return None
+    max_size = (resize_config['max_width'], resize_config['max_height'])
+    try:
+        with Image.open(io.BytesIO(content) if isinstance(content, bytes) else content) as img:
+            if img.width <= max_size[0] and img.height <= max_size[1]:
+                return None
+            image_format = img.format
+            save_options = {k: img.info[k] for k in ('exif', 'icc_profile') if img.info.get(k)}
+            if image_format in ('JPEG', 'WEBP'):
+                save_options['quality'] = resize_config['quality']
+            
+            # Draft mode lets the JPEG decoder skip detail we are about to throw
+            # away; decoding at >= 2x the target keeps the LANCZOS result sharp
+            img.draft(img.mode, (max_size[0] * 2, max_size[1] * 2))
+            img.thumbnail(max_size, Image.LANCZOS)
+            
+            output = io.BytesIO()
+            img.save(output, image_format, **save_options)
+            return output.getvalue()
+    except Exception as e:
+        print(f"Resize error: {e}")
+        return None
+
+# Bounding box of the thumbnails in static/thumbs, in pixels
+THUMBNAIL_SIZE = 400
+
+# Longest side of the inline blurred placeholder, in pixels
+PLACEHOLDER_SIZE = 16
+
+def image_placeholder(img):
+    """Return (tiny JPEG data URI, '#rrggbb' average colour) for an open image.
+
+    The data URI is a few hundred bytes; themes paint it, scaled up and blurred
+    by the browser, as the image background until the real file arrives.
+    """
+    from PIL import Image
+    small = img.convert('RGB')
+    small.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.BOX)
+    output = io.BytesIO()
+    small.save(output, 'JPEG', quality=40)
+    data_uri = 'data:image/jpeg;base64,' + base64.b64encode(output.getvalue()).decode('ascii')
+    r, g, b = small.resize((1, 1), Image.BOX).getpixel((0, 0))
+    return data_uri, f'#{r:02x}{g:02x}{b:02x}'
+
+def backfill_image_placeholders():
+    """Compute placeholders for images uploaded before they existed, from their thumbnails"""
+    from PIL import Image
+    conn = get_db()
+    cur = conn.cursor()
+    rows = cur.execute('SELECT id, gallery_id, filename FROM images WHERE placeholder IS NULL').fetchall()
+    updates = []
+    for row in rows:
+        image_path, thumb_path, _ = image_file_paths(row['gallery_id'], row['filename'])
+        source = thumb_path if os.path.exists(thumb_path) else image_path
+        try:
+            with Image.open(source) as img:
+                updates.append((*image_placeholder(img), row['id']))
+        except Exception as e:
+            print(f"Placeholder backfill error for {row['filename']}: {e}")
+    cur.executemany('UPDATE images SET placeholder=?, dominant_color=? WHERE id=?', updates)
+    conn.commit()
+    conn.close()
+    return len(updates)
+
+# Side of the grayscale grid a difference hash compares (one bit per adjacent pair)
+DHASH_SIZE = 8
+
+def image_dhash(img):
+    """Return the 64-bit difference hash of an open image as 16 hex digits.
+
+    Each bit says whether a pixel of a 9x8 grayscale copy is brighter than its
+    right-hand neighbour, so resizes, recompression and light edits of the same
+    frame land within a few bits of each other.
+    """
+    from PIL import Image
+    small = img.convert('L').resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BOX)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(DHASH_SIZE):
+        offset = row * (DHASH_SIZE + 1)
+        for col in range(DHASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f'{value:016x}'
+
+def backfill_image_hashes():
+    """Compute difference hashes for images uploaded before they existed, from their thumbnails"""
+    from PIL import Image
+    conn = get_db()
+    cur = conn.cursor()
+    rows = cur.execute('SELECT id, gallery_id, filename FROM images WHERE phash IS NULL').fetchall()
+    updates = []
+    for row in rows:
+        image_path, thumb_path, _ = image_file_paths(row['gallery_id'], row['filename'])
+        source = thumb_path if os.path.exists(thumb_path) else image_path
+        try:
+            with Image.open(source) as img:
+                updates.append((image_dhash(img), row['id']))
+        except Exception as e:
+            print(f"Hash backfill error for {row['filename']}: {e}")
+    cur.executemany('UPDATE images SET phash=? WHERE id=?', updates)
+    conn.commit()
+    conn.close()
+    if updates:
+        # Hashes were added below the index's high-water mark
+        invalidate_duplicate_index()
+    return len(updates)
+
+# Colour palettes: a median-cut of a small copy of the thumbnail. Each swatch is
+# also stored in image_colors under its cell of an 8x8x8 RGB grid, so colour
+# searches only read the rows in the cells around the requested colour.
+PALETTE_COLORS = 5
+PALETTE_SAMPLE_SIZE = 64
+COLOR_BIN_BITS = 3
+
+def image_palette(img):
+    """Return up to PALETTE_COLORS [('#rrggbb', share of pixels)] for an open image, most common first"""
+    from PIL import Image
+    small = img.convert('RGB')
+    small.thumbnail((PALETTE_SAMPLE_SIZE, PALETTE_SAMPLE_SIZE), Image.BOX)
+    quantized = small.quantize(colors=PALETTE_COLORS, method=Image.Quantize.MEDIANCUT)
+    rgb = quantized.getpalette()
+    total = small.width * small.height
+    return [(f'#{rgb[3 * index]:02x}{rgb[3 * index + 1]:02x}{rgb[3 * index + 2]:02x}', round(count / total, 3))
+            for count, index in sorted(quantized.getcolors(), reverse=True)]
+
+def parse_hex_color(value):
+    """'#rrggbb' (or 'rrggbb') as an (r, g, b) tuple; None if it isn't one"""
+    value = (value or '').strip().lstrip('#')
+    if not re.fullmatch(r'[0-9a-fA-F]{6}', value):
+        return None
+    return tuple(int(value[i:i + 2], 16) for i in (0, 2, 4))
+
+def color_bin(r, g, b):
+    shift = 8 - COLOR_BIN_BITS
+    return (r >> shift) << (2 * COLOR_BIN_BITS) | (g >> shift) << COLOR_BIN_BITS | b >> shift
+
+def record_image_palette(cur, image_id, palette):
+    """Store an image's palette and index its swatches in image_colors for colour search"""
+    if palette is None:
+        return
+    cur.execute('UPDATE images SET palette=? WHERE id=?', (json.dumps(palette), image_id))
+    rows = []
+    for color, weight in palette:
+        r, g, b = parse_hex_color(color)
+        rows.append((image_id, color_bin(r, g, b), r, g, b, weight))
+    cur.executemany('INSERT INTO image_colors (image_id, color_bin, r, g, b, weight) VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+def backfill_image_palettes():
+    """Compute palettes for images uploaded before they existed, from their thumbnails"""
+    from PIL import Image
+    conn = get_db()
+    cur = conn.cursor()
+    rows = cur.execute('SELECT id, gallery_id, filename FROM images WHERE palette IS NULL').fetchall()
+    updated = 0
+    for row in rows:
+        image_path, thumb_path, _ = image_file_paths(row['gallery_id'], row['filename'])
+        source = thumb_path if os.path.exists(thumb_path) else image_path
+        try:
+            with Image.open(source) as img:
+                palette = image_palette(img)
+        except Exception as e:
+            print(f"Palette backfill error for {row['filename']}: {e}")
+            continue
+        record_image_palette(cur, row['id'], palette)
+        updated += 1
+    conn.commit()
+    conn.close()
+    return updated
+
+# EXIF orientations that rotate the image by 90 degrees, swapping width and height
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+def image_dimensions(img):
+    """Return (width, height, orientation) as displayed, i.e. after applying EXIF orientation"""
+    try:
+        orientation = int(img.getexif().get(0x0112, 1))
+    except Exception:
+        orientation = 1
+    width, height = img.size
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    return width, height, orientation
+
+def backfill_image_dimensions():
+    """Record dimensions for images uploaded before they were tracked; only headers are read"""
+    from PIL import Image
+    conn = get_db()
+    cur = conn.cursor()
+    rows = cur.execute('SELECT id, gallery_id, filename FROM images WHERE width IS NULL').fetchall()
+    updates = []
+    for row in rows:
+        image_path, _, _ = image_file_paths(row['gallery_id'], row['filename'])
+        try:
+            with Image.open(image_path) as img:
+                updates.append((*image_dimensions(img), row['id']))
+        except Exception as e:
+            print(f"Dimension backfill error for {row['filename']}: {e}")
+    cur.executemany('UPDATE images SET width=?, height=?, orientation=? WHERE id=?', updates)
+    conn.commit()
+    conn.close()
+    return len(updates)
+
+# One-off jobs that fill in derived columns for rows created before they existed
+BACKFILL_JOBS = [backfill_image_placeholders, backfill_image_dimensions, backfill_image_hashes,
+                 backfill_image_palettes]
+
+def _run_backfills():
+    for job in BACKFILL_JOBS:
+        try:
+            count = job()
+            if count:
+                print(f"Backfilled {count} rows with {job.__name__}")
+        except Exception as e:
+            print(f"Error running {job.__name__}: {e}")
+    # Build the duplicate index up front so /api/duplicates never pays for it
+    try:
+        conn = get_db()
+        get_duplicate_index(conn.cursor())
+        conn.close()
+    except Exception as e:
+        print(f"Error building duplicate index: {e}")
+
+@app.on_event('startup')
+def start_backfills():
+    """Run derived-column backfills in the background"""
+    threading.Thread(target=_run_backfills, name='backfills', daemon=True).start()
+
+def store_uploaded_image(gallery_id, filename, content, resize_config=None, staged_path=None):
+    """Write an upload (downscaled when configured), its thumbnail and any archived original.
+    
+    With staged_path the upload is a file on disk (a finalized chunked upload)
+    instead of `content` bytes. It is decoded from the file, never read into
+    memory, and renamed into place (or into the archive, if it was downscaled)
+    only after everything else has been written, so a failure leaves it staged.
+    Returns the byte counts, dimensions and placeholder to record on the images row.
+    """
+    from PIL import Image, ImageOps
+    file_path, thumb_path, archive_path = image_file_paths(gallery_id, filename)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    source = content if staged_path is None else staged_path
+    source_size = len(content) if staged_path is None else os.path.getsize(staged_path)
+    
+    archive_size = None
+    resized = downscale_image_bytes(source, resize_config)
+    keep_original = resized is not None and resize_config['keep_original']
+    if resized is not None:
+        with open(file_path, 'wb') as f:
+            f.write(resized)
+        if keep_original and staged_path is None:
+            os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+            with open(archive_path, 'wb') as f:
+                f.write(content)
+        archive_size = source_size if keep_original else None
+    elif staged_path is None:
+        with open(file_path, 'wb') as f:
+            f.write(content)
+    
+    # Generate thumbnail and placeholder from the stored (possibly downscaled) image
+    placeholder, dominant_color, phash, palette = None, None, None, None
+    width, height, orientation = None, None, None
+    if resized is not None:
+        stored = io.BytesIO(resized)
+    else:
+        stored = io.BytesIO(content) if staged_path is None else staged_path
+    try:
+        with Image.open(stored) as img:
+            width, height, orientation = image_dimensions(img)
+            img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            # Thumbnails are saved without EXIF, so bake the orientation into
+            # the pixels to match the stored (display) width and height
+            thumb = ImageOps.exif_transpose(img)
+            thumb.save(thumb_path)
+            placeholder, dominant_color = image_placeholder(thumb)
+            phash = image_dhash(thumb)
+            palette = image_palette(thumb)
+    except Exception as e:
+        print(f"Thumbnail error: {e}")
+    
+    if staged_path is not None:
+        if resized is None:
+            os.replace(staged_path, file_path)
+        elif keep_original:
+            os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+            os.replace(staged_path, archive_path)
+        else:
+            os.remove(staged_path)
+    
+    return {'file_size': len(resized) if resized is not None else source_size,
+            'thumb_size': _file_size(thumb_path), 'archive_size': archive_size,
+            'placeholder': placeholder, 'dominant_color': dominant_color, 'phash': phash,
+            'palette': palette,
+            'width': width, 'height': height, 'orientation': orientation}
+
+def draw_watermark(img, watermark_config, scale=1.0):
+    """Return an RGB copy of img with the watermark drawn on it.
+    
+    `scale` is img's size relative to the image the watermark is meant for, so
+    a thumbnail (scale < 1) gets a faithful miniature of the full-size result.
+    """
+    from PIL import Image, ImageDraw, ImageFont
+    # Convert to RGB if necessary (for PNG with transparency)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    
+    # Create a copy to work with
+    watermarked = img.copy()
+    
+    # Create a drawing context
+    draw = ImageDraw.Draw(watermarked)
+    
+    # Get watermark settings
+    text = watermark_config.get('text', '© Your Name')
+    font_family = watermark_config.get('font_family', 'arial')
+    opacity = int(watermark_config.get('opacity', 30))
+    position_vertical = watermark_config.get('position_vertical', 'bottom')
+    position_horizontal = watermark_config.get('position_horizontal', 'right')
+    
+    # Calculate font size - use the setting directly without scaling
+    # This maintains consistent DPI/physical size across all images
+    font_size = int(watermark_config.get('font_size', 16))
+    
+    # Optional: Add a minimum size constraint for very small images
+    img_width, img_height = watermarked.size
+    min_dimension = min(img_width, img_height) / scale
+    
+    # Only scale down if the image is very small (less than 200px in any dimension)
+    # to ensure watermark remains readable on tiny images
+    if min_dimension < 200:
+        scale_factor = min_dimension / 200
+        scaled_font_size = max(8, int(font_size * scale_factor))
+    else:
+        scaled_font_size = font_size
+    scaled_font_size = max(1, round(scaled_font_size * scale))
+    
+    # Try to load a system font, fallback to default
+    font = None
+    try:
+        # Try common system font paths
+        font_paths = [
+            f"C:/Windows/Fonts/{font_family.lower().replace(' ', '')}.ttf",
+            f"C:/Windows/Fonts/{font_family.lower()}.ttf",
+            "C:/Windows/Fonts/arial.ttf",
+            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+            "/System/Library/Fonts/Arial.ttf"
+        ]
+        
+        for font_path in font_paths:
+            if os.path.exists(font_path):
+                font = ImageFont.truetype(font_path, scaled_font_size)
+                break
+        
+        if font is None:
+            font = ImageFont.load_default()
+    
+    except Exception:
+        font = ImageFont.load_default()
+    
+    # Get text size
+    bbox = draw.textbbox((0, 0), text, font=font)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
+    
+    # Calculate padding (2% of image width/height)
+    padding_x = int(img_width * 0.02)
+    padding_y = int(img_height * 0.02)
+    
+    # Calculate position
+    if position_horizontal == 'left':
+        x = padding_x
+    elif position_horizontal == 'center':
+        x = (img_width - text_width) // 2
+    else:  # right
+        x = img_width - text_width - padding_x
+    
+    if position_vertical == 'top':
+        y = padding_y
+    else:  # bottom
+        y = img_height - text_height - padding_y
+    
+    # Create a semi-transparent overlay for the text background
+    overlay = Image.new('RGBA', watermarked.size, (0, 0, 0, 0))
+    overlay_draw = ImageDraw.Draw(overlay)
+    
+    # Draw background rectangle with some padding
+    bg_padding = max(1, round(4 * scale))
+    bg_opacity = int(opacity * 2.55 * 0.7)  # 70% of text opacity for background
+    overlay_draw.rectangle([
+        x - bg_padding, y - bg_padding,
+        x + text_width + bg_padding, y + text_height + bg_padding
+    ], fill=(0, 0, 0, bg_opacity))
+    
+    # Draw the text on the overlay
+    text_opacity = int(opacity * 2.55)  # Convert percentage to 0-255
+    overlay_draw.text((x, y), text, font=font, fill=(255, 255, 255, text_opacity))
+    
+    # Composite the overlay onto the image
+    watermarked = Image.alpha_composite(watermarked.convert('RGBA'), overlay)
+    
+    # Convert back to RGB for saving as JPEG
+    return watermarked.convert('RGB')
+
 def apply_watermark_to_image(src_path, dest_path, watermark_config):
     """Apply watermark to an image"""
+    from PIL import Image, ImageOps
     try:
         # Validate inputs
         if not watermark_config:
-            print("Warning: No watermark config provided, copying original image")
+            logger.warning("No watermark config provided, copying original image")
             shutil.copy2(src_path, dest_path)
             return False
-            
+        
         if not os.path.exists(src_path):
-            print(f"Warning: Source image not found: {src_path}")
+            logger.warning("Source image not found: %s", src_path)
             return False
         
         # Open the source image
         with Image.open(src_path) as img:
-            # Convert to RGB if necessary (for PNG with transparency)
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Create a copy to work with
-            watermarked = img.copy()
-            
-            # Create a drawing context
-            draw = ImageDraw.Draw(watermarked)
-            
-            # Get watermark settings
-            text = watermark_config.get('text', '© Your Name')
-            font_family = watermark_config.get('font_family', 'arial')
-            font_size = int(watermark_config.get('font_size', 16))
-            opacity = int(watermark_config.get('opacity', 30))
-            position_vertical = watermark_config.get('position_vertical', 'bottom')
-            position_horizontal = watermark_config.get('position_horizontal', 'right')
-            
-            # Calculate font size - use the setting directly without scaling
-            # This maintains consistent DPI/physical size across all images
-            font_size = int(watermark_config.get('font_size', 16))
-            
-            # Optional: Add a minimum size constraint for very small images
-            img_width, img_height = watermarked.size
-            min_dimension = min(img_width, img_height)
-            
-            # Only scale down if the image is very small (less than 200px in any dimension)
-            # to ensure watermark remains readable on tiny images
-            if min_dimension < 200:
-                scale_factor = min_dimension / 200
-                scaled_font_size = max(8, int(font_size * scale_factor))
-            else:
-                scaled_font_size = font_size
-            
-            # Try to load a system font, fallback to default
-            font = None
-            try:
-                # Try common system font paths
-                font_paths = [
-                    f"C:/Windows/Fonts/{font_family.lower().replace(' ', '')}.ttf",
-                    f"C:/Windows/Fonts/{font_family.lower()}.ttf",
-                    "C:/Windows/Fonts/arial.ttf",
-                    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-                    "/System/Library/Fonts/Arial.ttf"
-                ]
-                
-                for font_path in font_paths:
-                    if os.path.exists(font_path):
-                        font = ImageFont.truetype(font_path, scaled_font_size)
-                        break
-                        
-                if font is None:
-                    font = ImageFont.load_default()
-                    
-            except Exception:
-                font = ImageFont.load_default()
-            
-            # Get text size
-            bbox = draw.textbbox((0, 0), text, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-            
-            # Calculate padding (2% of image width/height)
-            padding_x = int(img_width * 0.02)
-            padding_y = int(img_height * 0.02)
-            
-            # Calculate position
-            if position_horizontal == 'left':
-                x = padding_x
-            elif position_horizontal == 'center':
-                x = (img_width - text_width) // 2
-            else:  # right
-                x = img_width - text_width - padding_x
-                
-            if position_vertical == 'top':
-                y = padding_y
-            else:  # bottom
-                y = img_height - text_height - padding_y
-            
-            # Create a semi-transparent overlay for the text background
-            overlay = Image.new('RGBA', watermarked.size, (0, 0, 0, 0))
-            overlay_draw = ImageDraw.Draw(overlay)
-            
-            # Draw background rectangle with some padding
-            bg_padding = 4
-            bg_opacity = int(opacity * 2.55 * 0.7)  # 70% of text opacity for background
-            overlay_draw.rectangle([
-                x - bg_padding, y - bg_padding, 
-                x + text_width + bg_padding, y + text_height + bg_padding
-            ], fill=(0, 0, 0, bg_opacity))
-            
-            # Draw the text on the overlay
-            text_opacity = int(opacity * 2.55)  # Convert percentage to 0-255
-            overlay_draw.text((x, y), text, font=font, fill=(255, 255, 255, text_opacity))
-            
-            # Composite the overlay onto the image
-            watermarked = Image.alpha_composite(watermarked.convert('RGBA'), overlay)
-            
-            # Convert back to RGB for saving as JPEG
-            watermarked = watermarked.convert('RGB')
+            # The output has no EXIF, so rotate the pixels upright first
+            watermarked = draw_watermark(ImageOps.exif_transpose(img), watermark_config)
             
             # Save the watermarked image
             watermarked.save(dest_path, 'JPEG', quality=95, optimize=True)
             
             return True
-            
+    
     except Exception as e:
-        print(f"Error applying watermark to {src_path}: {e}")
+        logger.warning("Error applying watermark to %s: %s", src_path, e)
         # Fallback: just copy the original image
         shutil.copy2(src_path, dest_path)
         return False
@@ -349,9 +1321,14 @@ def dashboard(request: Request, skip_welcome: bool = False):
     total_images = c.execute('SELECT COUNT(*) as count FROM images').fetchone()['count']
     enabled_images = c.execute('SELECT COUNT(*) as count FROM images WHERE enabled=1').fetchone()['count']
     
+    # Get tracked storage usage (no filesystem walk)
+    storage = get_storage_usage(c)
+    storage_threshold_gb = get_setting('storage_cleanup_threshold_gb', 0)
+    
     # Get recent galleries (last 5)
     recent_galleries = c.execute('''
-        SELECT g.*, COUNT(i.id) as image_count 
+        SELECT g.*, COUNT(i.id) as image_count, 
+               COALESCE(SUM(i.file_size), 0) + COALESCE(SUM(i.thumb_size), 0) + COALESCE(SUM(i.archive_size), 0) as storage_bytes 
         FROM galleries g 
         LEFT JOIN images i ON g.id = i.gallery_id 
         GROUP BY g.id 
@@ -388,19 +1365,14 @@ def dashboard(request: Request, skip_welcome: bool = False):
             })
     except Exception as e:
         print(f"Error fetching generated sites from database: {e}")
-        # Fallback to filesystem method for backwards compatibility
-        download_dir = 'downloads'
-        if os.path.exists(download_dir):
-            for filename in os.listdir(download_dir):
-                if filename.endswith('.zip'):
-                    file_path = os.path.join(download_dir, filename)
-                    stat = os.stat(file_path)
-                    generated_sites.append({
-                        'filename': filename,
-                        'name': filename.replace('.zip', '').replace('_', ' ').title(),
-                        'created': datetime.fromtimestamp(stat.st_mtime),
-                        'size': stat.st_size
-                    })
+        # Fallback to the archive directory snapshot for backwards compatibility
+        for filename, (size, mtime) in get_archive_snapshot().items():
+            generated_sites.append({
+                'filename': filename,
+                'name': filename.replace('.zip', '').replace('_', ' ').title(),
+                'created': datetime.fromtimestamp(mtime),
+                'size': size
+            })
         
         # Sort by creation time, newest first
         generated_sites.sort(key=lambda x: x['created'], reverse=True)
@@ -415,7 +1387,9 @@ def dashboard(request: Request, skip_welcome: bool = False):
         'enabled_images': enabled_images,
         'recent_galleries': recent_galleries,
         'recent_images': recent_images,
-        'generated_sites': generated_sites
+        'generated_sites': generated_sites,
+        'storage': storage,
+        'storage_threshold_gb': storage_threshold_gb
     })
 
 @app.get('/gallery/{gallery_id}', response_class=HTMLResponse)
@@ -435,17 +1409,33 @@ def view_generated_sites(request: Request):
     """View and manage all generated sites"""
     conn = get_db()
     
-    # Get all generated sites
-    sites = conn.execute('''SELECT * FROM generated_sites 
-                           ORDER BY created_at DESC''').fetchall()
+    # Get all generated sites (without the potentially large manifests)
+    sites = conn.execute('''SELECT id, site_title, site_description, theme, filename, file_size, 
+                                  gallery_count, image_count, created_at, gallery_ids, 
+                                  manifest IS NOT NULL AS has_manifest 
+                           FROM generated_sites 
+                           ORDER BY created_at DESC, id DESC''').fetchall()
+    
+    # Archive files on disk and gallery titles, each fetched once for all rows
+    archives_on_disk = get_archive_snapshot().keys()
+    gallery_titles = {str(row['id']): row['title'] for row in conn.execute('SELECT id, title FROM galleries')}
+    
+    # For each build with a manifest, the next older one with a manifest (to
+    # download a patch against), found in one pass from the oldest row
+    previous_ids = []
+    last_with_manifest = None
+    for site in reversed(sites):
+        previous_ids.append(last_with_manifest if site['has_manifest'] else None)
+        if site['has_manifest']:
+            last_with_manifest = site['id']
+    previous_ids.reverse()
     
     generated_sites = []
     total_size = 0
     
-    for site in sites:
+    for site, previous_id in zip(sites, previous_ids):
         # Check if file still exists
-        file_path = os.path.join('static', 'generated_sites', site['filename'])
-        file_exists = os.path.exists(file_path)
+        file_exists = site['filename'] in archives_on_disk
         
         # Convert bytes to MB for display
         file_size_mb = site['file_size'] / (1024 * 1024) if site['file_size'] else 0
@@ -456,9 +1446,8 @@ def view_generated_sites(request: Request):
         if site['gallery_ids']:
             gallery_ids = site['gallery_ids'].split(',')
             for gid in gallery_ids:
-                gallery = conn.execute('SELECT title FROM galleries WHERE id=?', (gid.strip(),)).fetchone()
-                if gallery:
-                    gallery_names.append(gallery['title'])
+                if gid.strip() in gallery_titles:
+                    gallery_names.append(gallery_titles[gid.strip()])
         
         generated_sites.append({
             'id': site['id'],
@@ -471,7 +1460,8 @@ def view_generated_sites(request: Request):
             'image_count': site['image_count'],
             'gallery_names': gallery_names,
             'created_at': site['created_at'],
-            'file_exists': file_exists
+            'file_exists': file_exists,
+            'previous_id': previous_id
         })
     
     conn.close()
@@ -496,9 +1486,10 @@ def delete_generated_site(site_id: int):
         
         if site:
             # Delete file if it exists
-            file_path = os.path.join('static', 'generated_sites', site['filename'])
+            file_path = os.path.join(GENERATED_SITES_DIR, site['filename'])
             if os.path.exists(file_path):
                 os.remove(file_path)
+                invalidate_archive_snapshot()
             
             # Delete from database
             conn.execute('DELETE FROM generated_sites WHERE id=?', (site_id,))
@@ -518,32 +1509,26 @@ def cleanup_generated_sites():
     try:
         conn = get_db()
         
-        # Get all sites from database
+        # Get all sites from database and a fresh snapshot of the archive directory
         sites = conn.execute('SELECT id, filename FROM generated_sites').fetchall()
+        invalidate_archive_snapshot()
+        disk_filenames = set(get_archive_snapshot())
+        db_filenames = {site['filename'] for site in sites}
         
         # Check for orphaned database entries (files that don't exist)
-        orphaned_entries = []
-        for site in sites:
-            file_path = os.path.join('static', 'generated_sites', site['filename'])
-            if not os.path.exists(file_path):
-                orphaned_entries.append(site['id'])
+        missing_filenames = db_filenames - disk_filenames
+        orphaned_entries = [site['id'] for site in sites if site['filename'] in missing_filenames]
         
         # Remove orphaned database entries
-        for site_id in orphaned_entries:
-            conn.execute('DELETE FROM generated_sites WHERE id=?', (site_id,))
+        conn.executemany('DELETE FROM generated_sites WHERE id=?', [(site_id,) for site_id in orphaned_entries])
         
-        # Check for orphaned files (files without database entries)
-        generated_sites_dir = os.path.join('static', 'generated_sites')
-        if os.path.exists(generated_sites_dir):
-            db_filenames = {site['filename'] for site in sites}
-            
-            for filename in os.listdir(generated_sites_dir):
-                if filename.endswith('.zip') and filename not in db_filenames:
-                    file_path = os.path.join(generated_sites_dir, filename)
-                    os.remove(file_path)
+        # Queue orphaned files (files without database entries) for the reaper
+        trash_files(conn.cursor(), [os.path.join(GENERATED_SITES_DIR, filename)
+                                    for filename in sorted(disk_filenames - db_filenames)])
         
         conn.commit()
         conn.close()
+        wake_deletion_reaper()
         
         message = f"Cleanup complete. Removed {len(orphaned_entries)} orphaned database entries."
         return RedirectResponse(f'/generated-sites?message={message}', status_code=303)
@@ -648,7 +1633,7 @@ def delete_gallery(gallery_id: int):
         return RedirectResponse('/galleries?error=Gallery+not+found', status_code=303)
     
     # Get all images in this gallery for file cleanup
-    images = c.execute('SELECT filename FROM images WHERE gallery_id=?', (gallery_id,)).fetchall()
+    images = c.execute('SELECT id, filename FROM images WHERE gallery_id=?', (gallery_id,)).fetchall()
     
     # Delete images from database
     c.execute('DELETE FROM images WHERE gallery_id=?', (gallery_id,))
@@ -656,19 +1641,14 @@ def delete_gallery(gallery_id: int):
     # Delete gallery from database
     c.execute('DELETE FROM galleries WHERE id=?', (gallery_id,))
     
+    # Trash the gallery folder and its thumbnails for the background reaper
+    trash_files(c, [f'static/gallery_{gallery_id}', os.path.join(ORIGINALS_ARCHIVE_DIR, f'gallery_{gallery_id}')] +
+                   [image_file_paths(gallery_id, image['filename'])[1] for image in images])
+    
     conn.commit()
     conn.close()
-    
-    # Clean up image files
-    gallery_dir = f'static/gallery_{gallery_id}'
-    if os.path.exists(gallery_dir):
-        shutil.rmtree(gallery_dir)
-    
-    # Clean up thumbnail files
-    for image in images:
-        thumb_path = f'static/thumbs/{image["filename"]}'
-        if os.path.exists(thumb_path):
-            os.remove(thumb_path)
+    forget_duplicate_images([image['id'] for image in images])
+    wake_deletion_reaper()
     
     return RedirectResponse('/galleries?message=Gallery+deleted+successfully', status_code=303)
 
@@ -678,21 +1658,8 @@ def add_image_form(request: Request, gallery_id: int):
 
 @app.post('/gallery/{gallery_id}/add-image')
 def add_image(gallery_id: int, file: UploadFile = File(...), title: str = Form(None), description: str = Form(None), camera_type: str = Form(None), lens: str = Form(None), settings: str = Form(None)):
-    # Save image
-    os.makedirs(f'static/gallery_{gallery_id}', exist_ok=True)
-    os.makedirs('static/thumbs', exist_ok=True)
-    file_path = f'static/gallery_{gallery_id}/{file.filename}'
-    thumb_path = f'static/thumbs/{file.filename}'
-    with open(file_path, 'wb') as f:
-        content = file.file.read()
-        f.write(content)
-    # Generate thumbnail
-    try:
-        with Image.open(file_path) as img:
-            img.thumbnail((400, 400))
-            img.save(thumb_path)
-    except Exception as e:
-        print(f"Thumbnail error: {e}")
+    # Save image and thumbnail
+    sizes = store_uploaded_image(gallery_id, file.filename, file.file.read(), get_upload_resize_config())
     # Extract EXIF (to be implemented)
     exif = ''
     # Save to DB
@@ -700,12 +1667,13 @@ def add_image(gallery_id: int, file: UploadFile = File(...), title: str = Form(N
     cur = conn.cursor()
     
     # Get next sort order
-    max_sort = cur.execute('SELECT COALESCE(MAX(sort_order), -1) FROM images WHERE gallery_id=?', (gallery_id,)).fetchone()[0]
-    next_sort_order = max_sort + 1
+    max_sort = cur.execute('SELECT COALESCE(MAX(sort_order), ?) FROM images WHERE gallery_id=?', (-RANK_STEP, gallery_id)).fetchone()[0]
+    next_sort_order = max_sort + RANK_STEP
     
-    cur.execute('''INSERT INTO images (gallery_id, filename, title, description, camera_type, lens, settings, exif, enabled, sort_order) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                (gallery_id, file.filename, title, description, camera_type, lens, settings, exif, 1, next_sort_order))
+    cur.execute('''INSERT INTO images (gallery_id, filename, title, description, camera_type, lens, settings, exif, enabled, sort_order, file_size, thumb_size, archive_size, placeholder, dominant_color, width, height, orientation, phash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (gallery_id, file.filename, title, description, camera_type, lens, settings, exif, 1, next_sort_order, sizes['file_size'], sizes['thumb_size'], sizes['archive_size'], sizes['placeholder'], sizes['dominant_color'], sizes['width'], sizes['height'], sizes['orientation'], sizes['phash']))
     image_id = cur.lastrowid
+    record_image_palette(cur, image_id, sizes['palette'])
     # If this is the first image in the gallery, set as featured
     gallery = cur.execute('SELECT * FROM galleries WHERE id=?', (gallery_id,)).fetchone()
     if not gallery['featured_image_id']:
@@ -714,110 +1682,348 @@ def add_image(gallery_id: int, file: UploadFile = File(...), title: str = Form(N
     conn.close()
     return RedirectResponse(f'/gallery/{gallery_id}', status_code=303)
 
-# Multiple image upload with EXIF extraction
-@app.post('/gallery/{gallery_id}/upload-multiple')
-def upload_multiple_images(gallery_id: int, files: List[UploadFile] = File(...)):
-    results = []
-    conn = get_db()
-    cur = conn.cursor()
+def extract_upload_exif(content):
+    """Read camera, lens and exposure settings plus the full EXIF dict from uploaded bytes or a file path"""
+    exif_data = {}
+    camera_type = ""
+    lens = ""
+    settings = ""
     
-    for file in files:
-        try:
-            # Save image
-            os.makedirs(f'static/gallery_{gallery_id}', exist_ok=True)
-            os.makedirs('static/thumbs', exist_ok=True)
-            file_path = f'static/gallery_{gallery_id}/{file.filename}'
-            thumb_path = f'static/thumbs/{file.filename}'
-            
-            # Read file content
-            content = file.file.read()
-            
-            # Extract EXIF data from original file content first
-            exif_data = {}
-            camera_type = ""
-            lens = ""
-            settings = ""
-            
+    try:
+        # Create a BytesIO object from the content for EXIF reading
+        import exifread
+        if isinstance(content, bytes):
+            tags = exifread.process_file(io.BytesIO(content))
+        else:
+            with open(content, 'rb') as f:
+                tags = exifread.process_file(f)
+        
+        # Extract useful EXIF data
+        if 'Image Make' in tags and 'Image Model' in tags:
+            camera_type = f"{tags['Image Make']} {tags['Image Model']}"
+        elif 'Image Model' in tags:
+            camera_type = str(tags['Image Model'])
+        
+        if 'EXIF LensModel' in tags:
+            lens = str(tags['EXIF LensModel'])
+        elif 'EXIF LensMake' in tags:
+            lens = str(tags['EXIF LensMake'])
+        
+        # Camera settings
+        settings_parts = []
+        if 'EXIF ExposureTime' in tags:
+            settings_parts.append(f"1/{int(1/float(tags['EXIF ExposureTime'].values[0]))}s")
+        if 'EXIF FNumber' in tags:
+            settings_parts.append(f"f/{float(tags['EXIF FNumber'].values[0])}")
+        if 'EXIF ISOSpeedRatings' in tags:
+            settings_parts.append(f"ISO {tags['EXIF ISOSpeedRatings']}")
+        if 'EXIF FocalLength' in tags:
+            settings_parts.append(f"{float(tags['EXIF FocalLength'].values[0])}mm")
+        
+        settings = ", ".join(settings_parts)
+        
+        # Store full EXIF as JSON
+        exif_data = {str(k): str(v) for k, v in tags.items() if k not in ['JPEGThumbnail', 'TIFFThumbnail']}
+    
+    except Exception as e:
+        print(f"EXIF extraction error: {e}")
+    
+    return {'camera_type': camera_type, 'lens': lens, 'settings': settings, 'exif': exif_data}
+
+def record_uploaded_image(cur, gallery_id, filename, metadata, sizes):
+    """Insert an uploaded image after the gallery's last one, featuring it if the gallery has none; returns its id"""
+    # Get next sort order
+    max_sort = cur.execute('SELECT COALESCE(MAX(sort_order), ?) FROM images WHERE gallery_id=?', (-RANK_STEP, gallery_id)).fetchone()[0]
+    next_sort_order = max_sort + RANK_STEP
+    
+    # Save to DB
+    cur.execute('''INSERT INTO images (gallery_id, filename, title, description, camera_type, lens, settings, exif, enabled, sort_order, file_size, thumb_size, archive_size, placeholder, dominant_color, width, height, orientation, phash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (gallery_id, filename, filename, "", metadata['camera_type'], metadata['lens'], metadata['settings'], json.dumps(metadata['exif']), 1, next_sort_order, sizes['file_size'], sizes['thumb_size'], sizes['archive_size'], sizes['placeholder'], sizes['dominant_color'], sizes['width'], sizes['height'], sizes['orientation'], sizes['phash']))
+    image_id = cur.lastrowid
+    record_image_palette(cur, image_id, sizes['palette'])
+    
+    # If this is the first image in the gallery, set as featured
+    gallery = cur.execute('SELECT * FROM galleries WHERE id=?', (gallery_id,)).fetchone()
+    if not gallery['featured_image_id']:
+        cur.execute('UPDATE galleries SET featured_image_id=? WHERE id=?', (image_id, gallery_id))
+    return image_id
+
+def process_uploads(gallery_id, files, commit_each=False):
+    """Run uploaded files through EXIF extraction, storage and the images table, yielding progress events.
+    
+    Yields (event, data) pairs per file: received, exif, thumbnail, then
+    committed (or failed). Every event carries the file's index and filename.
+    With commit_each, each image is committed on its own connection as soon as
+    it is stored (the streaming route needs that, since its iterator may resume
+    on a different thread); otherwise the batch is one transaction.
+    """
+    resize_config = get_upload_resize_config()
+    batch_conn = None if commit_each else get_db()
+    try:
+        for index, file in enumerate(files):
+            event = {'index': index, 'filename': file.filename}
             try:
-                # Create a BytesIO object from the content for EXIF reading
-                content_stream = io.BytesIO(content)
-                tags = exifread.process_file(content_stream)
-                
-                # Extract useful EXIF data
-                if 'Image Make' in tags and 'Image Model' in tags:
-                    camera_type = f"{tags['Image Make']} {tags['Image Model']}"
-                elif 'Image Model' in tags:
-                    camera_type = str(tags['Image Model'])
-                
-                if 'EXIF LensModel' in tags:
-                    lens = str(tags['EXIF LensModel'])
-                elif 'EXIF LensMake' in tags:
-                    lens = str(tags['EXIF LensMake'])
+                # Read file content
+                content = file.file.read()
+                yield 'received', dict(event, bytes=len(content))
                 
-                # Camera settings
-                settings_parts = []
-                if 'EXIF ExposureTime' in tags:
-                    settings_parts.append(f"1/{int(1/float(tags['EXIF ExposureTime'].values[0]))}s")
-                if 'EXIF FNumber' in tags:
-                    settings_parts.append(f"f/{float(tags['EXIF FNumber'].values[0])}")
-                if 'EXIF ISOSpeedRatings' in tags:
-                    settings_parts.append(f"ISO {tags['EXIF ISOSpeedRatings']}")
-                if 'EXIF FocalLength' in tags:
-                    settings_parts.append(f"{float(tags['EXIF FocalLength'].values[0])}mm")
+                # Extract EXIF data from original file content first
+                metadata = extract_upload_exif(content)
+                yield 'exif', dict(event, camera_type=metadata['camera_type'], lens=metadata['lens'],
+                                   settings=metadata['settings'])
                 
-                settings = ", ".join(settings_parts)
+                # Now save the image (downscaled if configured) and its thumbnail
+                sizes = store_uploaded_image(gallery_id, file.filename, content, resize_config)
+                yield 'thumbnail', dict(event, thumbnail=f'/static/thumbs/{file.filename}',
+                                        width=sizes['width'], height=sizes['height'])
                 
-                # Store full EXIF as JSON
-                exif_data = {str(k): str(v) for k, v in tags.items() if k not in ['JPEGThumbnail', 'TIFFThumbnail']}
-                
-            except Exception as e:
-                print(f"EXIF extraction error: {e}")
-            
-            # Now save the original file
-            with open(file_path, 'wb') as f:
-                f.write(content)
+                conn = batch_conn or get_db()
+                try:
+                    image_id = record_uploaded_image(conn.cursor(), gallery_id, file.filename, metadata, sizes)
+                    if commit_each:
+                        conn.commit()
+                finally:
+                    if commit_each:
+                        conn.close()
+                yield 'committed', dict(event, image_id=image_id, camera_type=metadata['camera_type'],
+                                        lens=metadata['lens'], settings=metadata['settings'])
             
-            # Generate thumbnail from the saved original file
-            try:
-                with Image.open(file_path) as img:
-                    img.thumbnail((400, 400))
-                    img.save(thumb_path)
             except Exception as e:
-                print(f"Thumbnail error: {e}")
-            
-            # Get next sort order
-            max_sort = cur.execute('SELECT COALESCE(MAX(sort_order), -1) FROM images WHERE gallery_id=?', (gallery_id,)).fetchone()[0]
-            next_sort_order = max_sort + 1
-            
-            # Save to DB
-            cur.execute('''INSERT INTO images (gallery_id, filename, title, description, camera_type, lens, settings, exif, enabled, sort_order) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                        (gallery_id, file.filename, file.filename, "", camera_type, lens, settings, json.dumps(exif_data), 1, next_sort_order))
-            image_id = cur.lastrowid
-            
-            # If this is the first image in the gallery, set as featured
-            gallery = cur.execute('SELECT * FROM galleries WHERE id=?', (gallery_id,)).fetchone()
-            if not gallery['featured_image_id']:
-                cur.execute('UPDATE galleries SET featured_image_id=? WHERE id=?', (image_id, gallery_id))
-            
+                yield 'failed', dict(event, error=str(e))
+        
+        if batch_conn:
+            batch_conn.commit()
+    finally:
+        if batch_conn:
+            batch_conn.close()
+
+# Multiple image upload with EXIF extraction
+@app.post('/gallery/{gallery_id}/upload-multiple')
+def upload_multiple_images(gallery_id: int, files: List[UploadFile] = File(...)):
+    results = []
+    for event, data in process_uploads(gallery_id, files):
+        if event == 'committed':
             results.append({
                 "success": True,
-                "filename": file.filename,
-                "image_id": image_id,
-                "camera_type": camera_type,
-                "lens": lens,
-                "settings": settings
+                "filename": data['filename'],
+                "image_id": data['image_id'],
+                "camera_type": data['camera_type'],
+                "lens": data['lens'],
+                "settings": data['settings']
             })
-            
-        except Exception as e:
+        elif event == 'failed':
             results.append({
                 "success": False,
-                "filename": file.filename,
-                "error": str(e)
+                "filename": data['filename'],
+                "error": data['error']
             })
+    return {"results": results}
+
+def render_image_card(image_id):
+    """Render the gallery page's card for one image, for inserting into a live page"""
+    conn = get_db()
+    image = conn.execute('SELECT * FROM images WHERE id=?', (image_id,)).fetchone()
+    gallery = conn.execute('SELECT * FROM galleries WHERE id=?', (image['gallery_id'],)).fetchone()
+    conn.close()
+    return templates.get_template('partials/_image_card.html').render(image=image, gallery=gallery)
+
+def sse_event(event, data):
+    """Format one Server-Sent Event with a JSON payload"""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+@app.post('/gallery/{gallery_id}/upload-stream')
+def upload_images_stream(gallery_id: int, files: List[UploadFile] = File(...)):
+    """Upload like upload-multiple, streaming per-file progress as Server-Sent Events.
+    
+    Events: received, exif, thumbnail, committed (with the rendered image card
+    as `html`), failed, and a final done with the success/failure counts.
+    """
+    def events():
+        counts = {'committed': 0, 'failed': 0}
+        for event, data in process_uploads(gallery_id, files, commit_each=True):
+            if event == 'committed':
+                data['html'] = render_image_card(data['image_id'])
+            if event in counts:
+                counts[event] += 1
+            yield sse_event(event, data)
+        yield sse_event('done', {'total': len(files), **counts})
+    
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Resumable chunked uploads
+#
+# POST /api/uploads opens a session for one file, PUT /api/uploads/{id}?offset=N
+# appends a chunk, GET /api/uploads/{id} reports how many bytes have arrived (the
+# offset to resume from after a dropped connection) and POST .../finalize runs
+# the normal EXIF/thumbnail pipeline. Chunks are written into a per-session .part
+# file in UPLOAD_STAGING_DIR (outside the public /static mount). Finalize decodes
+# it from disk and renames it into the gallery only once the thumbnail and row
+# are done, so bytes are never re-sent, copied or held in memory, and a failed
+# finalize can simply be retried.
+UPLOAD_SESSION_TTL_HOURS = 24
+UPLOAD_STAGING_DIR = 'uploads'
+
+def upload_part_path(upload):
+    """Where a session's bytes accumulate until finalize"""
+    return os.path.join(UPLOAD_STAGING_DIR, f"{upload['id']}.part")
+
+def upload_session_status(upload):
+    return {"success": True, "upload_id": upload['id'], "gallery_id": upload['gallery_id'],
+            "filename": upload['filename'], "size": upload['total_size'], "offset": upload['received']}
+
+def expire_upload_sessions(cur):
+    """Drop sessions idle for longer than the TTL, trashing their partial files"""
+    stale = cur.execute("SELECT * FROM upload_sessions WHERE updated_at < datetime('now', ?)",
+                        (f'-{UPLOAD_SESSION_TTL_HOURS} hours',)).fetchall()
+    trash_files(cur, [upload_part_path(upload) for upload in stale])
+    cur.executemany('DELETE FROM upload_sessions WHERE id=?', [(upload['id'],) for upload in stale])
+    return len(stale)
+
+@app.post('/api/uploads')
+def create_upload(gallery_id: int = Form(...), filename: str = Form(...), size: int = Form(...)):
+    """Start a resumable upload of one file of `size` bytes into a gallery"""
+    filename = os.path.basename(filename.replace('\\', '/')).strip()
+    if not filename or size <= 0:
+        return {"success": False, "error": "A filename and a positive size are required"}
+    
+    conn = get_db()
+    cur = conn.cursor()
+    if not cur.execute('SELECT id FROM galleries WHERE id=?', (gallery_id,)).fetchone():
+        conn.close()
+        return {"success": False, "error": "Gallery not found"}
     
+    if expire_upload_sessions(cur):
+        wake_deletion_reaper()
+    upload = {'id': uuid.uuid4().hex, 'gallery_id': gallery_id, 'filename': filename,
+              'total_size': size, 'received': 0}
+    part_path = upload_part_path(upload)
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    open(part_path, 'wb').close()
+    cur.execute('INSERT INTO upload_sessions (id, gallery_id, filename, total_size) VALUES (?, ?, ?, ?)',
+                (upload['id'], gallery_id, filename, size))
     conn.commit()
     conn.close()
-    return {"results": results}
+    return upload_session_status(upload)
+
+@app.get('/api/uploads/{upload_id}')
+def get_upload(upload_id: str):
+    """Report how many bytes of an upload have been stored, i.e. where to resume"""
+    conn = get_db()
+    upload = conn.execute('SELECT * FROM upload_sessions WHERE id=?', (upload_id,)).fetchone()
+    conn.close()
+    if not upload:
+        return {"success": False, "error": "Upload not found"}
+    return upload_session_status(upload)
+
+def write_upload_chunk(upload_id, offset, data):
+    """Write a chunk at `offset`, which must be exactly the number of bytes received so far"""
+    conn = get_db()
+    cur = conn.cursor()
+    upload = cur.execute('SELECT * FROM upload_sessions WHERE id=?', (upload_id,)).fetchone()
+    if not upload:
+        conn.close()
+        return {"success": False, "error": "Upload not found"}
+    if offset != upload['received']:
+        conn.close()
+        return {"success": False, "error": "Offset mismatch", "offset": upload['received']}
+    if offset + len(data) > upload['total_size']:
+        conn.close()
+        return {"success": False, "error": "Chunk runs past the declared size", "offset": upload['received']}
+    
+    with open(upload_part_path(upload), 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+    
+    # Only advance if no concurrent retry of the same chunk got there first
+    cur.execute('UPDATE upload_sessions SET received=?, updated_at=CURRENT_TIMESTAMP WHERE id=? AND received=?',
+                (offset + len(data), upload_id, offset))
+    conn.commit()
+    upload = cur.execute('SELECT * FROM upload_sessions WHERE id=?', (upload_id,)).fetchone()
+    conn.close()
+    return upload_session_status(upload)
+
+@app.put('/api/uploads/{upload_id}')
+async def append_upload_chunk(upload_id: str, offset: int, request: Request):
+    """Append the raw request body to an upload at `offset`; returns the new offset"""
+    data = await request.body()
+    return await run_db(write_upload_chunk, upload_id, offset, data)
+
+@app.post('/api/uploads/{upload_id}/finalize')
+def finalize_upload(upload_id: str):
+    """Run a complete upload through EXIF extraction, thumbnails and the images table, then move it into place.
+    
+    The stored name gets a numeric suffix if the gallery already has that
+    filename. If processing fails the .part file and session are left as they
+    were, so finalize can be retried.
+    """
+    conn = get_db()
+    cur = conn.cursor()
+    upload = cur.execute('SELECT * FROM upload_sessions WHERE id=?', (upload_id,)).fetchone()
+    if not upload:
+        conn.close()
+        return {"success": False, "error": "Upload not found"}
+    if upload['received'] != upload['total_size']:
+        conn.close()
+        return {"success": False, "error": "Upload incomplete", "offset": upload['received']}
+    if not cur.execute('SELECT id FROM galleries WHERE id=?', (upload['gallery_id'],)).fetchone():
+        cur.execute('DELETE FROM upload_sessions WHERE id=?', (upload_id,))
+        trash_files(cur, [upload_part_path(upload)])
+        conn.commit()
+        conn.close()
+        wake_deletion_reaper()
+        return {"success": False, "error": "Gallery not found"}
+    
+    part_path = upload_part_path(upload)
+    filename = available_image_filename(cur, upload['gallery_id'], upload['filename'])
+    try:
+        metadata = extract_upload_exif(part_path)
+        sizes = store_uploaded_image(upload['gallery_id'], filename, None, get_upload_resize_config(),
+                                     staged_path=part_path)
+    except Exception as e:
+        conn.close()
+        return {"success": False, "error": str(e)}
+    
+    try:
+        image_id = record_uploaded_image(cur, upload['gallery_id'], filename, metadata, sizes)
+        cur.execute('DELETE FROM upload_sessions WHERE id=?', (upload_id,))
+        conn.commit()
+    except Exception as e:
+        # The file has already been moved into place, so there is nothing left
+        # to retry: drop the session and the stored files
+        conn.rollback()
+        cur.execute('DELETE FROM upload_sessions WHERE id=?', (upload_id,))
+        trash_files(cur, image_file_paths(upload['gallery_id'], filename))
+        conn.commit()
+        conn.close()
+        wake_deletion_reaper()
+        return {"success": False, "error": str(e)}
+    
+    conn.close()
+    return {
+        "success": True,
+        "filename": filename,
+        "image_id": image_id,
+        "camera_type": metadata['camera_type'],
+        "lens": metadata['lens'],
+        "settings": metadata['settings']
+    }
+
+@app.delete('/api/uploads/{upload_id}')
+def abort_upload(upload_id: str):
+    """Abandon an upload and delete what was received"""
+    conn = get_db()
+    cur = conn.cursor()
+    upload = cur.execute('SELECT * FROM upload_sessions WHERE id=?', (upload_id,)).fetchone()
+    if not upload:
+        conn.close()
+        return {"success": False, "error": "Upload not found"}
+    cur.execute('DELETE FROM upload_sessions WHERE id=?', (upload_id,))
+    trash_files(cur, [upload_part_path(upload)])
+    conn.commit()
+    conn.close()
+    wake_deletion_reaper()
+    return {"success": True}
 
 # Set featured image for gallery
 @app.post('/gallery/{gallery_id}/set-featured/{image_id}')
@@ -859,24 +2065,129 @@ async def reorder_images(gallery_id: int, request: Request):
     except:
         return {"success": False, "error": "Invalid JSON"}
     
+    return await run_db(save_image_order, gallery_id, image_order)
+
+def save_image_order(gallery_id, image_order):
+    """Write the sort_order of each {id, sort_order} item that belongs to the gallery"""
     conn = get_db()
     cur = conn.cursor()
     
-    # Update sort_order for each image
-    for item in image_order:
-        image_id = item.get('id')
-        sort_order = item.get('sort_order')
-        
-        # Verify the image belongs to this gallery
-        image = cur.execute('SELECT * FROM images WHERE id=? AND gallery_id=?', (image_id, gallery_id)).fetchone()
-        if image:
-            cur.execute('UPDATE images SET sort_order=? WHERE id=?', (sort_order, image_id))
+    # Verify ownership with one query, then write every new position in one batch
+    gallery_image_ids = {row['id'] for row in cur.execute('SELECT id FROM images WHERE gallery_id=?', (gallery_id,))}
+    updates = [(item.get('sort_order'), item.get('id')) for item in image_order
+               if isinstance(item, dict) and item.get('id') in gallery_image_ids]
+    cur.executemany('UPDATE images SET sort_order=? WHERE id=?', updates)
     
     conn.commit()
     conn.close()
     
     return {"success": True}
 
+def respace_gallery_ranks(cur, gallery_id):
+    """Respace a gallery's sort_order values RANK_STEP apart, keeping the current order (no commit)"""
+    ids = [row[0] for row in cur.execute(
+        'SELECT id FROM images WHERE gallery_id=? ORDER BY sort_order ASC, id ASC', (gallery_id,)).fetchall()]
+    cur.executemany('UPDATE images SET sort_order=? WHERE id=?',
+                    [(index * RANK_STEP, image_id) for index, image_id in enumerate(ids)])
+
+def rebalance_gallery_ranks(gallery_id):
+    """Respace a gallery's sort_order values RANK_STEP apart, keeping the current order"""
+    conn = get_db()
+    respace_gallery_ranks(conn.cursor(), gallery_id)
+    conn.commit()
+    conn.close()
+
+def _move_neighbours(cur, gallery_id, image_id, after_id, before_id):
+    """Return the (id, sort_order) of the images a move puts image_id between (None past a list end).
+
+    When only one neighbour is given, the other is the image actually adjacent
+    to it, not counting the moved image. Raises ValueError if a neighbour is not
+    in the gallery or after_id does not come before before_id.
+    """
+    given = {}
+    for neighbour_id in (after_id, before_id):
+        if neighbour_id is not None:
+            row = cur.execute('SELECT id, sort_order FROM images WHERE id=? AND gallery_id=? AND id != ?',
+                              (neighbour_id, gallery_id, image_id)).fetchone()
+            if not row:
+                raise ValueError("Image not found")
+            given[neighbour_id] = (row['id'], row['sort_order'])
+    low, high = given.get(after_id), given.get(before_id)
+    
+    # Images are ordered by (sort_order, id)
+    if low is None:
+        row = cur.execute('''SELECT id, sort_order FROM images WHERE gallery_id=? AND id != ? AND (sort_order, id) < (?, ?) 
+                             ORDER BY sort_order DESC, id DESC LIMIT 1''', (gallery_id, image_id, high[1], high[0])).fetchone()
+        low = (row['id'], row['sort_order']) if row else None
+    elif high is None:
+        row = cur.execute('''SELECT id, sort_order FROM images WHERE gallery_id=? AND id != ? AND (sort_order, id) > (?, ?) 
+                             ORDER BY sort_order ASC, id ASC LIMIT 1''', (gallery_id, image_id, low[1], low[0])).fetchone()
+        high = (row['id'], row['sort_order']) if row else None
+    elif (low[1], low[0]) >= (high[1], high[0]):
+        raise ValueError("after_id must come before before_id")
+    return low, high
+
+# Move a single image between two neighbours
+@app.post('/gallery/{gallery_id}/move')
+async def move_image(gallery_id: int, request: Request, background_tasks: BackgroundTasks):
+    """Move one image so it sits after `after_id` and before `before_id`.
+
+    Only the moved row is rewritten. When the neighbours' ranks are too close to
+    fit a new one between them the gallery is respaced first, and a respacing is
+    scheduled in the background once a gap is nearly used up.
+    """
+    body = await request.body()
+    try:
+        data = json.loads(body.decode())
+        image_id = data['image_id']
+        after_id = data.get('after_id')
+        before_id = data.get('before_id')
+    except:
+        return {"success": False, "error": "Invalid JSON"}
+    
+    if after_id is None and before_id is None:
+        return {"success": False, "error": "after_id or before_id is required"}
+    
+    result = await run_db(move_image_rank, gallery_id, image_id, after_id, before_id)
+    if result.pop('rebalance', False):
+        background_tasks.add_task(rebalance_gallery_ranks, gallery_id)
+    return result
+
+def move_image_rank(gallery_id, image_id, after_id, before_id):
+    """Give image_id a sort_order between its new neighbours; see move_image"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('BEGIN IMMEDIATE')  # Neighbours can't change between reading them and the update
+    
+    if not cur.execute('SELECT id FROM images WHERE id=? AND gallery_id=?', (image_id, gallery_id)).fetchone():
+        conn.close()
+        return {"success": False, "error": "Image not found"}
+    try:
+        low, high = _move_neighbours(cur, gallery_id, image_id, after_id, before_id)
+    except ValueError as e:
+        conn.close()
+        return {"success": False, "error": str(e)}
+    
+    if low is not None and high is not None and high[1] - low[1] < 2:
+        # No integer left between the neighbours; respace in this transaction and look again
+        respace_gallery_ranks(cur, gallery_id)
+        low, high = [(i, cur.execute('SELECT sort_order FROM images WHERE id=?', (i,)).fetchone()[0])
+                     for i, _ in (low, high)]
+    
+    if low is None:
+        new_rank = high[1] - RANK_STEP
+    elif high is None:
+        new_rank = low[1] + RANK_STEP
+    else:
+        new_rank = (low[1] + high[1]) // 2
+    
+    cur.execute('UPDATE images SET sort_order=? WHERE id=?', (new_rank, image_id))
+    conn.commit()
+    conn.close()
+    
+    rebalance = low is not None and high is not None and min(new_rank - low[1], high[1] - new_rank) < 2
+    return {"success": True, "sort_order": new_rank, "rebalance": rebalance}
+
 # Toggle image enabled/disabled
 @app.post('/image/{image_id}/toggle-enabled')
 def toggle_image_enabled(image_id: int):
@@ -923,21 +2234,143 @@ def delete_image(image_id: int):
         # Remove featured image reference if this was the featured image
         cur.execute('UPDATE galleries SET featured_image_id=NULL WHERE featured_image_id=?', (image_id,))
         
+        # Trash files for the background reaper
+        trash_files(cur, image_file_paths(gallery_id, filename))
+        
         conn.commit()
         conn.close()
-        
-        # Delete files
-        try:
-            os.remove(f'static/gallery_{gallery_id}/{filename}')
-            os.remove(f'static/thumbs/{filename}')
-        except:
-            pass  # Files might not exist
+        forget_duplicate_images([image_id])
+        wake_deletion_reaper()
             
         return {"success": True, "gallery_id": gallery_id}
     else:
         conn.close()
         return {"success": False}
 
+# Image fields that a bulk "set" action may change
+BULK_EDITABLE_FIELDS = ('title', 'description', 'camera_type', 'lens', 'settings', 'enabled')
+
+def _move_image_files(moves):
+    """Relocate image files after a bulk move has committed"""
+    for from_gallery_id, to_gallery_id, filename in moves:
+        src_image, _, src_archive = image_file_paths(from_gallery_id, filename)
+        dest_image, _, dest_archive = image_file_paths(to_gallery_id, filename)
+        for src, dest in ((src_image, dest_image), (src_archive, dest_archive)):
+            if not os.path.exists(src):
+                continue  # No archived original for this image
+            if os.path.exists(dest):
+                print(f"Not moving {src}: {dest} already exists")
+                continue
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            try:
+                os.replace(src, dest)
+            except OSError as e:
+                print(f"Error moving {src} to gallery {to_gallery_id}: {e}")
+
+# Bulk image operations
+@app.post('/images/bulk')
+async def bulk_image_action(request: Request, background_tasks: BackgroundTasks):
+    """Apply one action to a selection of images in a single transaction.
+
+    Body: {"image_ids": [...], "action": "enable" | "disable" | "delete" | "move" | "set",
+    "gallery_id": <target gallery for move>, "fields": {<column>: <value> for set}}.
+    Deleted files go to the deletion queue in the same transaction; relocating
+    moved files runs as a background task after the commit.
+    """
+    body = await request.body()
+    try:
+        data = json.loads(body.decode())
+        image_ids = [int(i) for i in data.get('image_ids', [])]
+        action = data.get('action')
+    except:
+        return {"success": False, "error": "Invalid JSON"}
+    
+    if action not in ('enable', 'disable', 'delete', 'move', 'set'):
+        return {"success": False, "error": f"Unknown action: {action}"}
+    
+    result, moves = await run_db(apply_bulk_action, image_ids, action, data)
+    if moves:
+        background_tasks.add_task(_move_image_files, moves)
+    return result
+
+def apply_bulk_action(image_ids, action, data):
+    """Run one bulk action in a transaction; returns (response, file moves to perform)"""
+    conn = get_db()
+    cur = conn.cursor()
+    
+    images = cur.execute('SELECT id, gallery_id, filename FROM images WHERE id IN (SELECT value FROM json_each(?))',
+                         (json.dumps(image_ids),)).fetchall()
+    found_ids = [img['id'] for img in images]
+    selection = (json.dumps(found_ids),)
+    moves = []
+    
+    try:
+        if action in ('enable', 'disable'):
+            cur.execute('UPDATE images SET enabled=? WHERE id IN (SELECT value FROM json_each(?))',
+                        (1 if action == 'enable' else 0, *selection))
+        
+        elif action == 'set':
+            fields = {k: v for k, v in (data.get('fields') or {}).items() if k in BULK_EDITABLE_FIELDS}
+            if not fields:
+                conn.close()
+                return {"success": False, "error": "No editable fields given"}, []
+            assignments = ', '.join(f'{column}=?' for column in fields)
+            cur.execute(f'UPDATE images SET {assignments} WHERE id IN (SELECT value FROM json_each(?))',
+                        (*fields.values(), *selection))
+        
+        elif action == 'delete':
+            cur.execute('DELETE FROM images WHERE id IN (SELECT value FROM json_each(?))', selection)
+            cur.execute('UPDATE galleries SET featured_image_id=NULL WHERE featured_image_id IN (SELECT value FROM json_each(?))', selection)
+            trash_files(cur, [path for img in images for path in image_file_paths(img['gallery_id'], img['filename'])])
+        
+        elif action == 'move':
+            target_id = data.get('gallery_id')
+            target = cur.execute('SELECT * FROM galleries WHERE id=?', (target_id,)).fetchone()
+            if not target:
+                conn.close()
+                return {"success": False, "error": "Target gallery not found"}, []
+            to_move = [img for img in images if img['gallery_id'] != target['id']]
+            
+            # Files are relocated by name, so refuse rather than overwrite a
+            # same-named image in the target (or two moved images landing on one name)
+            names = [img['filename'] for img in to_move]
+            taken = {row['filename'] for row in cur.execute(
+                'SELECT filename FROM images WHERE gallery_id=? AND filename IN (SELECT value FROM json_each(?))',
+                (target['id'], json.dumps(names)))}
+            for name in names:
+                image_path, _, archive_path = image_file_paths(target['id'], name)
+                if names.count(name) > 1 or os.path.exists(image_path) or os.path.exists(archive_path):
+                    taken.add(name)
+            if taken:
+                conn.close()
+                return {"success": False, "error": f"Target gallery already has: {', '.join(sorted(taken))}"}, []
+            
+            # Append moved images after the target gallery's last image
+            max_sort = cur.execute('SELECT COALESCE(MAX(sort_order), ?) FROM images WHERE gallery_id=?', (-RANK_STEP, target['id'])).fetchone()[0]
+            cur.executemany('UPDATE images SET gallery_id=?, sort_order=? WHERE id=?',
+                            [(target['id'], max_sort + (index + 1) * RANK_STEP, img['id']) for index, img in enumerate(to_move)])
+            moved_selection = (json.dumps([img['id'] for img in to_move]),)
+            cur.execute('UPDATE galleries SET featured_image_id=NULL WHERE id != ? AND featured_image_id IN (SELECT value FROM json_each(?))',
+                        (target['id'], *moved_selection))
+            if to_move and not target['featured_image_id']:
+                cur.execute('UPDATE galleries SET featured_image_id=? WHERE id=?', (to_move[0]['id'], target['id']))
+            moves = [(img['gallery_id'], target['id'], img['filename']) for img in to_move]
+        
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        conn.close()
+        return {"success": False, "error": str(e)}, []
+    
+    conn.close()
+    
+    if action == 'delete':
+        forget_duplicate_images(found_ids)
+        wake_deletion_reaper()
+    
+    missing_ids = sorted(set(image_ids) - set(found_ids))
+    return {"success": True, "action": action, "affected": len(found_ids), "missing_ids": missing_ids}, moves
+
 # Settings page
 def get_setting(key: str, default=None):
     """Get a setting value from the database"""
@@ -1023,6 +2456,32 @@ def settings(request: Request, message: str = None):
         'settings': settings_data
     })
 
+def save_settings_form(form_data):
+    """Store every known setting from a submitted settings form"""
+    # Get current settings to know types
+    current_settings = get_all_settings()
+    
+    # Update each setting
+    for category_settings in current_settings.values():
+        for setting_key, setting_info in category_settings.items():
+            if setting_key in form_data:
+                setting_type = setting_info['type']
+                new_value = form_data[setting_key]
+                
+                # Handle boolean checkboxes (unchecked boxes don't appear in form data)
+                if setting_type == 'boolean':
+                    new_value = 'true'
+                
+                print(f"Updating {setting_key} = {new_value} (type: {setting_type})")
+                success = set_setting(setting_key, new_value, setting_type)
+                if not success:
+                    print(f"Failed to update setting: {setting_key}")
+                    
+            elif setting_info['type'] == 'boolean':
+                # Boolean setting not in form data means it was unchecked
+                print(f"Setting {setting_key} to false (unchecked)")
+                set_setting(setting_key, 'false', 'boolean')
+
 @app.post('/settings/update', response_class=HTMLResponse)
 async def update_settings(request: Request):
     """Update settings from form submission"""
@@ -1033,29 +2492,7 @@ async def update_settings(request: Request):
         
         print(f"Received form data: {form_data}")  # Debug output
         
-        # Get current settings to know types
-        current_settings = get_all_settings()
-        
-        # Update each setting
-        for category_settings in current_settings.values():
-            for setting_key, setting_info in category_settings.items():
-                if setting_key in form_data:
-                    setting_type = setting_info['type']
-                    new_value = form_data[setting_key]
-                    
-                    # Handle boolean checkboxes (unchecked boxes don't appear in form data)
-                    if setting_type == 'boolean':
-                        new_value = 'true'
-                    
-                    print(f"Updating {setting_key} = {new_value} (type: {setting_type})")
-                    success = set_setting(setting_key, new_value, setting_type)
-                    if not success:
-                        print(f"Failed to update setting: {setting_key}")
-                        
-                elif setting_info['type'] == 'boolean':
-                    # Boolean setting not in form data means it was unchecked
-                    print(f"Setting {setting_key} to false (unchecked)")
-                    set_setting(setting_key, 'false', 'boolean')
+        await run_db(save_settings_form, form_data)
         
         return RedirectResponse('/settings?message=Settings+updated+successfully', status_code=303)
         
@@ -1065,34 +2502,73 @@ async def update_settings(request: Request):
         traceback.print_exc()
         return RedirectResponse('/settings?error=Failed+to+update+settings', status_code=303)
 
+# The watermark preview box on the settings page (.preview-image img is capped at 400x300)
+SAMPLE_PREVIEW_SIZE = (400, 300)
+SAMPLE_IMAGE_COUNT = 3
+
+def sample_enabled_images(cur, count=SAMPLE_IMAGE_COUNT):
+    """Pick up to `count` distinct random enabled images without sorting the table.
+    
+    Each pick probes a random id between the smallest and largest enabled id
+    and takes the first enabled image not yet picked at or after it, a seek on
+    the (enabled, id) index. If the probes come up short (enabled images
+    bunched together, or a probe past the last one), the rest are filled in id
+    order, so the result only has fewer than `count` images when the library does.
+    """
+    low, high = cur.execute('SELECT MIN(id), MAX(id) FROM images WHERE enabled = 1').fetchone()
+    if low is None:
+        return []
+    query = '''
+        SELECT i.id, i.filename, i.gallery_id, i.width, i.height
+        FROM images i
+        WHERE i.enabled = 1 AND i.id >= ?
+          AND i.id NOT IN (SELECT value FROM json_each(?))
+          AND EXISTS (SELECT 1 FROM galleries g WHERE g.id = i.gallery_id)
+        ORDER BY i.id
+        LIMIT ?
+    '''
+    picked = {}
+    for _ in range(count * 2):
+        if len(picked) == count:
+            break
+        row = cur.execute(query, (random.randint(low, high), json.dumps(list(picked)), 1)).fetchone()
+        if row:
+            picked[row['id']] = row
+    if len(picked) < count:
+        for row in cur.execute(query, (low, json.dumps(list(picked)), count - len(picked))).fetchall():
+            picked[row['id']] = row
+    return list(picked.values())
+
+def preview_dimensions(width, height, box=SAMPLE_PREVIEW_SIZE):
+    """Size an image of width x height is displayed at in the preview box, via its thumbnail"""
+    if not width or not height:
+        return None, None
+    scale = min(THUMBNAIL_SIZE / width, THUMBNAIL_SIZE / height, 1)
+    width, height = width * scale, height * scale
+    scale = min(box[0] / width, box[1] / height, 1)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
 @app.get('/api/sample-images')
 def get_sample_images():
     """Get sample images from user's gallery for watermark preview"""
     try:
         conn = get_db()
-        cur = conn.cursor()
-        
-        # Get up to 3 random enabled images from all galleries
-        images = cur.execute('''
-            SELECT i.filename, g.id as gallery_id
-            FROM images i
-            JOIN galleries g ON i.gallery_id = g.id
-            WHERE i.enabled = 1
-            ORDER BY RANDOM()
-            LIMIT 3
-        ''').fetchall()
-        
+        images = sample_enabled_images(conn.cursor())
         conn.close()
         
         sample_images = []
         for img in images:
-            # Use thumbnail for preview (smaller file size)
+            # The thumbnail already covers the preview box, so never send the full image
             thumb_url = f'/static/thumbs/{img["filename"]}'
             full_url = f'/static/gallery_{img["gallery_id"]}/{img["filename"]}'
+            width, height = preview_dimensions(img['width'], img['height'])
             
             sample_images.append({
+                'id': img['id'],
                 'url': thumb_url,
                 'full_url': full_url,
+                'width': width,
+                'height': height,
                 'alt': f'Sample from gallery {img["gallery_id"]}'
             })
         
@@ -1103,25 +2579,382 @@ def get_sample_images():
         # Return empty list if no images found or error occurs
         return {"images": []}
 
+# Near-duplicate detection
+#
+# Each image has a 64-bit difference hash (see image_dhash). The hashes live in
+# an in-memory multi-index hash table: the 64 bits are split into
+# DUPLICATE_HASH_CHUNKS chunks of 16, each with its own dict. Two hashes that
+# differ in at most DUPLICATE_MAX_DISTANCE (6) bits differ in at most one bit
+# of some chunk, so a lookup probes each chunk's value and its 16 one-bit
+# neighbours and only compares against the few images found there, never
+# against every image. Clusters are kept up to date as hashes are added (each
+# new image is one lookup plus a merge), which makes listing them proportional
+# to the number of duplicates, not the library size.
+DUPLICATE_MAX_DISTANCE = 6
+DUPLICATE_HASH_CHUNKS = 4
+HASH_BITS = 64
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+class MultiIndexHashTable:
+    """Integer hashes indexed by each of their chunks, for Hamming-radius lookups up to max_distance"""
+
+    def __init__(self, max_distance=DUPLICATE_MAX_DISTANCE, chunks=DUPLICATE_HASH_CHUNKS, bits=HASH_BITS):
+        self.max_distance = max_distance
+        self.chunk_bits = bits // chunks
+        self.mask = (1 << self.chunk_bits) - 1
+        self.shifts = [i * self.chunk_bits for i in range(chunks)]
+        self.tables = [{} for _ in self.shifts]
+        # Pigeonhole: some chunk of a match differs in at most max_distance // chunks
+        # bits, so lookups probe every chunk value within that many bit flips
+        flips = [0]
+        for _ in range(max_distance // chunks):
+            flips = sorted({f | 1 << bit for f in flips for bit in range(self.chunk_bits)} | set(flips))
+        self.flips = flips
+
+    def add(self, value, item):
+        entry = (value, item)
+        for shift, table in zip(self.shifts, self.tables):
+            table.setdefault((value >> shift) & self.mask, []).append(entry)
+    
+    def remove(self, value, item):
+        entry = (value, item)
+        for shift, table in zip(self.shifts, self.tables):
+            bucket = table.get((value >> shift) & self.mask)
+            if bucket and entry in bucket:
+                bucket.remove(entry)
+
+    def search(self, value, radius=None):
+        """Return the items whose hash is within `radius` (at most max_distance) bits of value"""
+        radius = self.max_distance if radius is None else min(radius, self.max_distance)
+        candidates = []
+        for shift, table in zip(self.shifts, self.tables):
+            chunk = (value >> shift) & self.mask
+            for flip in self.flips:
+                bucket = table.get(chunk ^ flip)
+                if bucket:
+                    candidates.extend(bucket)
+        return list({item for other, item in candidates if bin(value ^ other).count('1') <= radius})
+
+class DuplicateIndex:
+    """Multi-index hash table of image hashes plus the near-duplicate clusters found so far"""
+
+    def __init__(self):
+        self.table = MultiIndexHashTable()
+        self.hashes = {}       # image id -> hash
+        self.max_id = 0
+        self.count = 0
+        self.cluster_of = {}   # image id -> cluster key, for images with duplicates
+        self.clusters = {}     # cluster key -> set of image ids
+
+    def add(self, image_id, value):
+        neighbours = self.table.search(value)
+        self.table.add(value, image_id)
+        self.hashes[image_id] = value
+        self.count += 1
+        self.max_id = max(self.max_id, image_id)
+        if not neighbours:
+            return
+        # Merge the new image and every cluster it touches into the largest one
+        keys = {self.cluster_of.get(other, other) for other in neighbours}
+        key = max(keys, key=lambda k: len(self.clusters.get(k, ())))
+        members = self.clusters.setdefault(key, {key})
+        for other_key in keys - {key}:
+            members |= self.clusters.pop(other_key, {other_key})
+        members.add(image_id)
+        for member in members:
+            self.cluster_of[member] = key
+
+    def remove(self, image_id):
+        """Forget a deleted image and re-split its cluster among the images that remain"""
+        value = self.hashes.pop(image_id, None)
+        if value is None:
+            return
+        self.table.remove(value, image_id)
+        self.count -= 1
+        key = self.cluster_of.pop(image_id, None)
+        if key is None:
+            return
+        members = self.clusters.pop(key)
+        members.discard(image_id)
+        # The deleted image may have been the only link between parts of the
+        # cluster, so regroup the survivors by their links to each other
+        for member in members:
+            del self.cluster_of[member]
+        while members:
+            group = set()
+            pending = [members.pop()]
+            while pending:
+                member = pending.pop()
+                group.add(member)
+                linked = [other for other in self.table.search(self.hashes[member]) if other in members]
+                members.difference_update(linked)
+                pending.extend(linked)
+            if len(group) > 1:
+                key = min(group)
+                self.clusters[key] = group
+                for member in group:
+                    self.cluster_of[member] = key
+    
+    def catch_up(self, cur):
+        """Add images inserted since the index last looked (ids only grow)"""
+        rows = cur.execute('SELECT id, phash FROM images WHERE id > ? AND phash IS NOT NULL ORDER BY id',
+                           (self.max_id,)).fetchall()
+        for row in rows:
+            self.add(row['id'], int(row['phash'], 16))
+        return len(rows)
+
+_duplicate_index = None
+_duplicate_index_lock = threading.Lock()
+
+def get_duplicate_index(cur):
+    """Return the up-to-date duplicate index, building it on first use"""
+    global _duplicate_index
+    with _duplicate_index_lock:
+        if _duplicate_index is None:
+            _duplicate_index = DuplicateIndex()
+        _duplicate_index.catch_up(cur)
+        return _duplicate_index
+
+def forget_duplicate_images(image_ids):
+    """Drop deleted images from the duplicate index, if it has been built"""
+    with _duplicate_index_lock:
+        if _duplicate_index is not None:
+            for image_id in image_ids:
+                _duplicate_index.remove(image_id)
+
+def invalidate_duplicate_index():
+    """Drop the index so it is rebuilt, e.g. after hashes were backfilled onto old ids"""
+    global _duplicate_index
+    with _duplicate_index_lock:
+        _duplicate_index = None
+
+@app.get('/api/duplicates')
+def list_duplicate_clusters():
+    """List clusters of near-duplicate images (burst shots, re-edits, re-uploads) across all galleries"""
+    conn = get_db()
+    cur = conn.cursor()
+    index = get_duplicate_index(cur)
+    with _duplicate_index_lock:
+        clusters = [sorted(members) for members in index.clusters.values()]
+    
+    # Deletions are applied to the index as they happen; this only guards
+    # against rows removed behind the application's back
+    member_ids = [image_id for members in clusters for image_id in members]
+    images = {row['id']: row for row in cur.execute('''
+        SELECT id, gallery_id, filename, title, phash FROM images
+        WHERE id IN (SELECT value FROM json_each(?))''', (json.dumps(member_ids),))}
+    conn.close()
+    
+    result = []
+    for members in clusters:
+        rows = [images[image_id] for image_id in members if image_id in images]
+        if len(rows) < 2:
+            continue
+        first = int(rows[0]['phash'], 16)
+        result.append({
+            'size': len(rows),
+            'max_distance': max(hamming_distance(first, int(row['phash'], 16)) for row in rows),
+            'images': [{'id': row['id'], 'gallery_id': row['gallery_id'], 'filename': row['filename'],
+                        'title': row['title'], 'thumbnail': f'/static/thumbs/{row["filename"]}'} for row in rows]
+        })
+    result.sort(key=lambda cluster: -cluster['size'])
+    return {'clusters': result, 'indexed': index.count, 'threshold': DUPLICATE_MAX_DISTANCE}
+
+COLOR_SEARCH_DISTANCE = 60
+COLOR_SEARCH_LIMIT = 50
+
+@app.get('/api/images/near-color')
+def images_near_color(color: str, distance: int = COLOR_SEARCH_DISTANCE, limit: int = COLOR_SEARCH_LIMIT,
+                      gallery_id: int = None):
+    """Find images with a palette swatch within `distance` (RGB Euclidean) of a colour, closest first"""
+    target = parse_hex_color(color)
+    if target is None:
+        return {"success": False, "error": "color must be a hex colour like #3366cc"}
+    distance = max(0, min(distance, 442))
+    
+    # Only the grid cells that overlap the cube around the colour can hold matches
+    shift = 8 - COLOR_BIN_BITS
+    ranges = [range(max(0, c - distance) >> shift, (min(255, c + distance) >> shift) + 1) for c in target]
+    bins = [(r << (2 * COLOR_BIN_BITS)) | (g << COLOR_BIN_BITS) | b
+            for r in ranges[0] for g in ranges[1] for b in ranges[2]]
+    
+    conn = get_db()
+    rows = conn.execute('''
+        SELECT i.id, i.gallery_id, i.filename, i.title, c.r, c.g, c.b, c.weight,
+               MIN((c.r - :r) * (c.r - :r) + (c.g - :g) * (c.g - :g) + (c.b - :b) * (c.b - :b)) AS distance_sq
+        FROM image_colors c
+        JOIN images i ON i.id = c.image_id
+        WHERE c.color_bin IN (SELECT value FROM json_each(:bins))
+          AND (:gallery_id IS NULL OR i.gallery_id = :gallery_id)
+        GROUP BY c.image_id
+        HAVING distance_sq <= :distance_sq
+        ORDER BY distance_sq, c.weight DESC
+        LIMIT :limit
+    ''', {'r': target[0], 'g': target[1], 'b': target[2], 'bins': json.dumps(bins), 'gallery_id': gallery_id,
+          'distance_sq': distance * distance, 'limit': max(1, limit)}).fetchall()
+    conn.close()
+    
+    return {"success": True, "color": '#%02x%02x%02x' % target, "images": [{
+        'id': row['id'], 'gallery_id': row['gallery_id'], 'filename': row['filename'], 'title': row['title'],
+        'thumbnail': f'/static/thumbs/{row["filename"]}',
+        'swatch': '#%02x%02x%02x' % (row['r'], row['g'], row['b']), 'weight': row['weight'],
+        'distance': round(row['distance_sq'] ** 0.5, 1)
+    } for row in rows]}
+
+# Watermark previews: the real watermark rendered onto an image's thumbnail,
+# cached per thumbnail file and watermark config so slider changes only ever
+# render small images, and repeated settings re-use earlier renders
+WATERMARK_PREVIEW_CACHE_DIR = os.path.join(CACHE_DIR, 'watermark_previews')
+WATERMARK_PREVIEW_KEYS = ('text', 'font_family', 'font_size', 'opacity', 'position_vertical', 'position_horizontal')
+WATERMARK_FONT_SIZE_RANGE = (8, 72)  # what the settings page accepts
+
+def watermark_config_hash(config, source=''):
+    """Short hash of the settings that change how a watermark looks, plus an identifier of the image drawn on"""
+    key = json.dumps({name: str(config.get(name, '')) for name in WATERMARK_PREVIEW_KEYS}, sort_keys=True)
+    return hashlib.sha256((key + source).encode()).hexdigest()[:16]
+
+def render_watermark_preview(image_id, watermark_config):
+    """Return the cached preview path for an image and config, rendering it first if needed; None without a thumbnail"""
+    conn = get_db()
+    cur = conn.cursor()
+    image = cur.execute('SELECT gallery_id, filename, width, height FROM images WHERE id=?', (image_id,)).fetchone()
+    if not image:
+        conn.close()
+        return None
+    
+    _, thumb_path, _ = image_file_paths(image['gallery_id'], image['filename'])
+    try:
+        thumb_stat = os.stat(thumb_path)
+    except OSError:
+        conn.close()
+        return None
+    # Key on the thumbnail file itself, not just the id, so a replaced image
+    # (or a new one reusing the id after a reset) never gets an old preview
+    source = f"{image['filename']}:{thumb_stat.st_size}:{thumb_stat.st_mtime_ns}"
+    preview_path = os.path.join(WATERMARK_PREVIEW_CACHE_DIR,
+                                f'{image_id}_{watermark_config_hash(watermark_config, source)}.jpg')
+    if os.path.exists(preview_path):
+        touch_cache_file(cur, preview_path)
+        conn.commit()
+        conn.close()
+        return preview_path
+    
+    from PIL import Image
+    try:
+        with Image.open(thumb_path) as thumb:
+            # Draw at the thumbnail's scale so it looks like the full-size export
+            scale = max(thumb.size) / max(image['width'], image['height']) if image['width'] else 1.0
+            preview = draw_watermark(thumb, watermark_config, scale=min(scale, 1.0))
+    except OSError:
+        conn.close()
+        return None
+    
+    os.makedirs(WATERMARK_PREVIEW_CACHE_DIR, exist_ok=True)
+    tmp_path = f'{preview_path}.{threading.get_ident()}.tmp'
+    preview.save(tmp_path, 'JPEG', quality=85)
+    os.replace(tmp_path, preview_path)
+    record_cache_file(cur, 'watermark_preview', preview_path, os.path.getsize(preview_path))
+    conn.commit()
+    conn.close()
+    return preview_path
+
+@app.get('/api/watermark-preview/{image_id}')
+def watermark_preview(image_id: int, text: str = None, font_family: str = None, font_size: int = None,
+                      opacity: int = None, position_vertical: str = None, position_horizontal: str = None):
+    """Preview the watermark exactly as exports draw it, on the image's thumbnail.
+    
+    Query parameters override the saved watermark settings, so the settings
+    page can preview changes before they are saved.
+    """
+    watermark_config = get_watermark_config()
+    if font_size is not None:
+        font_size = min(max(font_size, WATERMARK_FONT_SIZE_RANGE[0]), WATERMARK_FONT_SIZE_RANGE[1])
+    if opacity is not None:
+        opacity = min(max(opacity, 0), 100)
+    overrides = {'text': text, 'font_family': font_family, 'font_size': font_size, 'opacity': opacity,
+                 'position_vertical': position_vertical, 'position_horizontal': position_horizontal}
+    watermark_config.update({name: str(value) for name, value in overrides.items() if value is not None})
+    
+    preview_path = render_watermark_preview(image_id, watermark_config)
+    if preview_path is None:
+        return PlainTextResponse('Image not found', status_code=404)
+    return FileResponse(preview_path, media_type='image/jpeg')
+
+@app.get('/api/storage')
+def storage_usage():
+    """Report tracked storage usage per category and per gallery"""
+    conn = get_db()
+    cur = conn.cursor()
+    usage = get_storage_usage(cur)
+    usage['galleries'] = {row['gallery_id']: row['bytes'] for row in cur.execute('''
+        SELECT gallery_id, COALESCE(SUM(file_size), 0) + COALESCE(SUM(thumb_size), 0) + COALESCE(SUM(archive_size), 0) AS bytes 
+        FROM images GROUP BY gallery_id''')}
+    conn.close()
+    usage['threshold_bytes'] = get_setting('storage_cleanup_threshold_gb', 0) * 1024 ** 3
+    return usage
+
+@app.post('/api/storage/enforce')
+def run_storage_limits():
+    """Apply retention and size limits now instead of waiting for the janitor"""
+    return enforce_storage_limits()
+
+@app.get('/metrics', response_class=PlainTextResponse)
+def metrics_endpoint():
+    """Per-route latency, response size and SQLite query metrics in Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+@app.get('/api/maintenance/deletions')
+def deletion_backlog():
+    """Report the background file deletion backlog"""
+    return get_deletion_backlog()
+
 # Reset database and static/gallery folders
 @app.post('/settings/reset', response_class=HTMLResponse)
 def reset_database(request: Request):
-    # Remove DB file
-    if os.path.exists(DB_PATH):
-        os.remove(DB_PATH)
-    # Remove all gallery folders
-    static_dir = 'static'
-    for name in os.listdir(static_dir):
-        path = os.path.join(static_dir, name)
-        if name.startswith('gallery_') and os.path.isdir(path):
-            shutil.rmtree(path)
-    # Remove all thumbs
-    thumbs_dir = os.path.join(static_dir, 'thumbs')
-    if os.path.isdir(thumbs_dir):
-        for f in os.listdir(thumbs_dir):
-            os.remove(os.path.join(thumbs_dir, f))
-    # Recreate DB tables
-    startup()
+    global _database_generation
+    with _deletion_lock:
+        # Carry over deletions still queued in the old database. Only trash
+        # paths survive: live paths from before the trash existed may be
+        # reused by the new database, so those are moved into the trash now.
+        trash_paths = []
+        if os.path.exists(DB_PATH):
+            try:
+                conn = get_db()
+                queued = [row['path'] for row in conn.execute('SELECT path FROM pending_deletions')]
+                conn.close()
+            except sqlite3.Error:
+                queued = []
+            for path in queued:
+                if path.startswith(TRASH_DIR + os.sep):
+                    trash_paths.append(path)
+                elif os.path.exists(path):
+                    trash_paths.append(move_to_trash(path))
+            # Remove DB file
+            os.remove(DB_PATH)
+            _database_generation += 1
+        # Move gallery folders, thumbs and archived originals out of the way; the reaper deletes them later
+        static_dir = 'static'
+        for name in os.listdir(static_dir):
+            path = os.path.join(static_dir, name)
+            if (name.startswith('gallery_') or name == 'thumbs') and os.path.isdir(path):
+                trash_paths.append(move_to_trash(path))
+        if os.path.isdir(ORIGINALS_ARCHIVE_DIR):
+            trash_paths.append(move_to_trash(ORIGINALS_ARCHIVE_DIR))
+        # Caches named by image or site id would otherwise be served for the new database's rows
+        for cache_dir in (WATERMARK_PREVIEW_CACHE_DIR, DELTA_CACHE_DIR):
+            if os.path.isdir(cache_dir):
+                trash_paths.append(move_to_trash(cache_dir))
+        # Recreate DB tables
+        startup()
+        # Image ids restart at 1 in the new database
+        invalidate_duplicate_index()
+        conn = get_db()
+        queue_file_deletions(conn.cursor(), trash_paths)
+        conn.commit()
+        conn.close()
+    wake_deletion_reaper()
     return RedirectResponse('/settings?message=Database+reset+successfully', status_code=303)
 
 # Static Site Generation Routes
@@ -1164,119 +2997,633 @@ def generate_page(request: Request):
     return templates.TemplateResponse('generate.html', {
         'request': request,
         'galleries': galleries_with_info,
-        'themes': themes
+        'themes': themes,
+        'page_size': get_setting('gallery_page_size', 0),
+        'deploy_directory': get_setting('deploy_directory', '')
     })
 
-@app.post('/generate/static')
-def generate_static_site(
-    site_title: str = Form("My Photo Gallery"),
-    site_description: str = Form(""),
-    theme: str = Form("minimal"),
-    gallery_ids: List[str] = Form([])
-):
-    """Generate static site with selected galleries and theme"""
-    try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        # Get selected galleries with their images
-        galleries = []
-        for gallery_id in gallery_ids:
-            gallery = c.execute('SELECT * FROM galleries WHERE id=?', (gallery_id,)).fetchone()
-            if gallery:
-                images = c.execute('''
-                    SELECT * FROM images 
-                    WHERE gallery_id=? AND enabled=1 
-                    ORDER BY sort_order ASC
-                ''', (gallery_id,)).fetchall()
-                
-                galleries.append({
-                    'id': gallery['id'],
-                    'title': gallery['title'],
-                    'description': gallery['description'],
-                    'images': [dict(img) for img in images]
-                })
-        
-        conn.close()
-        
-        if not galleries:
-            return RedirectResponse('/generate?error=No+galleries+selected', status_code=303)
-        
-        # Create temporary directory for static site
-        temp_dir = tempfile.mkdtemp(prefix='static_site_')
+def gallery_page_url(gallery_id, page):
+    """File name of one page of a gallery in a multi-page site"""
+    return f'gallery-{gallery_id}.html' if page == 1 else f'gallery-{gallery_id}-{page}.html'
+
+def plan_site_pages(galleries, page_size):
+    """Return (filename, template context) for every page of the generated site.
+
+    With page_size <= 0 the whole site is a single index.html, as before.
+    Otherwise index.html is a landing page showing one cover image per gallery
+    (with `url`, `image_count` and `page_count` set on each gallery), and each
+    gallery gets pages of page_size images carrying a `pagination` context.
+    """
+    if page_size <= 0:
+        return [('index.html', {'galleries': galleries})]
+    
+    pages = []
+    landing_galleries = []
+    for gallery in galleries:
+        images = gallery['images']
+        page_count = max(1, -(-len(images) // page_size))
+        cover = next((img for img in images if img['id'] == gallery.get('featured_image_id')), images[0] if images else None)
+        landing_galleries.append(dict(gallery,
+                                      images=[cover] if cover else [],
+                                      url=gallery_page_url(gallery['id'], 1),
+                                      image_count=len(images),
+                                      page_count=page_count))
         
-        try:
-            # Create directory structure
-            images_dir = os.path.join(temp_dir, 'images')
-            os.makedirs(images_dir, exist_ok=True)
-            
-            # Get watermark configuration
+        for page in range(1, page_count + 1):
+            pagination = {
+                'page': page,
+                'page_count': page_count,
+                'page_size': page_size,
+                'home_url': 'index.html',
+                'prev_url': gallery_page_url(gallery['id'], page - 1) if page > 1 else None,
+                'next_url': gallery_page_url(gallery['id'], page + 1) if page < page_count else None,
+                'pages': [{'number': n, 'url': gallery_page_url(gallery['id'], n), 'current': n == page}
+                          for n in range(1, page_count + 1)]
+            }
+            page_images = images[(page - 1) * page_size:page * page_size]
+            pages.append((gallery_page_url(gallery['id'], page),
+                          {'galleries': [dict(gallery, images=page_images)], 'pagination': pagination}))
+    
+    pages.insert(0, ('index.html', {'galleries': landing_galleries}))
+    return pages
+
+# Generated sites keep extracted theme CSS/JS here, named by content hash
+SITE_ASSETS_DIR = 'assets'
+
+_STRING_LITERAL = re.compile(r"""("(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')""")
+_PROTECTED_HTML = re.compile(r'<(pre|textarea|script|style)\b.*?</\1\s*>', re.S | re.I)
+_INLINE_STYLE = re.compile(r'<style>(.*?)</style>', re.S | re.I)
+_INLINE_SCRIPT = re.compile(r'<script>(.*?)</script>', re.S | re.I)
+
+def _outside_strings(text, transform):
+    """Apply transform to everything except quoted string literals"""
+    parts = _STRING_LITERAL.split(text)
+    return ''.join(part if i % 2 else transform(part) for i, part in enumerate(parts))
+
+def minify_css(css):
+    """Drop comments and insignificant whitespace from a stylesheet"""
+    def squeeze(segment):
+        segment = re.sub(r'\s+', ' ', segment)
+        segment = re.sub(r'\s*([{};,>])\s*', r'\1', segment)
+        segment = re.sub(r':\s+', ':', segment)
+        return segment.replace(';}', '}')
+    return _outside_strings(re.sub(r'/\*.*?\*/', '', css, flags=re.S), squeeze).strip()
+
+# A '/' after one of these (or at the start) begins a regex literal, not a division
+_JS_REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%<>~^')
+_JS_REGEX_KEYWORDS = {'return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'new', 'delete', 'void',
+                      'throw', 'instanceof', 'yield', 'await'}
+
+def _js_line_states(js):
+    """Split a script into lines, each with the lexical state at its start and at its end.
+    
+    States are 'code', 'comment' (a /* */ block), 'line_comment', or 'literal'
+    (inside a string, regex or template literal, where whitespace is content).
+    Template literals may nest through ${...}; a '/' counts as a regex after
+    an operator, an opening bracket or a keyword like `return`.
+    """
+    lines = []
+    state = 'code'
+    quote = None
+    in_class = False
+    templates = []  # brace depth at which each open ${ returns to its template
+    depth = 0
+    prev = ''  # last significant code character, or the last identifier
+    continued = False  # a string's backslash-newline line continuation
+    line_start, start_state = 0, 'code'
+    i, n = 0, len(js)
+    while i < n:
+        ch = js[i]
+        if ch == '\n':
+            if state == 'line_comment':
+                state = 'code'
+                end_state = 'line_comment'
+            else:
+                if state == 'literal' and quote != '`' and not continued:
+                    state = 'code'  # Unterminated string or regex: give up on it
+                end_state = state
+                continued = False
+            lines.append((js[line_start:i], start_state, end_state))
+            line_start, start_state = i + 1, state
+            i += 1
+            continue
+        if state == 'line_comment':
+            pass
+        elif state == 'comment':
+            if js.startswith('*/', i):
+                state = 'code'
+                i += 1
+        elif state == 'literal':
+            if ch == '\\':
+                if js.startswith('\n', i + 1):
+                    continued = True
+                else:
+                    i += 1
+            elif quote == '/':
+                if ch == '[':
+                    in_class = True
+                elif ch == ']':
+                    in_class = False
+                elif ch == '/' and not in_class:
+                    state, prev = 'code', 'a'
+            elif quote == '`' and js.startswith('${', i):
+                templates.append(depth)
+                state, prev = 'code', '{'
+                i += 1
+            elif ch == quote:
+                state, prev = 'code', 'a'
+        elif js.startswith('//', i):
+            state = 'line_comment'
+        elif js.startswith('/*', i):
+            state = 'comment'
+            i += 1
+        elif ch in '\'"`' or (ch == '/' and (not prev or prev in _JS_REGEX_PRECEDERS or prev in _JS_REGEX_KEYWORDS)):
+            state, quote, in_class = 'literal', ch, False
+        elif ch == '}' and templates and depth == templates[-1]:
+            templates.pop()
+            state, quote = 'literal', '`'
+        elif not ch.isspace():
+            if ch == '{':
+                depth += 1
+            elif ch == '}':
+                depth -= 1
+            if ch.isalnum() or ch in '_$':
+                prev = prev + ch if prev and (prev[-1].isalnum() or prev[-1] in '_$') else ch
+            else:
+                prev = ch
+        i += 1
+    lines.append((js[line_start:], start_state, state))
+    return lines
+
+def minify_js(js):
+    """Conservatively minify a script: strip indentation, blank lines and whole-line comments.
+    
+    Line breaks are kept so automatic semicolon insertion behaves exactly as
+    before, and nothing inside string, regex or template literals is touched.
+    """
+    out = []
+    for line, start, end in _js_line_states(js):
+        if start != 'literal':
+            line = line.lstrip()
+        if end != 'literal':
+            line = line.rstrip()
+        if start == 'code' and end != 'literal' and (not line or line.startswith('//')):
+            continue
+        out.append(line)
+    return '\n'.join(out)
+
+def _squeeze_html(fragment):
+    fragment = re.sub(r'<!--(?!\[if).*?-->', '', fragment, flags=re.S)
+    return re.sub(r'[ \t\r\f\v]*\n\s*', '\n', fragment)
+
+def minify_html(html):
+    """Drop comments and indentation outside <pre>, <textarea>, <script> and <style>"""
+    out, pos = [], 0
+    for match in _PROTECTED_HTML.finditer(html):
+        out.append(_squeeze_html(html[pos:match.start()]))
+        out.append(match.group(0))
+        pos = match.end()
+    out.append(_squeeze_html(html[pos:]))
+    return ''.join(out).strip() + '\n'
+
+def write_site_asset(output_dir, content, extension):
+    """Write content to assets/<hash>.<extension> unless already present; returns its relative URL"""
+    name = f'{hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]}.{extension}'
+    path = os.path.join(output_dir, SITE_ASSETS_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Pages are rendered concurrently and may share an asset, so write atomically
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    return f'{SITE_ASSETS_DIR}/{name}'
+
+def optimize_page_html(html, output_dir):
+    """Move inline <style>/<script> blocks into hashed asset files and minify what remains.
+
+    Identical blocks on different pages (or in different builds) map to the same
+    file, so browsers cache theme CSS/JS across pages and redeploys.
+    """
+    def extract_style(match):
+        css = minify_css(match.group(1))
+        return f'<link rel="stylesheet" href="{write_site_asset(output_dir, css, "css")}">' if css else ''
+    
+    def extract_script(match):
+        js = minify_js(match.group(1))
+        return f'<script src="{write_site_asset(output_dir, js, "js")}"></script>' if js else ''
+    
+    html = _INLINE_STYLE.sub(extract_style, html)
+    html = _INLINE_SCRIPT.sub(extract_script, html)
+    return minify_html(html)
+
+def render_site_pages(template, pages, output_dir, common_context, workers=None, optimize=False):
+    """Render and write every planned page, several at a time; returns the file names written"""
+    def render_page(page):
+        filename, context = page
+        html = template.render(**common_context, **context)
+        if optimize:
+            html = optimize_page_html(html, output_dir)
+        with open(os.path.join(output_dir, filename), 'w', encoding='utf-8') as f:
+            f.write(html)
+        return filename
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(render_page, pages))
+
+# Compressed copies of generated text files, named by the content hash of the
+# source so unchanged files are never recompressed from one build to the next
+PRECOMPRESS_CACHE_DIR = os.path.join(CACHE_DIR, 'precompressed')
+PRECOMPRESS_EXTENSIONS = ('.html', '.css', '.js', '.json')
+
+def precompress_encodings():
+    """Return {sibling suffix: compress function} for the encodings available here"""
+    import gzip
+    encodings = {'.gz': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+        encodings['.br'] = lambda data: brotli.compress(data, quality=11)
+    except ImportError:
+        pass
+    return encodings
+
+def link_or_copy(src, dest):
+    """Hardlink src to dest when the filesystem allows it, otherwise copy; dest is replaced atomically"""
+    tmp_path = f'{dest}.{threading.get_ident()}.tmp'
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dest)
+
+def precompress_site_files(output_dir, workers=None):
+    """Write .gz/.br siblings next to every HTML, CSS, JS and JSON file of a site.
+
+    Files are compressed in parallel. Compressed output is cached by content
+    hash (and tracked in derivative_cache), so only new or changed files are
+    compressed; siblings that would not be smaller are skipped. Returns file
+    counts and the bytes of siblings written.
+    """
+    paths = [os.path.join(root, name) for root, _, files in os.walk(output_dir)
+             for name in files if name.endswith(PRECOMPRESS_EXTENSIONS)]
+    encodings = precompress_encodings()
+    os.makedirs(PRECOMPRESS_CACHE_DIR, exist_ok=True)
+    
+    def compress(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        written, reused, sibling_bytes = [], [], 0
+        for suffix, compress_data in encodings.items():
+            cached_path = os.path.join(PRECOMPRESS_CACHE_DIR, digest + suffix)
             try:
-                watermark_config = get_watermark_config()
-                if watermark_config is None:
-                    watermark_config = get_default_watermark_config()
-                    
-                watermark_enabled = watermark_config.get('enabled', 'false').lower() == 'true'
-                print(f"Watermark config loaded: enabled={watermark_enabled}, text={watermark_config.get('text', 'N/A')}")
-            except Exception as e:
-                print(f"Error loading watermark config: {e}")
-                watermark_config = get_default_watermark_config()
-                watermark_enabled = False
+                size = os.path.getsize(cached_path)
+                if size < len(data):
+                    link_or_copy(cached_path, path + suffix)
+                    sibling_bytes += size
+                reused.append(cached_path)
+                continue
+            except FileNotFoundError:
+                pass  # Not cached yet, or evicted by the janitor a moment ago
+            compressed = compress_data(data)
+            tmp_path = f'{cached_path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(compressed)
+            # Link the sibling before publishing into the cache, where it could be evicted
+            if len(compressed) < len(data):
+                link_or_copy(tmp_path, path + suffix)
+                sibling_bytes += len(compressed)
+            os.replace(tmp_path, cached_path)
+            written.append((cached_path, len(compressed)))
+        return written, reused, sibling_bytes
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(compress, paths))
+    
+    written = [entry for entries, _, _ in results for entry in entries]
+    reused = [path for _, paths_reused, _ in results for path in paths_reused]
+    conn = get_db()
+    cur = conn.cursor()
+    for cached_path, size in written:
+        record_cache_file(cur, 'precompressed', cached_path, size)
+    for cached_path in reused:
+        touch_cache_file(cur, cached_path)
+    conn.commit()
+    conn.close()
+    return {'files': len(paths), 'compressed': len(written), 'reused': len(reused),
+            'bytes': sum(sibling_bytes for _, _, sibling_bytes in results)}
+
+# Deploy-directory output keeps a persistent copy of the site with a manifest of
+# path -> sha256/size, so a rebuild only touches files that actually changed and
+# deployment can sync just the listed deltas
+SITE_MANIFEST_NAME = '.site-manifest.json'
+SITE_CHANGES_NAME = '.site-changes.json'
+
+def hash_file(path):
+    """sha256 hex digest of a file, read in 1 MB chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def build_site_manifest(site_dir, previous=None):
+    """Return {relative path: {'sha256', 'size', 'mtime_ns'}} for every file in a site.
+
+    Files whose size and mtime match an entry of `previous` reuse its hash, so
+    linked or copy2'd originals that did not change are not read again.
+    """
+    previous = previous or {}
+    manifest = {}
+    for root, _, files in os.walk(site_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, site_dir).replace(os.sep, '/')
+            if relpath in (SITE_MANIFEST_NAME, SITE_CHANGES_NAME):
+                continue
+            stat = os.stat(path)
+            old = previous.get(relpath)
+            if old and old['size'] == stat.st_size and old.get('mtime_ns') == stat.st_mtime_ns:
+                file_hash = old['sha256']
+            else:
+                file_hash = hash_file(path)
+            manifest[relpath] = {'sha256': file_hash, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    return manifest
+
+def load_site_manifest(target_dir):
+    """Read a deploy directory's manifest; {} when there is none yet"""
+    try:
+        with open(os.path.join(target_dir, SITE_MANIFEST_NAME)) as f:
+            return json.load(f)['files']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+def _write_json_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def sync_site_directory(build_dir, target_dir):
+    """Mirror a freshly built site into target_dir, touching only what changed.
+
+    Unchanged files are left alone, new and changed files are hardlinked from
+    the build where possible (copied otherwise) and files that are no longer
+    part of the site are deleted. Only files listed in the previous manifest
+    are ever removed. The change list is returned and also written to
+    .site-changes.json next to the manifest.
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    target_root = os.path.realpath(target_dir)
+    old_manifest = load_site_manifest(target_dir)
+    new_manifest = build_site_manifest(build_dir, old_manifest)
+    changes = {'added': [], 'changed': [], 'removed': [], 'unchanged': 0}
+    
+    for relpath, entry in sorted(new_manifest.items()):
+        dest = os.path.join(target_dir, relpath)
+        old = old_manifest.get(relpath)
+        if old and old['sha256'] == entry['sha256'] and os.path.exists(dest):
+            changes['unchanged'] += 1
+            continue
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        link_or_copy(os.path.join(build_dir, relpath), dest)
+        changes['changed' if old else 'added'].append(relpath)
+    
+    for relpath in sorted(set(old_manifest) - set(new_manifest)):
+        dest = os.path.realpath(os.path.join(target_dir, relpath))
+        if not dest.startswith(target_root + os.sep):
+            continue
+        try:
+            os.remove(dest)
+        except FileNotFoundError:
+            pass
+        changes['removed'].append(relpath)
+        # Prune directories left empty, up to the target itself
+        parent = os.path.dirname(dest)
+        while parent != target_root and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+    
+    _write_json_atomic(os.path.join(target_dir, SITE_MANIFEST_NAME),
+                       {'generated_at': datetime.now().isoformat(), 'files': new_manifest})
+    _write_json_atomic(os.path.join(target_dir, SITE_CHANGES_NAME), changes)
+    return changes
+
+# Slowest image copies kept in a build's profile
+BUILD_PROFILE_SLOWEST_IMAGES = 10
+
+class StageTimer:
+    """Accumulate wall-clock seconds, and bytes produced, per named build stage"""
+    
+    def __init__(self):
+        self.timings = {}
+        self.bytes = {}
+    
+    @contextmanager
+    def stage(self, name):
+        """Time a stage; its bytes are reported by the stage itself with add_bytes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.perf_counter() - start
+    
+    def add_bytes(self, name, count):
+        self.bytes[name] = self.bytes.get(name, 0) + count
+    
+    def profile(self, slowest_images=()):
+        """JSON-ready summary stored with the build and shown on the results page"""
+        return {
+            'total_seconds': round(sum(self.timings.values()), 4),
+            'stages': [{'name': name, 'seconds': round(seconds, 4), 'bytes': self.bytes.get(name)}
+                       for name, seconds in self.timings.items()],
+            'slowest_images': list(slowest_images)
+        }
+
+def load_site_galleries(gallery_ids):
+    """Load the selected galleries with their enabled images, in the given order"""
+    conn = get_db()
+    c = conn.cursor()
+    galleries = []
+    for gallery_id in gallery_ids:
+        gallery = c.execute('SELECT * FROM galleries WHERE id=?', (gallery_id,)).fetchone()
+        if gallery:
+            images = c.execute('''
+                SELECT * FROM images 
+                WHERE gallery_id=? AND enabled=1 
+                ORDER BY sort_order ASC
+            ''', (gallery_id,)).fetchall()
             
-            # Copy selected images (with watermark if enabled)
-            for gallery in galleries:
-                for image in gallery['images']:
-                    src_path = os.path.join('static', f'gallery_{gallery["id"]}', image['filename'])
-                    dest_path = os.path.join(images_dir, image['filename'])
-                    
-                    if os.path.exists(src_path):
-                        try:
-                            if watermark_enabled and watermark_config and watermark_config.get('text', '').strip():
-                                # Apply watermark
-                                print(f"Applying watermark to {image['filename']}")
-                                success = apply_watermark_to_image(src_path, dest_path, watermark_config)
-                                if not success:
-                                    print(f"Watermark failed for {image['filename']}, using original")
-                            else:
-                                # Just copy without watermark
-                                print(f"Copying {image['filename']} without watermark (enabled={watermark_enabled}, config={watermark_config is not None})")
-                                shutil.copy2(src_path, dest_path)
-                        except Exception as img_error:
-                            print(f"Error processing image {image['filename']}: {img_error}")
-                            # Fallback: copy original
-                            shutil.copy2(src_path, dest_path)
-                    else:
-                        print(f"Warning: Source image not found: {src_path}")
+            galleries.append({
+                'id': gallery['id'],
+                'title': gallery['title'],
+                'description': gallery['description'],
+                'featured_image_id': gallery['featured_image_id'],
+                'images': [dict(img) for img in images]
+            })
+    conn.close()
+    return galleries
+
+def load_build_watermark_config():
+    """Return the watermark config to apply to a build, or None when watermarking is off"""
+    try:
+        watermark_config = get_watermark_config()
+        if watermark_config is None:
+            watermark_config = get_default_watermark_config()
             
-            # Load and render template
-            theme_template_path = os.path.join('static_templates', theme, 'index.html')
-            if not os.path.exists(theme_template_path):
-                theme_template_path = os.path.join('static_templates', 'minimal', 'index.html')
+        watermark_enabled = watermark_config.get('enabled', 'false').lower() == 'true'
+        logger.debug("Watermark config loaded: enabled=%s, text=%s", watermark_enabled, watermark_config.get('text', 'N/A'))
+    except Exception as e:
+        print(f"Error loading watermark config: {e}")
+        return None
+    
+    if watermark_enabled and watermark_config.get('text', '').strip():
+        return watermark_config
+    return None
+
+def copy_site_image(src_path, dest_path, watermark_config):
+    """Copy one image into a site, watermarking it when a config is given"""
+    if not os.path.exists(src_path):
+        logger.warning("Source image not found: %s", src_path)
+        return
+    try:
+        if watermark_config:
+            # Apply watermark
+            logger.debug("Applying watermark to %s", os.path.basename(src_path))
+            success = apply_watermark_to_image(src_path, dest_path, watermark_config)
+            if not success:
+                logger.warning("Watermark failed for %s, using original", os.path.basename(src_path))
+        else:
+            # Just copy without watermark
+            link_or_copy(src_path, dest_path)
+    except Exception as img_error:
+        logger.warning("Error processing image %s: %s", os.path.basename(src_path), img_error)
+        # Fallback: copy original
+        shutil.copy2(src_path, dest_path)
+
+def build_static_site(gallery_ids, site_title="My Photo Gallery", site_description="", theme="minimal",
+                      page_size=None, output_mode="zip", deploy_dir="", workers=None):
+    """Run the static site pipeline, shared by the web form and the `app.build` CLI.
+
+    Loads the galleries, copies (and watermarks) their images, renders the pages,
+    optionally precompresses them, then zips the site into GENERATED_SITES_DIR and
+    records it, or syncs it into deploy_dir. `workers` sizes the thread pools of
+    the image, render and compression stages (None = executor default).
+
+    Returns a dict describing the build, with per-stage seconds under 'timings'
+    and the stage seconds/bytes plus slowest image copies under 'profile' (also
+    stored in generated_sites.build_profile).
+    Raises ValueError for requests that cannot be built.
+    """
+    import tempfile, zipfile
+    timer = StageTimer()
+    if page_size is None:
+        page_size = get_setting('gallery_page_size', 0)
+    
+    with timer.stage('load'):
+        galleries = load_site_galleries(gallery_ids)
+    if not galleries:
+        raise ValueError('No galleries selected')
+    
+    deploy_dir = (deploy_dir or '').strip() or get_setting('deploy_directory', '')
+    if output_mode == 'directory' and not deploy_dir:
+        raise ValueError('No deploy directory set (Settings → Portfolio)')
+    
+    theme_template_path = os.path.join('static_templates', theme, 'index.html')
+    if not os.path.exists(theme_template_path):
+        theme = 'minimal'
+    
+    result = {
+        'output_mode': output_mode,
+        'site_title': site_title,
+        'site_description': site_description,
+        'theme': theme,
+        'gallery_count': len(galleries),
+        'image_count': sum(len(g['images']) for g in galleries),
+        'timings': timer.timings,
+        'slowest_images': []
+    }
+    
+    # Create temporary directory for static site. Deploy builds are staged next to
+    # the target so their files can be hardlinked into it rather than copied
+    if output_mode == 'directory':
+        deploy_dir = os.path.abspath(deploy_dir)
+        os.makedirs(os.path.dirname(deploy_dir), exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix='.static_site_', dir=os.path.dirname(deploy_dir))
+    else:
+        temp_dir = tempfile.mkdtemp(prefix='static_site_')
+    
+    try:
+        # Copy selected images (with watermark if enabled)
+        with timer.stage('images'):
+            images_dir = os.path.join(temp_dir, 'images')
+            os.makedirs(images_dir, exist_ok=True)
+            watermark_config = load_build_watermark_config()
+            jobs = [(os.path.join('static', f'gallery_{gallery["id"]}', image['filename']),
+                     os.path.join(images_dir, image['filename']))
+                    for gallery in galleries for image in gallery['images']]
             
-            with open(theme_template_path, 'r', encoding='utf-8') as f:
-                template_content = f.read()
+            def timed_copy(job):
+                start = time.perf_counter()
+                copy_site_image(*job, watermark_config)
+                return {'filename': os.path.basename(job[1]), 'seconds': round(time.perf_counter() - start, 4),
+                        'bytes': _file_size(job[1])}
             
-            # Simple template rendering (we'll use Jinja2 properly)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                copies = list(pool.map(timed_copy, jobs))
+            timer.add_bytes('images', sum(copy['bytes'] for copy in copies))
+            result['slowest_images'] = heapq.nlargest(BUILD_PROFILE_SLOWEST_IMAGES, copies,
+                                                      key=lambda copy: copy['seconds'])
+        
+        # Render the landing page and paginated gallery pages
+        with timer.stage('render'):
             from jinja2 import Environment, FileSystemLoader
             
             env = Environment(loader=FileSystemLoader('static_templates'))
             env.filters['from_json'] = from_json
             
             template = env.get_template(f'{theme}/index.html')
-            
-            rendered_html = template.render(
-                site_title=site_title,
-                site_description=site_description,
-                galleries=galleries
-            )
-            
-            # Write HTML file
-            with open(os.path.join(temp_dir, 'index.html'), 'w', encoding='utf-8') as f:
-                f.write(rendered_html)
-            
-            # Create ZIP file
-            zip_filename = f'site_{datetime.now().strftime("%Y%m%d_%H%M%S")}.zip'
-            zip_path = os.path.join('static', 'generated_sites', zip_filename)
+            pages = render_site_pages(template, plan_site_pages(galleries, page_size), temp_dir, {
+                'site_title': site_title,
+                'site_description': site_description
+            }, workers=workers, optimize=get_setting('optimize_site_assets', False))
+            assets_dir = os.path.join(temp_dir, SITE_ASSETS_DIR)
+            assets = os.listdir(assets_dir) if os.path.isdir(assets_dir) else []
+            timer.add_bytes('render', sum(_file_size(os.path.join(temp_dir, page)) for page in pages) +
+                                      sum(_file_size(os.path.join(assets_dir, asset)) for asset in assets))
+        
+        if get_setting('precompress_site_files', False):
+            with timer.stage('precompress'):
+                timer.add_bytes('precompress', precompress_site_files(temp_dir, workers=workers)['bytes'])
+        
+        if output_mode == 'directory':
+            with timer.stage('sync'):
+                result['deploy_dir'] = deploy_dir
+                result['changes'] = sync_site_directory(temp_dir, deploy_dir)
+                timer.add_bytes('sync', sum(_file_size(os.path.join(deploy_dir, path))
+                                            for path in result['changes']['added'] + result['changes']['changed']))
+            result['profile'] = timer.profile(result['slowest_images'])
+            return result
+        
+        # Record what the build contains so later builds can be diffed against it.
+        # Hashes of files unchanged since the latest build are reused from its manifest
+        with timer.stage('manifest'):
+            conn = get_db()
+            latest = conn.execute('''SELECT manifest FROM generated_sites WHERE manifest IS NOT NULL 
+                                     ORDER BY id DESC LIMIT 1''').fetchone()
+            conn.close()
+            manifest = build_site_manifest(temp_dir, json.loads(latest['manifest']) if latest else None)
+        
+        # Create ZIP file
+        with timer.stage('zip'):
+            stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            zip_filename = f'site_{stamp}.zip'
+            # Builds within the same second must not overwrite each other (deltas diff against them)
+            suffix = 1
+            while zip_filename in get_archive_snapshot():
+                suffix += 1
+                zip_filename = f'site_{stamp}_{suffix}.zip'
+            zip_path = os.path.join(GENERATED_SITES_DIR, zip_filename)
             os.makedirs(os.path.dirname(zip_path), exist_ok=True)
             
             with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
@@ -1286,36 +3633,80 @@ def generate_static_site(
                         arcname = os.path.relpath(file_path, temp_dir)
                         zipf.write(file_path, arcname)
             
-            # Get file size for display
-            file_size = os.path.getsize(zip_path)
-            file_size_mb = file_size / (1024 * 1024)
-            
-            # Save generated site to database
+            invalidate_archive_snapshot()
+            result['zip_filename'] = zip_filename
+            result['file_size'] = os.path.getsize(zip_path)
+            timer.add_bytes('zip', result['file_size'])
+        
+        # Save generated site to database
+        with timer.stage('record'):
             try:
                 conn = get_db()
                 c = conn.cursor()
-                gallery_ids_json = ','.join(gallery_ids)
-                total_images = sum(len(g["images"]) for g in galleries)
                 c.execute('''INSERT INTO generated_sites 
                             (site_title, site_description, theme, filename, file_size, 
-                             gallery_count, image_count, gallery_ids) 
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                         (site_title, site_description, theme, zip_filename, file_size,
-                          len(galleries), total_images, gallery_ids_json))
+                             gallery_count, image_count, gallery_ids, manifest) 
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                         (site_title, site_description, theme, zip_filename, result['file_size'],
+                          len(galleries), result['image_count'], ','.join(str(g) for g in gallery_ids),
+                          json.dumps(manifest)))
+                result['site_id'] = c.lastrowid
                 conn.commit()
                 conn.close()
+                wake_storage_janitor()
             except Exception as db_error:
                 print(f"Error saving generated site to database: {db_error}")
-            
-            # Store generation info in session/query params for results page
-            return RedirectResponse(f'/generate/results?zip={zip_filename}&title={site_title}&desc={site_description}&theme={theme}&galleries={len(galleries)}&images={sum(len(g["images"]) for g in galleries)}&size={file_size_mb:.1f}', status_code=303)
-            
-        finally:
-            # Cleanup temp directory
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            
+        
+        # Stored once every stage, including the insert above, has been timed
+        result['profile'] = timer.profile(result['slowest_images'])
+        if 'site_id' in result:
+            conn = get_db()
+            conn.execute('UPDATE generated_sites SET build_profile=? WHERE id=?',
+                         (json.dumps(result['profile']), result['site_id']))
+            conn.commit()
+            conn.close()
+        return result
+        
+    finally:
+        # Cleanup temp directory
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+@app.post('/generate/static')
+def generate_static_site(
+    site_title: str = Form("My Photo Gallery"),
+    site_description: str = Form(""),
+    theme: str = Form("minimal"),
+    gallery_ids: List[str] = Form([]),
+    page_size: str = Form(""),
+    output_mode: str = Form("zip")
+):
+    """Generate static site with selected galleries and theme.
+
+    The directory output mode always syncs into the deploy_directory setting;
+    a target path is never taken from the request, since the sync deletes files.
+    """
+    try:
+        try:
+            page_size = int(page_size)
+        except ValueError:
+            page_size = None
+        
+        build = build_static_site(gallery_ids, site_title, site_description, theme,
+                                  page_size=page_size, output_mode=output_mode)
+    except ValueError as e:
+        return RedirectResponse(f'/generate?error={quote(str(e))}', status_code=303)
     except Exception as e:
         return RedirectResponse(f'/generate?error=Generation+failed:+{str(e)}', status_code=303)
+    
+    if output_mode == 'directory':
+        changes = build['changes']
+        summary = (f"Synced to {build['deploy_dir']}: {len(changes['added'])} added, {len(changes['changed'])} changed, "
+                   f"{len(changes['removed'])} removed, {changes['unchanged']} unchanged")
+        return RedirectResponse(f'/generate?success={quote(summary)}', status_code=303)
+    
+    # Store generation info in session/query params for results page
+    file_size_mb = build['file_size'] / (1024 * 1024)
+    return RedirectResponse(f'/generate/results?zip={build["zip_filename"]}&title={site_title}&desc={site_description}&theme={build["theme"]}&galleries={build["gallery_count"]}&images={build["image_count"]}&size={file_size_mb:.1f}', status_code=303)
 
 @app.get('/generate/results', response_class=HTMLResponse)
 def generate_results(request: Request):
@@ -1333,13 +3724,17 @@ def generate_results(request: Request):
         return RedirectResponse('/generate?error=No+generation+data+found', status_code=303)
     
     # Check if file exists
-    zip_path = os.path.join('static', 'generated_sites', zip_filename)
-    if not os.path.exists(zip_path):
+    archive = get_archive_snapshot().get(zip_filename)
+    if archive is None:
         return RedirectResponse('/generate?error=Generated+file+not+found', status_code=303)
     
     # Get file stats
-    file_stat = os.stat(zip_path)
-    generated_time = datetime.fromtimestamp(file_stat.st_mtime)
+    generated_time = datetime.fromtimestamp(archive[1])
+    
+    conn = get_db()
+    row = conn.execute('SELECT build_profile FROM generated_sites WHERE filename=?', (zip_filename,)).fetchone()
+    conn.close()
+    profile = json.loads(row['build_profile']) if row and row['build_profile'] else None
     
     return templates.TemplateResponse('generate_results.html', {
         'request': request,
@@ -1351,14 +3746,20 @@ def generate_results(request: Request):
         'image_count': image_count,
         'file_size': f'{file_size} MB',
         'generated_time': generated_time,
-        'galleries': []  # We could store this info if needed
+        'galleries': [],  # We could store this info if needed
+        'profile': profile
     })
 
 @app.get('/download/{filename}')
 def download_generated_site(filename: str):
     """Download generated static site"""
-    file_path = os.path.join('static', 'generated_sites', filename)
+    file_path = os.path.join(GENERATED_SITES_DIR, filename)
     if os.path.exists(file_path) and filename.endswith('.zip'):
+        # Record the access for LRU eviction
+        conn = get_db()
+        conn.execute('UPDATE generated_sites SET last_accessed_at=CURRENT_TIMESTAMP WHERE filename=?', (filename,))
+        conn.commit()
+        conn.close()
         return FileResponse(
             file_path,
             media_type='application/zip',
@@ -1366,6 +3767,78 @@ def download_generated_site(filename: str):
         )
     return RedirectResponse('/generate?error=File+not+found', status_code=303)
 
+# Patch archives between two builds, cached until storage limits evict them
+DELTA_CACHE_DIR = os.path.join(CACHE_DIR, 'deltas')
+
+def diff_site_manifests(old_manifest, new_manifest):
+    """Return the added, changed and removed paths between two build manifests"""
+    return {
+        'added': sorted(set(new_manifest) - set(old_manifest)),
+        'changed': sorted(path for path in set(new_manifest) & set(old_manifest)
+                          if new_manifest[path]['sha256'] != old_manifest[path]['sha256']),
+        'removed': sorted(set(old_manifest) - set(new_manifest))
+    }
+
+def build_site_delta(site, base):
+    """Write a zip of the files added or changed in `site` since `base`, plus a deletion list.
+
+    Both arguments are generated_sites rows with manifests; the files are read
+    from the site's own archive. Returns the cached delta path.
+    """
+    import zipfile
+    delta_path = os.path.join(DELTA_CACHE_DIR, f'site_{site["id"]}_since_{base["id"]}.zip')
+    if os.path.exists(delta_path):
+        conn = get_db()
+        touch_cache_file(conn.cursor(), delta_path)
+        conn.commit()
+        conn.close()
+        return delta_path
+    
+    changes = diff_site_manifests(json.loads(base['manifest']), json.loads(site['manifest']))
+    os.makedirs(DELTA_CACHE_DIR, exist_ok=True)
+    tmp_path = f'{delta_path}.{threading.get_ident()}.tmp'
+    with zipfile.ZipFile(os.path.join(GENERATED_SITES_DIR, site['filename'])) as source, \
+         zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as delta:
+        for path in changes['added'] + changes['changed']:
+            with source.open(path) as src, delta.open(path, 'w') as dest:
+                shutil.copyfileobj(src, dest)
+        delta.writestr(SITE_CHANGES_NAME, json.dumps(changes, indent=1))
+    os.replace(tmp_path, delta_path)
+    
+    conn = get_db()
+    record_cache_file(conn.cursor(), 'delta', delta_path, os.path.getsize(delta_path))
+    conn.commit()
+    conn.close()
+    return delta_path
+
+@app.get('/generated-sites/{site_id}/delta')
+def download_site_delta(site_id: int, since: int):
+    """Download only what changed in a generated site since an earlier build"""
+    import zipfile
+    conn = get_db()
+    site = conn.execute('SELECT id, filename, manifest FROM generated_sites WHERE id=?', (site_id,)).fetchone()
+    base = conn.execute('SELECT id, filename, manifest FROM generated_sites WHERE id=?', (since,)).fetchone()
+    conn.close()
+    
+    if not site or not base:
+        return RedirectResponse('/generated-sites?error=Site+not+found', status_code=303)
+    if not site['manifest'] or not base['manifest']:
+        return RedirectResponse('/generated-sites?error=Site+has+no+file+manifest', status_code=303)
+    if site['filename'] not in get_archive_snapshot():
+        return RedirectResponse('/generated-sites?error=Generated+file+not+found', status_code=303)
+    
+    try:
+        delta_path = build_site_delta(site, base)
+    except (KeyError, zipfile.BadZipFile) as e:
+        print(f"Error building delta for site {site_id}: {e}")
+        return RedirectResponse('/generated-sites?error=Could+not+build+delta', status_code=303)
+    
+    return FileResponse(
+        delta_path,
+        media_type='application/zip',
+        filename=f'{os.path.splitext(site["filename"])[0]}_delta_since_{base["id"]}.zip'
+    )
+
 @app.get('/preview/{theme}')
 def preview_theme(theme: str, request: Request):
     """Preview a theme with sample data"""
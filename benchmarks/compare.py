@@ -0,0 +1,52 @@
+"""Compare two benchmark result files (from benchmarks/run.py) stage by stage.
+
+    python benchmarks/compare.py before.json after.json
+
+Prints images/sec, peak RSS and bytes written for both runs with the relative
+change. Exits with status 1 when any stage's throughput dropped by more than
+--threshold percent, so it can gate CI.
+"""
+import argparse
+import json
+import sys
+
+
+def change(before, after):
+    if not before or after is None:
+        return ''
+    return f'{(after - before) / before * 100:+.1f}%'
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10, help='allowed throughput drop in percent (default: 10)')
+    args = parser.parse_args(argv)
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if before.get('corpus') != after.get('corpus'):
+        print(f"warning: corpora differ ({before.get('corpus')} vs {after.get('corpus')})", file=sys.stderr)
+
+    print(f"{'stage':<10} {'images/s':>21} {'change':>8} {'peak RSS MB':>19} {'change':>8} {'bytes written':>25}")
+    regressed = []
+    for stage in sorted(set(before['stages']) & set(after['stages'])):
+        old, new = before['stages'][stage], after['stages'][stage]
+        throughput_change = change(old['images_per_sec'], new['images_per_sec'])
+        print(f"{stage:<10} {old['images_per_sec']:>10.2f} {new['images_per_sec']:>10.2f} {throughput_change:>8} "
+              f"{old['peak_rss_mb']:>9.1f} {new['peak_rss_mb']:>9.1f} {change(old['peak_rss_mb'], new['peak_rss_mb']):>8} "
+              f"{old['bytes_written']:>12} {new['bytes_written']:>12}")
+        if old['images_per_sec'] and new['images_per_sec'] < old['images_per_sec'] * (1 - args.threshold / 100):
+            regressed.append(stage)
+
+    if regressed:
+        print(f"throughput regressed by more than {args.threshold:g}%: {', '.join(regressed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
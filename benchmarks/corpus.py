@@ -0,0 +1,101 @@
+"""Synthetic, reproducible image corpus for the benchmarks.
+
+Images are smooth random colour fields (upscaled noise, so they compress like
+photos rather than flat fills) saved as 3:2 JPEGs. The same arguments always
+produce byte-identical files, so results are comparable across commits.
+
+EXIF richness levels:
+  none  - no EXIF block
+  basic - camera make/model and capture time
+  full  - basic plus lens, exposure, aperture, ISO, focal length, GPS, artist,
+          copyright and a long description, read by the upload EXIF extraction
+
+    python benchmarks/corpus.py /tmp/corpus --count 50 --megapixels 12 --exif full
+"""
+import argparse
+import io
+import math
+import os
+import random
+
+from PIL import Image, TiffImagePlugin
+
+EXIF_LEVELS = ('none', 'basic', 'full')
+
+CAMERAS = [('Canon', 'EOS R5'), ('Nikon', 'Z 7II'), ('Sony', 'ILCE-7RM4'), ('Fujifilm', 'X-T4')]
+LENSES = ['RF 24-70mm F2.8 L IS USM', 'NIKKOR Z 50mm f/1.8 S', 'FE 85mm F1.8', 'XF16-55mmF2.8 R LM WR']
+
+
+def image_size(megapixels):
+    """Width and height of a 3:2 image with roughly this many megapixels"""
+    width = max(1, round(math.sqrt(megapixels * 1_000_000 * 1.5)))
+    return width, max(1, round(width / 1.5))
+
+
+def rational(value, denominator=1):
+    return TiffImagePlugin.IFDRational(value, denominator)
+
+
+def build_exif(rnd, index, exif_level):
+    exif = Image.Exif()
+    if exif_level == 'none':
+        return exif
+    make, model = rnd.choice(CAMERAS)
+    exif[0x010F] = make
+    exif[0x0110] = model
+    exif[0x0132] = f'2024:{1 + index % 12:02d}:{1 + index % 28:02d} 12:{index % 60:02d}:00'
+    if exif_level == 'full':
+        exif[0x010E] = 'Synthetic benchmark image ' + 'lorem ipsum ' * 20
+        exif[0x013B] = 'Benchmark Photographer'
+        exif[0x8298] = 'Copyright Benchmark Photographer'
+        exif[0x8769] = {
+            0xA434: rnd.choice(LENSES),
+            0x829A: rational(1, rnd.choice([60, 125, 250, 500, 1000])),
+            0x829D: rational(rnd.choice([14, 18, 28, 40, 56, 80]), 10),
+            0x8827: rnd.choice([100, 200, 400, 800, 3200]),
+            0x920A: rational(rnd.choice([24, 35, 50, 85, 135]), 1),
+        }
+        exif[0x8825] = {
+            1: 'N',
+            2: (rational(rnd.randint(0, 89)), rational(rnd.randint(0, 59)), rational(0)),
+            3: 'E',
+            4: (rational(rnd.randint(0, 179)), rational(rnd.randint(0, 59)), rational(0)),
+        }
+    return exif
+
+
+def make_image(index, megapixels, exif_level='basic', seed=0):
+    """Encode one deterministic synthetic JPEG; returns its bytes"""
+    rnd = random.Random(seed * 1_000_003 + index)
+    tile = Image.frombytes('RGB', (48, 32), rnd.randbytes(48 * 32 * 3))
+    img = tile.resize(image_size(megapixels), Image.BICUBIC)
+    output = io.BytesIO()
+    img.save(output, 'JPEG', quality=90, exif=build_exif(rnd, index, exif_level))
+    return output.getvalue()
+
+
+def generate_corpus(directory, count, megapixels, exif_level='basic', seed=0):
+    """Write `count` images into directory (skipping ones already there); returns their paths"""
+    if exif_level not in EXIF_LEVELS:
+        raise ValueError(f'exif_level must be one of {EXIF_LEVELS}')
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, f'bench_{seed}_{megapixels:g}mp_{exif_level}_{index:05d}.jpg')
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(make_image(index, megapixels, exif_level, seed))
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic benchmark image corpus')
+    parser.add_argument('directory')
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--megapixels', type=float, default=12)
+    parser.add_argument('--exif', choices=EXIF_LEVELS, default='basic')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    paths = generate_corpus(args.directory, args.count, args.megapixels, args.exif, args.seed)
+    print(f'{len(paths)} images in {args.directory}')
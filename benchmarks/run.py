@@ -0,0 +1,201 @@
+"""Benchmark the upload, thumbnail, watermark and export paths on a synthetic corpus.
+
+Each stage runs in its own interpreter inside a scratch working directory (with
+its own gallery.db and static/), so peak RSS is per stage and the real data is
+never touched. For every stage the results record images/sec, peak RSS and the
+bytes written into the working directory. The output is one JSON document; keep
+it per commit and compare two of them with benchmarks/compare.py.
+
+    python benchmarks/run.py --count 50 --megapixels 12 --exif full --output results.json
+
+Stages:
+  upload     - POST /gallery/{id}/upload-multiple in batches (EXIF, downscale, thumbnail, DB insert)
+  thumbnail  - decode + 400px thumbnail + encode of every corpus image
+  watermark  - apply_watermark_to_image on every stored image
+  export     - build_static_site() into a zip, with its per-stage timings
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ('upload', 'thumbnail', 'watermark', 'export')
+UPLOAD_BATCH_SIZE = 10
+
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def stage_upload(main, corpus, workers):
+    from fastapi.testclient import TestClient
+    client = TestClient(main.app)
+    conn = main.get_db()
+    conn.execute("INSERT INTO galleries (title, description) VALUES ('Benchmark', '')")
+    conn.commit()
+    gallery_id = conn.execute('SELECT MAX(id) FROM galleries').fetchone()[0]
+    conn.close()
+    for start in range(0, len(corpus), UPLOAD_BATCH_SIZE):
+        batch = corpus[start:start + UPLOAD_BATCH_SIZE]
+        with contextlib.ExitStack() as stack:
+            files = [('files', (os.path.basename(path), stack.enter_context(open(path, 'rb')), 'image/jpeg'))
+                     for path in batch]
+            response = client.post(f'/gallery/{gallery_id}/upload-multiple', files=files)
+        response.raise_for_status()
+    return len(corpus), {}
+
+
+def stage_thumbnail(main, corpus, workers):
+    from PIL import Image
+    os.makedirs('bench_thumbs', exist_ok=True)
+    for path in corpus:
+        with Image.open(path) as img:
+            img.thumbnail((400, 400))
+            img.save(os.path.join('bench_thumbs', os.path.basename(path)))
+    return len(corpus), {}
+
+
+def stage_watermark(main, corpus, workers):
+    main.set_setting('watermark_enabled', True, 'boolean')
+    main.set_setting('watermark_text', '© Benchmark', 'text')
+    config = main.load_build_watermark_config()
+    os.makedirs('bench_watermarked', exist_ok=True)
+    conn = main.get_db()
+    rows = conn.execute('SELECT gallery_id, filename FROM images').fetchall()
+    conn.close()
+    for row in rows:
+        src_path, _, _ = main.image_file_paths(row['gallery_id'], row['filename'])
+        main.apply_watermark_to_image(src_path, os.path.join('bench_watermarked', row['filename']), config)
+    main.set_setting('watermark_enabled', False, 'boolean')
+    return len(rows), {}
+
+
+def stage_export(main, corpus, workers):
+    conn = main.get_db()
+    gallery_ids = [row['id'] for row in conn.execute('SELECT id FROM galleries')]
+    conn.close()
+    build = main.build_static_site(gallery_ids, 'Benchmark', theme='grid', workers=workers)
+    return build['image_count'], {'timings': build['timings'], 'archive_bytes': build['file_size']}
+
+
+def run_stage(stage, workdir, corpus, workers):
+    """Run one stage in this process (the child side of run_isolated); returns its measurements"""
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    with contextlib.redirect_stdout(sys.stderr):
+        from app import main
+        main.startup()
+        bytes_before = directory_bytes(workdir)
+        start = time.perf_counter()
+        images, extra = globals()[f'stage_{stage}'](main, corpus, workers)
+        seconds = time.perf_counter() - start
+    return dict({
+        'images': images,
+        'seconds': seconds,
+        'images_per_sec': images / seconds if seconds else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'bytes_written': directory_bytes(workdir) - bytes_before,
+    }, **extra)
+
+
+def run_isolated(stage, workdir, corpus_dir, workers):
+    """Run a stage in a fresh interpreter so its peak RSS is its own"""
+    command = [sys.executable, os.path.abspath(__file__), '--stage', stage, '--workdir', workdir,
+               '--corpus-dir', corpus_dir]
+    if workers:
+        command += ['--workers', str(workers)]
+    completed = subprocess.run(command, check=True, capture_output=True, text=True)
+    return json.loads(completed.stdout)
+
+
+def prepare_workdir(workdir):
+    os.makedirs(os.path.join(workdir, 'static'), exist_ok=True)
+    for name in ('static_templates', 'templates'):
+        link = os.path.join(workdir, name)
+        if not os.path.exists(link):
+            os.symlink(os.path.join(ROOT, name), link)
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark upload, thumbnail, watermark and export')
+    parser.add_argument('--count', type=int, default=20, help='images in the corpus')
+    parser.add_argument('--megapixels', type=float, default=12, help='size of each image')
+    parser.add_argument('--exif', choices=('none', 'basic', 'full'), default='basic', help='EXIF richness')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None, help='thread pool size for the export stage')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma-separated subset of ' + ', '.join(STAGES))
+    parser.add_argument('--corpus-dir', help='reuse/keep the corpus here (default: inside the scratch directory)')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    parser.add_argument('--stage', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.stage:
+        corpus = sorted(os.path.join(args.corpus_dir, name) for name in os.listdir(args.corpus_dir))
+        print(json.dumps(run_stage(args.stage, args.workdir, corpus, args.workers)))
+        return
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from corpus import generate_corpus
+
+    stages = [stage for stage in args.stages.split(',') if stage]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f'unknown stages: {", ".join(sorted(unknown))}')
+    if {'watermark', 'export'} & set(stages) and 'upload' not in stages:
+        parser.error('the watermark and export stages need the upload stage')
+
+    scratch = tempfile.mkdtemp(prefix='gallery_bench_')
+    try:
+        corpus_dir = os.path.abspath(args.corpus_dir or os.path.join(scratch, 'corpus'))
+        corpus_dir = os.path.join(corpus_dir, f'{args.count}x{args.megapixels:g}mp_{args.exif}_seed{args.seed}')
+        generate_corpus(corpus_dir, args.count, args.megapixels, args.exif, args.seed)
+        workdir = os.path.join(scratch, 'work')
+        prepare_workdir(workdir)
+
+        results = {
+            'benchmark': 'pipeline',
+            'commit': git_commit(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'corpus': {'count': args.count, 'megapixels': args.megapixels, 'exif': args.exif, 'seed': args.seed,
+                       'bytes': directory_bytes(corpus_dir)},
+            'workers': args.workers,
+            'stages': {stage: run_isolated(stage, workdir, corpus_dir, args.workers)
+                       for stage in STAGES if stage in stages},
+        }
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,76 @@
+"""Startup-time benchmark: how long a worker takes to import the app and initialize the database.
+
+Measures, over several runs:
+  import_s        - `import app.main` in a fresh interpreter (what every uvicorn worker and --reload pays)
+  init_fresh_s    - startup() against an empty database (first boot)
+  init_current_s  - startup() against a database whose schema fingerprint is current (every later boot)
+
+Prints one JSON object; run from the project root:
+
+    python benchmarks/startup.py --runs 10 --output startup.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_import(runs):
+    code = 'import time; t = time.perf_counter(); import app.main; print(time.perf_counter() - t)'
+    return [float(subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True,
+                                 capture_output=True, text=True).stdout.split()[-1])
+            for _ in range(runs)]
+
+
+def time_init(runs):
+    sys.path.insert(0, ROOT)
+    from app import main
+
+    fresh, current = [], []
+    with tempfile.TemporaryDirectory() as tmp:
+        for run in range(runs):
+            main.DB_PATH = os.path.join(tmp, f'bench_{run}.db')
+            start = time.perf_counter()
+            main.startup()
+            fresh.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            main.startup()
+            current.append(time.perf_counter() - start)
+    return fresh, current
+
+
+def summarize(samples):
+    return {'median': statistics.median(samples), 'min': min(samples), 'max': max(samples), 'runs': len(samples)}
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description='Measure app import and database initialization time')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    os.chdir(ROOT)
+    with contextlib.redirect_stdout(sys.stderr):
+        fresh, current = time_init(args.runs)
+    results = {
+        'benchmark': 'startup',
+        'python': sys.version.split()[0],
+        'import_s': summarize(time_import(args.runs)),
+        'init_fresh_s': summarize(fresh),
+        'init_current_s': summarize(current),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main_cli()
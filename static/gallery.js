@@ -58,33 +58,33 @@ document.addEventListener('DOMContentLoaded', function() {
         targetCard.parentNode.insertBefore(draggedElement, targetCard);
       }
       
-      // Update sort order in database
-      updateImageOrder(gallery);
+      // Save the new position of the dragged image only
+      moveImage(draggedElement);
     }
   });
 
-  // Function to update image order in database
-  function updateImageOrder(gallery) {
-    const cards = Array.from(gallery.children);
-    const imageOrder = cards.map((card, index) => ({
-      id: parseInt(card.getAttribute('data-id')),
-      sort_order: index
-    }));
+  // Function to save a single image's new position in database
+  function moveImage(card) {
+    const galleryId = card.getAttribute('data-gallery-id');
+    const prev = card.previousElementSibling;
+    const next = card.nextElementSibling;
+    const move = {
+      image_id: parseInt(card.getAttribute('data-id')),
+      after_id: prev ? parseInt(prev.getAttribute('data-id')) : null,
+      before_id: next ? parseInt(next.getAttribute('data-id')) : null
+    };
     
-    const galleryId = cards[0]?.getAttribute('data-gallery-id');
     if (galleryId) {
-      fetch(`/gallery/${galleryId}/reorder`, {
+      fetch(`/gallery/${galleryId}/move`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
           'accept': 'application/json'
         },
-        body: JSON.stringify({ image_order: imageOrder })
-      }).then(resp => {
-        if (!resp.ok) {
-          console.error('Failed to update image order');
-          // Optionally reload the page on error
-          // window.location.reload();
+        body: JSON.stringify(move)
+      }).then(resp => resp.json()).then(data => {
+        if (!data.success) {
+          console.error('Failed to update image order:', data.error);
         }
       }).catch(err => {
         console.error('Error updating image order:', err);
@@ -361,3 +361,58 @@ window.showDeleteImageModal = function(imageId) {
     }
   }
 };
+
+// Upload files through the Server-Sent Events endpoint. Each image card is
+// added to the page's .gallery-flex as soon as the server has committed it, so
+// images can be curated while the rest of the batch is still processing.
+// onEvent(name, data) sees every event: received, exif, thumbnail, committed,
+// failed and the final done.
+window.streamUploads = async function(galleryId, files, onEvent) {
+  const formData = new FormData();
+  files.forEach(file => formData.append('files', file));
+
+  const response = await fetch(`/gallery/${galleryId}/upload-stream`, {
+    method: 'POST',
+    body: formData
+  });
+  if (!response.ok) {
+    throw new Error(`Upload failed with status ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  const dispatch = (frame) => {
+    let name = 'message';
+    let data = '';
+    frame.split('\n').forEach(line => {
+      if (line.startsWith('event:')) {
+        name = line.slice(6).trim();
+      } else if (line.startsWith('data:')) {
+        data += line.slice(5).trim();
+      }
+    });
+    const payload = data ? JSON.parse(data) : {};
+
+    const container = document.querySelector('.gallery-flex');
+    if (name === 'committed' && payload.html && container) {
+      container.insertAdjacentHTML('beforeend', payload.html);
+    }
+    if (onEvent) {
+      onEvent(name, payload);
+    }
+  };
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      dispatch(buffer.slice(0, boundary));
+      buffer = buffer.slice(boundary + 2);
+    }
+  }
+};
@@ -3,11 +3,20 @@ import sqlite3
 import os
 import tempfile
 import shutil
+import subprocess
+import sys
+import threading
+import time
 from fastapi.testclient import TestClient
+import app.main as main
 from app.main import app, get_db
 from PIL import Image
 import io
+import gzip
 import json
+import re
+import zipfile
+from datetime import datetime
 
 class TestConfig:
     """Test configuration"""
@@ -20,8 +29,9 @@ def test_client():
     # Create test directories
     os.makedirs('test_static/thumbs', exist_ok=True)
     
-    # Override database path for testing
-    original_db_path = app.state.db_path if hasattr(app.state, 'db_path') else None
+    # Override database path for testing (route handlers call get_db() directly)
+    original_db_path = main.DB_PATH
+    main.DB_PATH = TestConfig.TEST_DB
     
     def get_test_db():
         conn = sqlite3.connect(TestConfig.TEST_DB)
@@ -56,13 +66,19 @@ def test_client():
     )''')
     conn.commit()
     conn.close()
+    main.startup()
+    main.invalidate_duplicate_index()  # it caches ids from the previous test database
     
     client = TestClient(app)
+    client.follow_redirects = False  # tests assert on the 303 redirects
     
     yield client
     
     # Cleanup
+    while main.process_deletion_queue():
+        pass
     app.dependency_overrides.clear()
+    main.DB_PATH = original_db_path
     if os.path.exists(TestConfig.TEST_DB):
         os.remove(TestConfig.TEST_DB)
     if os.path.exists(TestConfig.TEST_STATIC_DIR):
@@ -85,6 +101,70 @@ def sample_gallery(test_client):
     
     return dict(gallery)
 
+@pytest.fixture
+def insert_images(test_client):
+    """Insert image rows straight into the test database, without files on disk"""
+    def insert(gallery_id, count=None, enabled=1, sort_order=None, dims=(None, None)):
+        """Insert photo0.jpg, photo1.jpg... and return their ids.
+        
+        enabled and sort_order take one value per image as a list; without a
+        count there is one image per entry. sort_order defaults to 0, 1, 2...
+        """
+        if count is None:
+            count = len(enabled if isinstance(enabled, list) else sort_order)
+        enabled_flags = enabled if isinstance(enabled, list) else [enabled] * count
+        sort_orders = sort_order if sort_order is not None else list(range(count))
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        image_ids = []
+        for i in range(count):
+            cur = conn.execute('''INSERT INTO images (gallery_id, filename, title, enabled, sort_order, width, height) 
+                                  VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                               (gallery_id, f'photo{i}.jpg', f'Photo {i}', enabled_flags[i], sort_orders[i], *dims))
+            image_ids.append(cur.lastrowid)
+        conn.commit()
+        conn.close()
+        return image_ids
+    return insert
+
+@pytest.fixture
+def sites_dir(test_client, monkeypatch, tmp_path):
+    """Point GENERATED_SITES_DIR at an empty temporary directory"""
+    monkeypatch.setattr(main, "GENERATED_SITES_DIR", str(tmp_path))
+    main.invalidate_archive_snapshot()
+    yield tmp_path
+    main.invalidate_archive_snapshot()
+
+def _static_image_paths():
+    """Gallery folders and image/thumbnail files under static/, where the app writes them"""
+    paths = set()
+    for name in os.listdir('static'):
+        if name.startswith('gallery_') or name == 'thumbs':
+            folder = os.path.join('static', name)
+            paths.add(folder)
+            paths.update(os.path.join(folder, filename) for filename in os.listdir(folder))
+    return paths
+
+@pytest.fixture
+def clean_static_images():
+    """Remove the gallery folders and image files a test leaves under static/"""
+    before = _static_image_paths()
+    yield
+    for path in sorted(_static_image_paths() - before, reverse=True):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+def upload_image(client, gallery_id, name, img):
+    """Upload a PIL image through upload-multiple, as PNG or JPEG by its extension; returns its result"""
+    img_format = 'PNG' if name.endswith('.png') else 'JPEG'
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format=img_format)
+    img_bytes.seek(0)
+    response = client.post(f"/gallery/{gallery_id}/upload-multiple",
+                           files=[("files", (name, img_bytes, f"image/{img_format.lower()}"))])
+    return response.json()["results"][0]
+
 @pytest.fixture
 def sample_image():
     """Create a sample image file for testing"""
@@ -356,6 +436,1339 @@ class TestImageOrdering:
         assert images[0]['id'] == image_ids[2]  # Last should be first
         assert images[1]['id'] == image_ids[1]  # Middle stays middle
         assert images[2]['id'] == image_ids[0]  # First should be last
+    
+    def _ordered_ids(self, gallery_id):
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        rows = conn.execute(
+            'SELECT id FROM images WHERE gallery_id=? ORDER BY sort_order ASC, id ASC',
+            (gallery_id,)
+        ).fetchall()
+        conn.close()
+        return [row[0] for row in rows]
+    
+    def test_move_image_updates_only_moved_row(self, test_client, sample_gallery, insert_images):
+        """Test moving one image between two neighbours leaves other ranks alone"""
+        step = main.RANK_STEP
+        image_ids = insert_images(sample_gallery['id'], sort_order=[0, step, 2 * step])
+        
+        response = test_client.post(
+            f"/gallery/{sample_gallery['id']}/move",
+            json={"image_id": image_ids[2], "after_id": image_ids[0], "before_id": image_ids[1]}
+        )
+        
+        result = response.json()
+        assert result["success"] is True
+        assert self._ordered_ids(sample_gallery['id']) == [image_ids[0], image_ids[2], image_ids[1]]
+        
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        ranks = dict(conn.execute('SELECT id, sort_order FROM images').fetchall())
+        conn.close()
+        assert ranks[image_ids[0]] == 0
+        assert ranks[image_ids[1]] == step
+    
+    def test_move_image_to_start_and_end(self, test_client, sample_gallery, insert_images):
+        """Test moving an image to either end of the gallery"""
+        step = main.RANK_STEP
+        image_ids = insert_images(sample_gallery['id'], sort_order=[0, step, 2 * step])
+        
+        test_client.post(f"/gallery/{sample_gallery['id']}/move",
+                         json={"image_id": image_ids[2], "before_id": image_ids[0]})
+        assert self._ordered_ids(sample_gallery['id']) == [image_ids[2], image_ids[0], image_ids[1]]
+        
+        test_client.post(f"/gallery/{sample_gallery['id']}/move",
+                         json={"image_id": image_ids[2], "after_id": image_ids[1]})
+        assert self._ordered_ids(sample_gallery['id']) == [image_ids[0], image_ids[1], image_ids[2]]
+    
+    def test_move_image_rebalances_dense_ranks(self, test_client, sample_gallery, insert_images):
+        """Test that legacy 0, 1, 2 ranks are respaced when there is no gap"""
+        image_ids = insert_images(sample_gallery['id'], sort_order=[0, 1, 2])
+        
+        response = test_client.post(
+            f"/gallery/{sample_gallery['id']}/move",
+            json={"image_id": image_ids[2], "after_id": image_ids[0], "before_id": image_ids[1]}
+        )
+        
+        assert response.json()["success"] is True
+        assert self._ordered_ids(sample_gallery['id']) == [image_ids[0], image_ids[2], image_ids[1]]
+    
+    def test_move_with_one_neighbour_uses_the_adjacent_image(self, test_client, sample_gallery, insert_images):
+        """Test that a move given only before_id lands between it and the image actually before it"""
+        image_ids = insert_images(sample_gallery['id'], sort_order=[0, 10, 2048, 3072])
+        
+        response = test_client.post(f"/gallery/{sample_gallery['id']}/move",
+                                    json={"image_id": image_ids[3], "before_id": image_ids[1]})
+        
+        assert response.json()["sort_order"] == 5
+        assert self._ordered_ids(sample_gallery['id']) == [image_ids[0], image_ids[3], image_ids[1], image_ids[2]]
+    
+    def test_inverted_neighbours_rejected_without_respacing(self, test_client, sample_gallery, insert_images):
+        """Test that after_id/before_id out of order are refused before any rank is rewritten"""
+        image_ids = insert_images(sample_gallery['id'], sort_order=[0, 1, 2])
+        
+        response = test_client.post(
+            f"/gallery/{sample_gallery['id']}/move",
+            json={"image_id": image_ids[0], "after_id": image_ids[2], "before_id": image_ids[1]}
+        )
+        
+        assert response.json()["success"] is False
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        ranks = [row[0] for row in conn.execute('SELECT sort_order FROM images ORDER BY id')]
+        conn.close()
+        assert ranks == [0, 1, 2]
+    
+    def test_move_image_from_other_gallery_rejected(self, test_client, sample_gallery, insert_images):
+        """Test that images outside the gallery cannot be moved into it"""
+        image_ids = insert_images(sample_gallery['id'], sort_order=[0, main.RANK_STEP])
+        
+        response = test_client.post(
+            f"/gallery/{sample_gallery['id'] + 1}/move",
+            json={"image_id": image_ids[1], "before_id": image_ids[0]}
+        )
+        
+        assert response.json()["success"] is False
+
+@pytest.mark.usefixtures("clean_static_images")
+class TestBulkImageOperations:
+    """Test the transactional bulk image endpoint"""
+    
+    def _fetch(self, query, params=()):
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(query, params).fetchall()
+        conn.close()
+        return rows
+    
+    def test_bulk_disable(self, test_client, sample_gallery, insert_images):
+        """Test disabling a selection of images"""
+        image_ids = insert_images(sample_gallery['id'], 3)
+        
+        response = test_client.post("/images/bulk", json={
+            "image_ids": image_ids[:2] + [99999],
+            "action": "disable"
+        })
+        
+        result = response.json()
+        assert result["success"] is True
+        assert result["affected"] == 2
+        assert result["missing_ids"] == [99999]
+        enabled = {row['id']: row['enabled'] for row in self._fetch('SELECT id, enabled FROM images')}
+        assert enabled == {image_ids[0]: 0, image_ids[1]: 0, image_ids[2]: 1}
+    
+    def test_bulk_set_fields(self, test_client, sample_gallery, insert_images):
+        """Test setting fields ignores columns that are not editable"""
+        image_ids = insert_images(sample_gallery['id'], 2)
+        
+        response = test_client.post("/images/bulk", json={
+            "image_ids": image_ids,
+            "action": "set",
+            "fields": {"lens": "50mm", "gallery_id": 42}
+        })
+        
+        assert response.json()["success"] is True
+        rows = self._fetch('SELECT lens, gallery_id FROM images')
+        assert all(row['lens'] == "50mm" for row in rows)
+        assert all(row['gallery_id'] == sample_gallery['id'] for row in rows)
+    
+    def test_bulk_delete_clears_featured(self, test_client, sample_gallery, insert_images):
+        """Test deleting a selection removes rows and featured references"""
+        image_ids = insert_images(sample_gallery['id'], 3)
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        conn.execute('UPDATE galleries SET featured_image_id=? WHERE id=?', (image_ids[0], sample_gallery['id']))
+        conn.commit()
+        conn.close()
+        
+        response = test_client.post("/images/bulk", json={"image_ids": image_ids[:2], "action": "delete"})
+        
+        assert response.json()["success"] is True
+        assert [row['id'] for row in self._fetch('SELECT id FROM images')] == [image_ids[2]]
+        gallery = self._fetch('SELECT featured_image_id FROM galleries WHERE id=?', (sample_gallery['id'],))[0]
+        assert gallery['featured_image_id'] is None
+    
+    def test_bulk_move_to_gallery(self, test_client, sample_gallery, insert_images):
+        """Test moving images appends them to the target gallery"""
+        image_ids = insert_images(sample_gallery['id'], 2)
+        test_client.post("/create-gallery", data={"title": "Target"})
+        target = self._fetch('SELECT id FROM galleries WHERE title=?', ("Target",))[0]
+        
+        response = test_client.post("/images/bulk", json={
+            "image_ids": image_ids,
+            "action": "move",
+            "gallery_id": target['id']
+        })
+        
+        assert response.json()["success"] is True
+        rows = self._fetch('SELECT id, gallery_id FROM images ORDER BY sort_order')
+        assert [row['id'] for row in rows] == image_ids
+        assert all(row['gallery_id'] == target['id'] for row in rows)
+        gallery = self._fetch('SELECT featured_image_id FROM galleries WHERE id=?', (target['id'],))[0]
+        assert gallery['featured_image_id'] == image_ids[0]
+    
+    def test_bulk_move_rejects_name_collision(self, test_client, sample_gallery, insert_images):
+        """Test that a move never overwrites a same-named image in the target gallery"""
+        image_ids = insert_images(sample_gallery['id'], 2)
+        test_client.post("/create-gallery", data={"title": "Target"})
+        target = self._fetch('SELECT id FROM galleries WHERE title=?', ("Target",))[0]
+        insert_images(target['id'], 1)
+        target_file = f"static/gallery_{target['id']}/photo0.jpg"
+        os.makedirs(os.path.dirname(target_file), exist_ok=True)
+        with open(target_file, 'wb') as f:
+            f.write(b'target')
+        
+        response = test_client.post("/images/bulk", json={
+            "image_ids": image_ids,
+            "action": "move",
+            "gallery_id": target['id']
+        })
+        
+        assert response.json()["success"] is False
+        assert "photo0.jpg" in response.json()["error"]
+        rows = self._fetch('SELECT gallery_id FROM images WHERE id IN (?, ?)', tuple(image_ids))
+        assert all(row['gallery_id'] == sample_gallery['id'] for row in rows)
+        with open(target_file, 'rb') as f:
+            assert f.read() == b'target'
+    
+    def test_bulk_unknown_action(self, test_client):
+        """Test that unknown actions are rejected"""
+        response = test_client.post("/images/bulk", json={"image_ids": [1], "action": "explode"})
+        assert response.json()["success"] is False
+
+class TestDeferredDeletion:
+    """Test the durable file deletion queue"""
+    
+    def _write_file(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'data')
+    
+    def test_delete_gallery_queues_files(self, test_client, sample_gallery):
+        """Test that gallery files are removed by the reaper, not the request"""
+        gallery_dir = f"static/gallery_{sample_gallery['id']}"
+        self._write_file(f"{gallery_dir}/queued.jpg")
+        self._write_file("static/thumbs/queued.jpg")
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        conn.execute('''INSERT INTO images (gallery_id, filename, title, sort_order) 
+                        VALUES (?, ?, ?, ?)''', (sample_gallery['id'], 'queued.jpg', 'Queued', 0))
+        conn.commit()
+        conn.close()
+        
+        response = test_client.post(f"/gallery/{sample_gallery['id']}/delete")
+        assert response.status_code == 303
+        assert not os.path.exists(gallery_dir)
+        assert test_client.get("/api/maintenance/deletions").json()["pending"] == 2
+        
+        # The live paths are free again: a same-named file written now must survive the reaper
+        self._write_file("static/thumbs/queued.jpg")
+        assert main.process_deletion_queue() == 2
+        assert os.path.exists("static/thumbs/queued.jpg")
+        assert test_client.get("/api/maintenance/deletions").json()["pending"] == 0
+        os.remove("static/thumbs/queued.jpg")
+    
+    def test_missing_paths_are_cleared(self, test_client):
+        """Test that already-deleted paths do not block the queue"""
+        conn = main.get_db()
+        main.queue_file_deletions(conn.cursor(), ["static/thumbs/does-not-exist.jpg"])
+        conn.commit()
+        conn.close()
+        
+        assert main.process_deletion_queue() == 1
+        assert main.get_deletion_backlog()["pending"] == 0
+    
+    def test_recover_trash_queues_orphans(self, test_client, monkeypatch, tmp_path):
+        """Test that trash left behind by a crash is picked up again"""
+        trash_dir = tmp_path / "trash"
+        monkeypatch.setattr(main, "TRASH_DIR", str(trash_dir))
+        self._write_file(str(trash_dir / "1_thumbs" / "a.jpg"))
+        
+        main.recover_trash()
+        main.recover_trash()  # Already queued paths are not queued twice
+        
+        assert main.get_deletion_backlog()["pending"] == 1
+        main.process_deletion_queue()
+        assert os.listdir(trash_dir) == []
+
+class TestUploadDownscale:
+    """Test downscaling uploads to max_image_width/height"""
+    
+    def _upload(self, test_client, gallery_id, size, filename="large.jpg"):
+        img = Image.new('RGB', size, color='blue')
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='JPEG', quality=95)
+        img_bytes.seek(0)
+        response = test_client.post(f"/gallery/{gallery_id}/upload-multiple",
+                                    files=[("files", (filename, img_bytes, "image/jpeg"))])
+        assert response.json()["results"][0]["success"] is True
+        return len(img_bytes.getvalue())
+    
+    def test_large_upload_is_downscaled(self, test_client, sample_gallery, monkeypatch, tmp_path):
+        """Test that uploads beyond the bounds are resized, keeping aspect ratio"""
+        monkeypatch.setattr(main, "ORIGINALS_ARCHIVE_DIR", str(tmp_path))
+        main.set_setting('downscale_uploads_enabled', True, 'boolean')
+        main.set_setting('max_image_width', 400, 'integer')
+        main.set_setting('max_image_height', 400, 'integer')
+        
+        self._upload(test_client, sample_gallery['id'], (1600, 800))
+        
+        with Image.open(f"static/gallery_{sample_gallery['id']}/large.jpg") as img:
+            assert img.size == (400, 200)
+    
+    def test_original_archived_by_default(self, test_client, sample_gallery, monkeypatch, tmp_path):
+        """Test that the untouched original is kept in the archive unless archiving is turned off"""
+        monkeypatch.setattr(main, "ORIGINALS_ARCHIVE_DIR", str(tmp_path))
+        main.set_setting('downscale_uploads_enabled', True, 'boolean')
+        main.set_setting('max_image_width', 400, 'integer')
+        
+        original_size = self._upload(test_client, sample_gallery['id'], (1600, 800))
+        
+        archived = tmp_path / f"gallery_{sample_gallery['id']}" / "large.jpg"
+        assert archived.stat().st_size == original_size
+        assert test_client.get("/api/storage").json()["archived_originals"] == original_size
+    
+    def test_downscaling_is_off_by_default(self, test_client, sample_gallery):
+        """Test that uploads are stored as sent until downscaling is turned on"""
+        main.set_setting('max_image_width', 400, 'integer')
+        
+        original_size = self._upload(test_client, sample_gallery['id'], (1600, 800))
+        
+        assert os.path.getsize(f"static/gallery_{sample_gallery['id']}/large.jpg") == original_size
+
+    def test_legacy_auto_resize_setting_is_dropped(self, test_client):
+        """Test that an existing install's always-on auto_resize_enabled does not turn downscaling on"""
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        conn.execute("""INSERT INTO app_settings (setting_key, setting_value, setting_type, category) 
+                        VALUES ('auto_resize_enabled', 'true', 'boolean', 'image_processing')""")
+        conn.execute('PRAGMA user_version = 0')
+        conn.commit()
+        
+        main.startup()
+        
+        assert conn.execute("SELECT COUNT(*) FROM app_settings WHERE setting_key='auto_resize_enabled'").fetchone()[0] == 0
+        conn.close()
+        assert main.get_upload_resize_config() is None
+
+class TestUploadEvents:
+    """Test per-file Server-Sent Events for batch uploads"""
+    
+    def _events(self, body):
+        events = []
+        for frame in body.strip().split("\n\n"):
+            lines = dict(line.split(": ", 1) for line in frame.splitlines())
+            events.append((lines["event"], json.loads(lines["data"])))
+        return events
+    
+    def test_upload_stream_emits_per_file_events(self, test_client, sample_gallery, sample_image):
+        """Test that each file reports its stages in order and committed files carry their card"""
+        files = [("files", sample_image)]
+        
+        response = test_client.post(f"/gallery/{sample_gallery['id']}/upload-stream", files=files)
+        
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = self._events(response.text)
+        first = [event for event, data in events if data.get("index") == 0]
+        assert first == ["received", "exif", "thumbnail", "committed"]
+        committed = next(data for event, data in events if event == "committed")
+        assert f'id="img-{committed["image_id"]}"' in committed["html"]
+        assert events[-1] == ("done", {"total": 1, "committed": 1, "failed": 0})
+        
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        assert conn.execute('SELECT COUNT(*) FROM images WHERE id=?', (committed["image_id"],)).fetchone()[0] == 1
+        conn.close()
+    
+    def test_failed_file_reported(self, test_client, sample_gallery, monkeypatch):
+        """Test that a file that cannot be stored produces a failed event and the batch continues"""
+        original_store = main.store_uploaded_image
+        
+        def failing_store(gallery_id, filename, *args, **kwargs):
+            if filename == "bad.jpg":
+                raise OSError("disk full")
+            return original_store(gallery_id, filename, *args, **kwargs)
+        
+        monkeypatch.setattr(main, "store_uploaded_image", failing_store)
+        files = [("files", (name, io.BytesIO(b"data"), "image/jpeg")) for name in ("bad.jpg", "good.jpg")]
+        
+        events = self._events(test_client.post(f"/gallery/{sample_gallery['id']}/upload-stream", files=files).text)
+        
+        assert ("failed", {"index": 0, "filename": "bad.jpg", "error": "disk full"}) in events
+        assert any(event == "committed" and data["filename"] == "good.jpg" for event, data in events)
+        assert events[-1] == ("done", {"total": 2, "committed": 1, "failed": 1})
+
+@pytest.mark.usefixtures("clean_static_images")
+class TestResumableUploads:
+    """Test the chunked, resumable upload API"""
+    
+    @pytest.fixture(autouse=True)
+    def staging_dir(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(main, "UPLOAD_STAGING_DIR", str(tmp_path / "uploads"))
+    
+    def _jpeg(self, size=(800, 600)):
+        img = Image.new('RGB', size, color='green')
+        exif = Image.Exif()
+        exif[0x010F] = 'Canon'
+        exif[0x0110] = 'EOS R5'
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='JPEG', quality=95, exif=exif)
+        return img_bytes.getvalue()
+    
+    def _start(self, test_client, gallery_id, content, filename="big.jpg"):
+        response = test_client.post("/api/uploads", data={
+            "gallery_id": str(gallery_id), "filename": filename, "size": str(len(content))
+        })
+        assert response.json()["success"] is True
+        return response.json()["upload_id"]
+    
+    def test_chunked_upload_resumes_and_finalizes(self, test_client, sample_gallery):
+        """Test that chunks append at the stored offset and finalize runs the upload pipeline"""
+        content = self._jpeg()
+        upload_id = self._start(test_client, sample_gallery['id'], content)
+        half = len(content) // 2
+        
+        assert test_client.put(f"/api/uploads/{upload_id}?offset=0", content=content[:half]).json()["offset"] == half
+        # A retried chunk at a stale offset is refused with the offset to resume from
+        stale = test_client.put(f"/api/uploads/{upload_id}?offset=0", content=content[:half]).json()
+        assert stale["success"] is False and stale["offset"] == half
+        assert test_client.get(f"/api/uploads/{upload_id}").json()["offset"] == half
+        assert test_client.post(f"/api/uploads/{upload_id}/finalize").json()["error"] == "Upload incomplete"
+        
+        test_client.put(f"/api/uploads/{upload_id}?offset={half}", content=content[half:])
+        result = test_client.post(f"/api/uploads/{upload_id}/finalize").json()
+        
+        assert result["success"] is True and result["camera_type"] == "Canon EOS R5"
+        gallery_dir = f"static/gallery_{sample_gallery['id']}"
+        with open(f"{gallery_dir}/{result['filename']}", "rb") as f:
+            assert f.read() == content
+        assert not os.listdir(main.UPLOAD_STAGING_DIR)
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        row = conn.execute('SELECT file_size, thumb_size, width FROM images WHERE id=?', (result["image_id"],)).fetchone()
+        assert conn.execute('SELECT COUNT(*) FROM upload_sessions').fetchone()[0] == 0
+        conn.close()
+        assert row[0] == len(content) and row[1] > 0 and row[2] == 800
+        assert test_client.get(f"/api/uploads/{upload_id}").json()["success"] is False
+    
+    def test_finalize_archives_downscaled_original(self, test_client, sample_gallery, monkeypatch, tmp_path):
+        """Test that a finalized upload that gets downscaled moves the received file into the archive"""
+        monkeypatch.setattr(main, "ORIGINALS_ARCHIVE_DIR", str(tmp_path))
+        main.set_setting('downscale_uploads_enabled', True, 'boolean')
+        main.set_setting('max_image_width', 400, 'integer')
+        main.set_setting('archive_original_uploads', True, 'boolean')
+        content = self._jpeg((1600, 800))
+        upload_id = self._start(test_client, sample_gallery['id'], content)
+        
+        test_client.put(f"/api/uploads/{upload_id}?offset=0", content=content)
+        result = test_client.post(f"/api/uploads/{upload_id}/finalize").json()
+        assert result["success"] is True
+        
+        assert (tmp_path / f"gallery_{sample_gallery['id']}" / result["filename"]).read_bytes() == content
+        with Image.open(f"static/gallery_{sample_gallery['id']}/{result['filename']}") as img:
+            assert img.size == (400, 200)
+        assert os.listdir(main.UPLOAD_STAGING_DIR) == []
+    
+    def test_abort_and_oversized_chunk(self, test_client, sample_gallery):
+        """Test that chunks beyond the declared size are refused and aborting removes the partial file"""
+        content = self._jpeg()
+        upload_id = self._start(test_client, sample_gallery['id'], content)
+        
+        response = test_client.put(f"/api/uploads/{upload_id}?offset=0", content=content + b"extra").json()
+        assert response["success"] is False and response["offset"] == 0
+        
+        assert test_client.delete(f"/api/uploads/{upload_id}").json()["success"] is True
+        assert not os.path.exists(os.path.join(main.UPLOAD_STAGING_DIR, f"{upload_id}.part"))
+    
+    def test_failed_finalize_can_be_retried(self, test_client, sample_gallery, monkeypatch):
+        """Test that a finalize that fails mid-processing leaves the staged file and session for a retry"""
+        content = self._jpeg()
+        upload_id = self._start(test_client, sample_gallery['id'], content, filename="retry.jpg")
+        test_client.put(f"/api/uploads/{upload_id}?offset=0", content=content)
+        
+        def failing_downscale(source, resize_config):
+            raise MemoryError("out of memory")
+        
+        downscale_image_bytes = main.downscale_image_bytes
+        monkeypatch.setattr(main, "downscale_image_bytes", failing_downscale)
+        assert test_client.post(f"/api/uploads/{upload_id}/finalize").json()["success"] is False
+        monkeypatch.setattr(main, "downscale_image_bytes", downscale_image_bytes)
+        assert test_client.get(f"/api/uploads/{upload_id}").json()["offset"] == len(content)
+        
+        result = test_client.post(f"/api/uploads/{upload_id}/finalize").json()
+        assert result["success"] is True
+        with open(f"static/gallery_{sample_gallery['id']}/{result['filename']}", "rb") as f:
+            assert f.read() == content
+    
+    def test_finalize_does_not_overwrite_existing_image(self, test_client, sample_gallery):
+        """Test that an upload named like an existing image is stored under a new name"""
+        gallery_dir = f"static/gallery_{sample_gallery['id']}"
+        os.makedirs(gallery_dir, exist_ok=True)
+        with open(f"{gallery_dir}/taken.jpg", "wb") as f:
+            f.write(b"existing")
+        content = self._jpeg()
+        upload_id = self._start(test_client, sample_gallery['id'], content, filename="taken.jpg")
+        test_client.put(f"/api/uploads/{upload_id}?offset=0", content=content)
+        
+        result = test_client.post(f"/api/uploads/{upload_id}/finalize").json()
+        
+        assert result["filename"] == "taken-2.jpg"
+        with open(f"{gallery_dir}/taken.jpg", "rb") as f:
+            assert f.read() == b"existing"
+
+class TestImagePlaceholders:
+    """Test upload-time placeholders and dominant colours"""
+    
+    def _placeholder_row(self):
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        row = conn.execute('SELECT placeholder, dominant_color FROM images ORDER BY id DESC LIMIT 1').fetchone()
+        conn.close()
+        return row
+    
+    def test_upload_stores_placeholder(self, test_client, sample_gallery):
+        """Test that uploads record a tiny data URI and the average colour"""
+        img_bytes = io.BytesIO()
+        Image.new('RGB', (800, 600), color=(200, 30, 30)).save(img_bytes, format='PNG')
+        img_bytes.seek(0)
+        test_client.post(f"/gallery/{sample_gallery['id']}/upload-multiple",
+                         files=[("files", ("red.png", img_bytes, "image/png"))])
+        
+        placeholder, dominant_color = self._placeholder_row()
+        assert placeholder.startswith('data:image/jpeg;base64,')
+        assert len(placeholder) < 1500
+        r, g, b = (int(dominant_color[i:i + 2], 16) for i in (1, 3, 5))
+        assert r > 180 and g < 60 and b < 60
+    
+    def test_backfill_uses_thumbnail(self, test_client, sample_gallery):
+        """Test that rows without a placeholder are filled from their thumbnail"""
+        os.makedirs("static/thumbs", exist_ok=True)
+        Image.new('RGB', (40, 40), color=(0, 0, 255)).save("static/thumbs/old.png")
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        conn.execute('INSERT INTO images (gallery_id, filename, enabled, sort_order) VALUES (?, ?, 1, 0)',
+                     (sample_gallery['id'], 'old.png'))
+        conn.commit()
+        conn.close()
+        
+        assert main.backfill_image_placeholders() == 1
+        assert self._placeholder_row()[1] == '#0000ff'
+        assert main.backfill_image_placeholders() == 0
+
+class TestImageDimensions:
+    """Test stored image dimensions and EXIF orientation"""
+    
+    def _dimensions(self):
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        row = conn.execute('SELECT width, height, orientation FROM images ORDER BY id DESC LIMIT 1').fetchone()
+        conn.close()
+        return row
+    
+    def test_upload_records_rotated_dimensions(self, test_client, sample_gallery):
+        """Test that a 90-degree EXIF orientation swaps the stored width and height"""
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        img_bytes = io.BytesIO()
+        Image.new('RGB', (300, 200), color='green').save(img_bytes, format='JPEG', exif=exif)
+        img_bytes.seek(0)
+        test_client.post(f"/gallery/{sample_gallery['id']}/upload-multiple",
+                         files=[("files", ("rotated.jpg", img_bytes, "image/jpeg"))])
+        
+        assert self._dimensions() == (200, 300, 6)
+        with Image.open("static/thumbs/rotated.jpg") as thumb:
+            assert thumb.size == (200, 300)
+    
+    def test_watermarked_export_is_upright(self, tmp_path):
+        """Test that watermarked copies, which carry no EXIF, have the orientation applied to their pixels"""
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        Image.new('RGB', (300, 200), color='green').save(tmp_path / "rotated.jpg", exif=exif)
+        
+        main.apply_watermark_to_image(str(tmp_path / "rotated.jpg"), str(tmp_path / "out.jpg"),
+                                      main.get_default_watermark_config())
+        
+        with Image.open(tmp_path / "out.jpg") as out:
+            assert out.size == (200, 300)
+    
+    def test_backfill_reads_image_header(self, test_client, sample_gallery):
+        """Test that rows without dimensions are filled in from the stored file"""
+        gallery_dir = f"static/gallery_{sample_gallery['id']}"
+        os.makedirs(gallery_dir, exist_ok=True)
+        Image.new('RGB', (120, 80)).save(f"{gallery_dir}/old.png")
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        conn.execute('INSERT INTO images (gallery_id, filename, enabled, sort_order) VALUES (?, ?, 1, 0)',
+                     (sample_gallery['id'], 'old.png'))
+        conn.commit()
+        conn.close()
+        
+        assert main.backfill_image_dimensions() == 1
+        assert self._dimensions() == (120, 80, 1)
+
+class TestStorageAccounting:
+    """Test byte tracking and storage limit enforcement"""
+    
+    GB = 1024 ** 3
+    
+    def _add_site(self, filename, size, created_at, last_accessed_at=None):
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        conn.execute('''INSERT INTO generated_sites (filename, file_size, created_at, last_accessed_at) 
+                        VALUES (?, ?, ?, ?)''', (filename, size, created_at, last_accessed_at))
+        conn.commit()
+        conn.close()
+    
+    def _site_filenames(self):
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        rows = conn.execute('SELECT filename FROM generated_sites ORDER BY id').fetchall()
+        conn.close()
+        return [row[0] for row in rows]
+    
+    def test_upload_records_sizes(self, test_client, sample_gallery, sample_image):
+        """Test that uploads record original and thumbnail sizes"""
+        filename, file_data, content_type = sample_image
+        expected_size = len(file_data.getvalue())
+        
+        test_client.post(f"/gallery/{sample_gallery['id']}/upload-multiple",
+                         files=[("files", (filename, file_data, content_type))])
+        
+        usage = test_client.get("/api/storage").json()
+        assert usage["originals"] == expected_size
+        assert usage["thumbnails"] > 0
+        assert usage["galleries"][str(sample_gallery['id'])] == usage["originals"] + usage["thumbnails"]
+    
+    def test_threshold_evicts_least_recently_used(self, test_client):
+        """Test that archives are evicted by last use until under the threshold"""
+        main.set_setting('storage_cleanup_threshold_gb', 2, 'integer')
+        main.set_setting('file_retention_days', 0, 'integer')
+        self._add_site('old.zip', self.GB, '2024-01-01 00:00:00', '2024-06-01 00:00:00')
+        self._add_site('stale.zip', self.GB, '2024-03-01 00:00:00')
+        self._add_site('new.zip', self.GB, '2024-02-01 00:00:00', '2024-07-01 00:00:00')
+        stale_path = os.path.join(main.GENERATED_SITES_DIR, 'stale.zip')
+        os.makedirs(main.GENERATED_SITES_DIR, exist_ok=True)
+        open(stale_path, 'wb').close()
+        
+        result = main.enforce_storage_limits()
+        
+        assert result["evicted_sites"] == 1
+        assert self._site_filenames() == ['old.zip', 'new.zip']
+        assert not os.path.exists(stale_path)
+        assert main.get_deletion_backlog()["pending"] == 1
+    
+    def test_retention_evicts_old_sites(self, test_client):
+        """Test that archives older than file_retention_days are evicted"""
+        main.set_setting('file_retention_days', 30, 'integer')
+        self._add_site('ancient.zip', 10, '2000-01-01 00:00:00')
+        self._add_site('fresh.zip', 10, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+        
+        result = main.enforce_storage_limits()
+        
+        assert result["evicted_sites"] == 1
+        assert self._site_filenames() == ['fresh.zip']
+
+class TestGeneratedSiteListing:
+    """Test archive listing against the directory snapshot"""
+    
+    def _add_site(self, filename, manifest=None):
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        conn.execute('INSERT INTO generated_sites (site_title, theme, filename, file_size, manifest) VALUES (?, ?, ?, ?, ?)',
+                     (filename, 'minimal', filename, 4, manifest))
+        conn.commit()
+        conn.close()
+    
+    def test_snapshot_tracks_directory_changes(self, sites_dir):
+        """Test that the snapshot lists archives and notices new files"""
+        (sites_dir / "a.zip").write_bytes(b"data")
+        (sites_dir / "notes.txt").write_bytes(b"x")
+        assert main.get_archive_snapshot() == {"a.zip": (4, os.path.getmtime(sites_dir / "a.zip"))}
+        
+        (sites_dir / "b.zip").write_bytes(b"da")
+        main.invalidate_archive_snapshot()
+        assert set(main.get_archive_snapshot()) == {"a.zip", "b.zip"}
+    
+    def test_cleanup_diffs_rows_against_files(self, test_client, sites_dir):
+        """Test cleanup drops rows without files and queues files without rows"""
+        (sites_dir / "kept.zip").write_bytes(b"data")
+        (sites_dir / "orphan.zip").write_bytes(b"data")
+        self._add_site("kept.zip")
+        self._add_site("missing.zip")
+        
+        response = test_client.post("/generated-sites/cleanup")
+        assert response.status_code == 303
+        
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        filenames = [row[0] for row in conn.execute('SELECT filename FROM generated_sites')]
+        conn.close()
+        assert filenames == ["kept.zip"]
+        
+        main.process_deletion_queue()
+        assert set(main.get_archive_snapshot()) == {"kept.zip"}
+    
+    def test_listing_page_marks_missing_archives(self, test_client, sites_dir):
+        """Test that the listing page renders without per-row probes"""
+        (sites_dir / "kept.zip").write_bytes(b"data")
+        self._add_site("kept.zip")
+        self._add_site("missing.zip")
+        
+        response = test_client.get("/generated-sites")
+        assert response.status_code == 200
+        assert response.text.count("missing-file") == 1
+    
+    def test_patch_links_skip_builds_without_manifest(self, test_client, sites_dir):
+        """Test that each build links a patch against the next older build that has a manifest"""
+        for filename, manifest in (("1.zip", "{}"), ("2.zip", None), ("3.zip", "{}"), ("4.zip", "{}")):
+            (sites_dir / filename).write_bytes(b"data")
+            self._add_site(filename, manifest)
+        
+        links = re.findall(r'/generated-sites/(\d+)/delta\?since=(\d+)', test_client.get("/generated-sites").text)
+        
+        assert links == [("4", "3"), ("3", "1")]
+
+class TestStaticSiteGeneration:
+    """Test multi-page static site output"""
+    
+    def _generate(self, test_client, sites_dir, gallery_id, **form):
+        response = test_client.post("/generate/static", data={
+            "site_title": "Portfolio", "theme": "minimal", "gallery_ids": [str(gallery_id)], **form
+        })
+        assert response.status_code == 303
+        zip_name = response.headers["location"].split("zip=")[1].split("&")[0]
+        return zipfile.ZipFile(sites_dir / zip_name)
+    
+    def test_paginated_gallery_pages(self, test_client, sample_gallery, sites_dir, insert_images):
+        """Test that a landing page and one page per page_size images are written"""
+        insert_images(sample_gallery['id'], 5)
+        
+        with self._generate(test_client, sites_dir, sample_gallery['id'], page_size="2") as site:
+            gid = sample_gallery['id']
+            assert {'index.html', f'gallery-{gid}.html', f'gallery-{gid}-2.html', f'gallery-{gid}-3.html'} <= set(site.namelist())
+            landing = site.read('index.html').decode()
+            last_page = site.read(f'gallery-{gid}-3.html').decode()
+        
+        assert landing.count('images/photo') == 1
+        assert f'gallery-{gid}.html' in landing
+        assert 'images/photo4.jpg' in last_page
+        assert f'href="gallery-{gid}-2.html" rel="prev"' in last_page
+    
+    def test_page_size_zero_keeps_single_page(self, test_client, sample_gallery, sites_dir, insert_images):
+        """Test that page_size 0 renders every image into index.html"""
+        insert_images(sample_gallery['id'], 3)
+        
+        with self._generate(test_client, sites_dir, sample_gallery['id'], page_size="0") as site:
+            assert [n for n in site.namelist() if n.endswith('.html')] == ['index.html']
+            assert site.read('index.html').decode().count('images/photo') == 3
+    
+    def test_placeholder_inlined_in_theme(self, test_client, sample_gallery, sites_dir, insert_images):
+        """Test that themes paint the stored placeholder behind each image"""
+        insert_images(sample_gallery['id'], 1)
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        conn.execute("UPDATE images SET placeholder='data:image/jpeg;base64,AAAA', dominant_color='#123456'")
+        conn.commit()
+        conn.close()
+        
+        with self._generate(test_client, sites_dir, sample_gallery['id'], page_size="0") as site:
+            html = site.read('index.html').decode()
+        
+        assert "background: #123456 url('data:image/jpeg;base64,AAAA')" in html
+        assert 'loading="lazy"' in html
+    
+    def test_grid_theme_reserves_image_size(self, test_client, sample_gallery, sites_dir, insert_images):
+        """Test that stored dimensions become width/height and skip the per-image masonry measure"""
+        insert_images(sample_gallery['id'], 1)
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        conn.execute("UPDATE images SET width=640, height=480")
+        conn.commit()
+        conn.close()
+        
+        with self._generate(test_client, sites_dir, sample_gallery['id'], page_size="0", theme="grid") as site:
+            html = site.read('index.html').decode()
+        
+        assert 'width="640" height="480" style="aspect-ratio: auto 640 / 480;"' in html
+        assert 'onload="resizeGridItem' not in html
+    
+    def test_theme_assets_extracted_and_shared(self, test_client, sample_gallery, sites_dir, insert_images):
+        """Test that inline theme CSS/JS become hashed files shared by every page"""
+        insert_images(sample_gallery['id'], 3)
+        
+        with self._generate(test_client, sites_dir, sample_gallery['id'], page_size="2") as site:
+            names = site.namelist()
+            landing = site.read('index.html').decode()
+            gallery_page = site.read(f"gallery-{sample_gallery['id']}.html").decode()
+            stylesheet = re.search(r'href="(assets/[0-9a-f]{16}\.css)"', landing).group(1)
+            css = site.read(stylesheet).decode()
+        
+        assert '<style>' not in landing and '<script>' not in landing
+        assert stylesheet in gallery_page and stylesheet in names
+        assert '\n    ' not in landing and '\n ' not in css
+    
+    def test_asset_optimization_can_be_disabled(self, test_client, sample_gallery, sites_dir, insert_images):
+        """Test that turning the setting off keeps the rendered theme as-is"""
+        main.set_setting('optimize_site_assets', False, 'boolean')
+        insert_images(sample_gallery['id'], 1)
+        
+        with self._generate(test_client, sites_dir, sample_gallery['id'], page_size="0") as site:
+            assert not any(n.startswith('assets/') for n in site.namelist())
+            assert '<style>' in site.read('index.html').decode()
+    
+    def test_minifiers_leave_strings_and_statements_intact(self):
+        """Test that minification keeps quoted text and line-separated statements"""
+        css = main.minify_css('a:hover , b > c {\n  content: "x ,  y" ;\n  /* note */ color: red;\n}')
+        js = main.minify_js('    // setup\n    let a = 1\n\n    let b = a\n')
+        
+        assert css == 'a:hover,b>c{content:"x ,  y";color:red}'
+        assert js == 'let a = 1\nlet b = a'
+    
+    def test_js_minifier_leaves_literals_alone(self):
+        """Test that template literals, regexes and strings keep their whitespace and // text"""
+        js = ('    const card = `\n        <p>${ name }</p>\n        // shown as text\n\n    `;\n'
+              '    const quote = /\'/g, url = "//cdn"\n    // comment\n    let half = a / 2 / b\n')
+        
+        assert main.minify_js(js) == ('const card = `\n        <p>${ name }</p>\n        // shown as text\n\n    `;\n'
+                                      'const quote = /\'/g, url = "//cdn"\nlet half = a / 2 / b')
+    
+    def test_precompressed_siblings_reuse_cache(self, test_client, monkeypatch, tmp_path):
+        """Test that .gz siblings are written and unchanged files are not recompressed"""
+        monkeypatch.setattr(main, "PRECOMPRESS_CACHE_DIR", str(tmp_path / "cache"))
+        html = "<html>" + "<p>gallery</p>" * 200 + "</html>"
+        for build in ("first", "second"):
+            (tmp_path / build).mkdir()
+            (tmp_path / build / "index.html").write_text(html)
+            (tmp_path / build / "photo.jpg").write_bytes(b"jpeg")
+        
+        first = main.precompress_site_files(str(tmp_path / "first"))
+        second = main.precompress_site_files(str(tmp_path / "second"))
+        
+        assert (first["compressed"], second["compressed"]) == (len(main.precompress_encodings()), 0)
+        assert gzip.decompress((tmp_path / "second" / "index.html.gz").read_bytes()).decode() == html
+        assert not (tmp_path / "second" / "photo.jpg.gz").exists()
+        siblings = [path for path in (tmp_path / "second").iterdir() if path.suffix in (".gz", ".br")]
+        assert first["bytes"] == second["bytes"] == sum(path.stat().st_size for path in siblings)
+        assert test_client.get("/api/storage").json()["caches"]["precompressed"] > 0
+    
+    def test_precompress_regenerates_evicted_cache_file(self, test_client, monkeypatch, tmp_path):
+        """Test that a cache file evicted between lookup and use is compressed again"""
+        monkeypatch.setattr(main, "PRECOMPRESS_CACHE_DIR", str(tmp_path / "cache"))
+        html = "<html>" + "<p>gallery</p>" * 200 + "</html>"
+        for build in ("first", "second"):
+            (tmp_path / build).mkdir()
+            (tmp_path / build / "index.html").write_text(html)
+        main.precompress_site_files(str(tmp_path / "first"))
+        
+        link_or_copy = main.link_or_copy
+        def evict_then_link(src, dest):
+            if src.startswith(main.PRECOMPRESS_CACHE_DIR) and not src.endswith(".tmp"):
+                os.remove(src)  # the janitor got there first
+            link_or_copy(src, dest)
+        monkeypatch.setattr(main, "link_or_copy", evict_then_link)
+        
+        second = main.precompress_site_files(str(tmp_path / "second"))
+        
+        assert second["compressed"] == len(main.precompress_encodings())
+        assert gzip.decompress((tmp_path / "second" / "index.html.gz").read_bytes()).decode() == html
+        assert (tmp_path / "cache").is_dir() and len(os.listdir(tmp_path / "cache")) == second["compressed"]
+    
+    def test_generate_writes_precompressed_files(self, test_client, sample_gallery, sites_dir, monkeypatch, tmp_path, insert_images):
+        """Test that enabling the setting adds .gz files to the archive"""
+        monkeypatch.setattr(main, "PRECOMPRESS_CACHE_DIR", str(tmp_path / "cache"))
+        main.set_setting('precompress_site_files', True, 'boolean')
+        insert_images(sample_gallery['id'], 1)
+        
+        with self._generate(test_client, sites_dir, sample_gallery['id'], page_size="0") as site:
+            names = site.namelist()
+        
+        assert 'index.html.gz' in names
+        assert any(n.startswith('assets/') and n.endswith('.css.gz') for n in names)
+    
+    def test_sync_site_directory_applies_deltas(self, tmp_path):
+        """Test that only changed files are rewritten and removed files are deleted"""
+        target = tmp_path / "deploy"
+        first, second = tmp_path / "build1", tmp_path / "build2"
+        for build in (first, second):
+            (build / "images").mkdir(parents=True)
+        (first / "index.html").write_text("v1")
+        (first / "images" / "a.jpg").write_bytes(b"a")
+        (first / "images" / "old.jpg").write_bytes(b"old")
+        (second / "index.html").write_text("v2")
+        os.link(first / "images" / "a.jpg", second / "images" / "a.jpg")
+        (second / "images" / "new.jpg").write_bytes(b"new")
+        
+        assert sorted(main.sync_site_directory(str(first), str(target))["added"]) == ["images/a.jpg", "images/old.jpg", "index.html"]
+        changes = main.sync_site_directory(str(second), str(target))
+        
+        assert changes == {"added": ["images/new.jpg"], "changed": ["index.html"],
+                           "removed": ["images/old.jpg"], "unchanged": 1}
+        assert not (target / "images" / "old.jpg").exists()
+        assert (target / "index.html").read_text() == "v2"
+        assert (target / "images" / "new.jpg").stat().st_ino == (second / "images" / "new.jpg").stat().st_ino
+        assert set(main.load_site_manifest(str(target))) == {"index.html", "images/a.jpg", "images/new.jpg"}
+    
+    def test_generate_into_deploy_directory(self, test_client, sample_gallery, sites_dir, tmp_path, insert_images):
+        """Test that rebuilding an unchanged site into the configured deploy directory changes nothing"""
+        insert_images(sample_gallery['id'], 2)
+        target = tmp_path / "deploy"
+        main.set_setting('deploy_directory', str(target))
+        form = {"site_title": "Portfolio", "theme": "minimal", "gallery_ids": [str(sample_gallery['id'])],
+                "page_size": "0", "output_mode": "directory"}
+        
+        first = test_client.post("/generate/static", data=form)
+        second = test_client.post("/generate/static", data=form)
+        
+        assert all(r.headers["location"].startswith("/generate?success=Synced") for r in (first, second))
+        assert (target / "index.html").exists()
+        assert json.loads((target / main.SITE_CHANGES_NAME).read_text())["added"] == []
+        assert json.loads((target / main.SITE_CHANGES_NAME).read_text())["changed"] == []
+        assert not list(sites_dir.glob("*.zip"))
+    
+    def test_deploy_directory_not_taken_from_request(self, test_client, sample_gallery, sites_dir, tmp_path, insert_images):
+        """Test that a deploy_dir sent with the form is ignored in favour of the setting"""
+        insert_images(sample_gallery['id'], 1)
+        posted = tmp_path / "elsewhere"
+        form = {"site_title": "Portfolio", "theme": "minimal", "gallery_ids": [str(sample_gallery['id'])],
+                "page_size": "0", "output_mode": "directory", "deploy_dir": str(posted)}
+        
+        response = test_client.post("/generate/static", data=form)
+        
+        assert response.headers["location"].startswith("/generate?error=No%20deploy%20directory")
+        assert not posted.exists()
+    
+    def test_delta_between_builds(self, test_client, sample_gallery, sites_dir, monkeypatch, tmp_path, insert_images):
+        """Test that a delta holds only changed files and lists removed ones"""
+        monkeypatch.setattr(main, "DELTA_CACHE_DIR", str(tmp_path / "deltas"))
+        gid = sample_gallery['id']
+        insert_images(gid, 2)
+        os.makedirs(f"static/gallery_{gid}", exist_ok=True)
+        for i in range(2):
+            Image.new('RGB', (20, 20), color='red').save(f"static/gallery_{gid}/photo{i}.jpg")
+        
+        self._generate(test_client, sites_dir, gid, page_size="0").close()
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        conn.execute("UPDATE images SET enabled=0 WHERE filename='photo1.jpg'")
+        conn.commit()
+        conn.close()
+        self._generate(test_client, sites_dir, gid, page_size="0").close()
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        base_id, site_id = [row[0] for row in conn.execute('SELECT id FROM generated_sites ORDER BY id')]
+        conn.close()
+        
+        response = test_client.get(f"/generated-sites/{site_id}/delta?since={base_id}")
+        
+        assert response.status_code == 200
+        with zipfile.ZipFile(io.BytesIO(response.content)) as delta:
+            changes = json.loads(delta.read(main.SITE_CHANGES_NAME))
+            assert set(delta.namelist()) == {main.SITE_CHANGES_NAME, 'index.html'}
+        assert changes == {'added': [], 'changed': ['index.html'], 'removed': ['images/photo1.jpg']}
+        assert f'delta?since={base_id}' in test_client.get("/generated-sites").text
+    
+    def test_build_profile_stored_and_shown(self, test_client, sample_gallery, sites_dir, insert_images):
+        """Test that stage timings, bytes and slowest images are saved with the site and shown on the results page"""
+        insert_images(sample_gallery['id'], 3)
+        response = test_client.post("/generate/static", data={
+            "site_title": "Portfolio", "theme": "minimal", "gallery_ids": [str(sample_gallery['id'])]
+        })
+        zip_name = response.headers["location"].split("zip=")[1].split("&")[0]
+        
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        profile = json.loads(conn.execute('SELECT build_profile FROM generated_sites WHERE filename=?',
+                                          (zip_name,)).fetchone()[0])
+        conn.close()
+        stages = {stage['name']: stage for stage in profile['stages']}
+        assert {'load', 'images', 'render', 'manifest', 'zip', 'record'} <= set(stages)
+        assert stages['render']['bytes'] > 0
+        assert stages['zip']['bytes'] == (sites_dir / zip_name).stat().st_size
+        assert sorted(image['filename'] for image in profile['slowest_images']) == ['photo0.jpg', 'photo1.jpg', 'photo2.jpg']
+        
+        page = test_client.get(response.headers["location"])
+        assert "Build Profile" in page.text
+        assert "Slowest images" in page.text and "photo0.jpg" in page.text
+    
+    def test_build_cli_syncs_without_server(self, test_client, sample_gallery, tmp_path, capsys, insert_images):
+        """Test that `python -m app.build` runs the pipeline and reports stage timings"""
+        from app import build
+        insert_images(sample_gallery['id'], 2)
+        target = tmp_path / "deploy"
+        
+        exit_code = build.main_cli([str(sample_gallery['id']), "--db", TestConfig.TEST_DB, "--theme", "grid",
+                                    "--page-size", "0", "--output", "directory", "--deploy-dir", str(target),
+                                    "--workers", "2"])
+        
+        output = capsys.readouterr().out
+        assert exit_code == 0
+        assert (target / "index.html").exists()
+        assert "Built 1 galleries, 2 images with the grid theme" in output
+        assert all(stage in output for stage in ("load", "images", "render", "sync", "total"))
+    
+    def test_build_cli_rejects_unknown_galleries(self, test_client, capsys):
+        """Test that a build with nothing to include exits with an error"""
+        from app import build
+        
+        assert build.main_cli(["999", "--db", TestConfig.TEST_DB]) == 2
+        assert "No galleries selected" in capsys.readouterr().err
+    
+    def test_plan_site_pages_uses_featured_cover(self):
+        """Test that the landing page cover is the featured image"""
+        gallery = {'id': 7, 'title': 'G', 'featured_image_id': 2,
+                   'images': [{'id': 1}, {'id': 2}, {'id': 3}]}
+        
+        pages = main.plan_site_pages([gallery], 2)
+        
+        assert [name for name, _ in pages] == ['index.html', 'gallery-7.html', 'gallery-7-2.html']
+        landing = pages[0][1]['galleries'][0]
+        assert landing['images'] == [{'id': 2}]
+        assert (landing['image_count'], landing['page_count']) == (3, 2)
+        assert pages[2][1]['pagination']['prev_url'] == 'gallery-7.html'
+
+class TestStartup:
+    """Test startup cost guards"""
+    
+    def test_startup_skips_current_schema(self, test_client):
+        """Test that startup() does nothing once the stored schema fingerprint is current"""
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == main.SCHEMA_FINGERPRINT
+        conn.execute("DELETE FROM app_settings WHERE setting_key='gallery_page_size'")
+        conn.commit()
+        
+        main.startup()
+        assert conn.execute("SELECT COUNT(*) FROM app_settings WHERE setting_key='gallery_page_size'").fetchone()[0] == 0
+        
+        conn.execute('PRAGMA user_version = 0')
+        conn.commit()
+        main.startup()
+        assert conn.execute("SELECT COUNT(*) FROM app_settings WHERE setting_key='gallery_page_size'").fetchone()[0] == 1
+        conn.close()
+    
+    def test_startup_respaces_dense_ranks(self, test_client, sample_gallery, insert_images):
+        """Test that a schema upgrade respaces legacy 0, 1, 2... ranks once, keeping the order"""
+        step = main.RANK_STEP
+        dense_ids = insert_images(sample_gallery['id'], sort_order=[2, 0, 1])
+        test_client.post("/create-gallery", data={"title": "Sparse"})
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        sparse_gallery = conn.execute("SELECT id FROM galleries WHERE title='Sparse'").fetchone()[0]
+        sparse_ids = insert_images(sparse_gallery, sort_order=[0, 5 * step])
+        conn.execute('PRAGMA user_version = 0')
+        conn.commit()
+        
+        main.startup()
+        
+        ranks = dict(conn.execute('SELECT id, sort_order FROM images').fetchall())
+        conn.close()
+        assert [ranks[i] for i in dense_ids] == [2 * step, 0, step]
+        assert [ranks[i] for i in sparse_ids] == [0, 5 * step]
+    
+    def test_import_defers_image_libraries(self):
+        """Test that importing the app does not load Pillow or exifread"""
+        code = "import sys, app.main; print(sorted(m for m in ('PIL', 'exifread') if m in sys.modules))"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        
+        assert result.stdout.strip() == "[]"
+
+class TestMetrics:
+    """Test the /metrics endpoint"""
+    
+    def test_metrics_records_routes_and_queries(self, test_client, sample_gallery):
+        """Test that requests are counted per route template with their SQLite queries"""
+        main.metrics.reset()
+        assert test_client.get(f"/gallery/{sample_gallery['id']}").status_code == 200
+        test_client.get("/no-such-page")
+        
+        response = test_client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        body = response.text
+        assert 'http_requests_total{method="GET",route="/gallery/{gallery_id}",status="200"} 1' in body
+        assert 'route="unmatched",status="404"' in body
+        assert 'http_request_duration_seconds_count{method="GET",route="/gallery/{gallery_id}"} 1' in body
+        queries = re.search(r'sqlite_queries_total\{route="/gallery/\{gallery_id\}"\} (\d+)', body)
+        assert queries and int(queries.group(1)) > 0
+        size = re.search(r'http_response_bytes_total\{method="GET",route="/gallery/\{gallery_id\}"\} (\d+)', body)
+        assert size and int(size.group(1)) > 0
+        assert "http_requests_in_flight 1" in body  # the /metrics request itself
+
+class TestEventLoopLatency:
+    """Test that async routes keep blocking database work off the event loop"""
+    
+    def _max_loop_lag(self, requests):
+        """Run the requests concurrently against the app; return the worst event loop stall in seconds"""
+        import asyncio
+        import httpx
+        
+        async def run():
+            lags = []
+            done = asyncio.Event()
+            
+            async def probe():
+                while not done.is_set():
+                    start = time.perf_counter()
+                    await asyncio.sleep(0.005)
+                    lags.append(time.perf_counter() - start - 0.005)
+            
+            probe_task = asyncio.create_task(probe())
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+                responses = await asyncio.gather(*(client.post(url, **kwargs) for url, kwargs in requests))
+            done.set()
+            await probe_task
+            return max(lags), responses
+        
+        return asyncio.run(run())
+    
+    def test_settings_update_does_not_block_loop(self, test_client, monkeypatch):
+        """Test that slow setting writes run on the database pool rather than the event loop"""
+        original_set_setting = main.set_setting
+        
+        def slow_set_setting(*args):
+            time.sleep(0.02)
+            return original_set_setting(*args)
+        
+        monkeypatch.setattr(main, "set_setting", slow_set_setting)
+        requests = [("/settings/update", {"data": {"watermark_text": f"Site {i}"}}) for i in range(4)]
+        
+        lag, responses = self._max_loop_lag(requests)
+        
+        assert all(response.status_code == 303 for response in responses)
+        assert main.get_setting("watermark_text", "").startswith("Site ")
+        # Each request spends well over 0.2s in set_setting; none of it may stall the loop
+        assert lag < 0.1
+    
+    def test_reorder_runs_on_db_pool(self, test_client, sample_gallery, monkeypatch):
+        """Test that reorder writes happen on the dedicated database threads"""
+        threads = []
+        original_save = main.save_image_order
+        
+        def recording_save(*args):
+            threads.append(threading.current_thread().name)
+            return original_save(*args)
+        
+        monkeypatch.setattr(main, "save_image_order", recording_save)
+        response = test_client.post(f"/gallery/{sample_gallery['id']}/reorder", json={"image_order": []})
+        
+        assert response.json() == {"success": True}
+        assert threads and threads[0].startswith("gallery-db")
+
+class TestSampleImages:
+    """Test the watermark preview sample endpoint"""
+    
+    def test_samples_are_distinct_enabled_images(self, test_client, sample_gallery, insert_images):
+        """Test that up to three distinct enabled images are returned, sized for the preview box"""
+        insert_images(sample_gallery['id'], enabled=[1, 0, 1, 0, 1, 1, 1], dims=(3000, 2000))
+        
+        enabled_urls = {f"/static/thumbs/photo{i}.jpg" for i in (0, 2, 4, 5, 6)}
+        
+        for seed in range(20):
+            main.random.seed(seed)
+            images = test_client.get("/api/sample-images").json()["images"]
+            urls = [image["url"] for image in images]
+            assert len(urls) == 3 and len(set(urls)) == 3
+            assert set(urls) <= enabled_urls
+        assert (images[0]["width"], images[0]["height"]) == (400, 267)
+    
+    def test_small_library_returns_every_enabled_image(self, test_client, sample_gallery, insert_images):
+        """Test that a library with fewer enabled images than requested returns all of them"""
+        insert_images(sample_gallery['id'], enabled=[0, 1, 0], dims=(3000, 2000))
+        
+        images = test_client.get("/api/sample-images").json()["images"]
+        
+        assert [image["url"] for image in images] == ["/static/thumbs/photo1.jpg"]
+    
+    def test_sparse_enabled_images_fill_the_sample(self, test_client, sample_gallery, insert_images, monkeypatch):
+        """Test that probes that keep hitting the same image are topped up to a full sample"""
+        insert_images(sample_gallery['id'], enabled=[0] * 200 + [1, 1, 1])
+        monkeypatch.setattr(main.random, "randint", lambda low, high: low)
+        
+        urls = [image["url"] for image in test_client.get("/api/sample-images").json()["images"]]
+        
+        assert urls == [f"/static/thumbs/photo{i}.jpg" for i in (200, 201, 202)]
+    
+    def test_preview_dimensions(self):
+        """Test that preview sizes follow the thumbnail and then the 400x300 preview box"""
+        assert main.preview_dimensions(3000, 2000) == (400, 267)
+        assert main.preview_dimensions(2000, 3000) == (200, 300)
+        assert main.preview_dimensions(200, 100) == (200, 100)
+        assert main.preview_dimensions(None, None) == (None, None)
+
+class TestWatermarkPreview:
+    """Test server-rendered, cached watermark previews"""
+    
+    def test_preview_rendered_on_thumbnail_and_cached(self, test_client, sample_gallery, monkeypatch, tmp_path):
+        """Test that previews are thumbnail-sized, watermarked, and cached per image and config"""
+        monkeypatch.setattr(main, "WATERMARK_PREVIEW_CACHE_DIR", str(tmp_path))
+        image_id = upload_image(test_client, sample_gallery['id'], "wm.jpg", Image.new('RGB', (1600, 1200), 'gray'))["image_id"]
+        url = f"/api/watermark-preview/{image_id}?text=PREVIEW&opacity=100&font_size=120"
+        
+        response = test_client.get(url)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/jpeg"
+        with Image.open(io.BytesIO(response.content)) as preview:
+            assert preview.size == (400, 300)
+            # Bottom-right holds the (dark background, white text) watermark; the top-left is untouched gray
+            corner = preview.convert('L').crop((250, 250, 400, 300))
+            assert min(corner.getdata()) < 60 and max(corner.getdata()) > 200
+            assert abs(preview.convert('L').getpixel((10, 10)) - 128) < 10
+        
+        test_client.get(url)
+        test_client.get(url.replace("opacity=100", "opacity=50"))
+        assert len(list(tmp_path.iterdir())) == 2
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        rows = conn.execute("SELECT COUNT(*) FROM derivative_cache WHERE kind='watermark_preview'").fetchone()[0]
+        conn.close()
+        assert rows == 2
+    
+    def test_reset_does_not_serve_old_previews(self, test_client, sample_gallery, monkeypatch, tmp_path):
+        """Test that an image reusing an id after a reset gets its own preview, and huge font sizes are clamped"""
+        monkeypatch.setattr(main, "WATERMARK_PREVIEW_CACHE_DIR", str(tmp_path / "previews"))
+        image_id = upload_image(test_client, sample_gallery['id'], "wm.jpg", Image.new('RGB', (1600, 1200), 'red'))["image_id"]
+        url = f"/api/watermark-preview/{image_id}?text=X&font_size=100000"
+        assert test_client.get(url).status_code == 200
+        
+        test_client.post("/settings/reset")
+        test_client.post("/create-gallery", data={"title": "Fresh", "description": ""})
+        assert upload_image(test_client, 1, "wm.jpg", Image.new('RGB', (1600, 1200), 'blue'))["image_id"] == image_id
+        
+        with Image.open(io.BytesIO(test_client.get(url).content)) as preview:
+            r, g, b = preview.convert('RGB').getpixel((10, 10))
+        assert b > 200 and r < 60
+    
+    def test_preview_unknown_image(self, test_client, monkeypatch, tmp_path):
+        """Test that previews of missing images are 404s"""
+        monkeypatch.setattr(main, "WATERMARK_PREVIEW_CACHE_DIR", str(tmp_path))
+        assert test_client.get("/api/watermark-preview/999").status_code == 404
+    
+    def test_scaled_watermark_matches_full_size(self):
+        """Test that drawing at scale gives a miniature of the full-size watermark"""
+        config = dict(main.get_default_watermark_config(), text='MATCH', font_size='80', opacity='100')
+        full = main.draw_watermark(Image.new('RGB', (1600, 1200), 'gray'), config)
+        small = main.draw_watermark(Image.new('RGB', (400, 300), 'gray'), config, scale=0.25)
+        
+        def dark_box(img):
+            return img.convert('L').point(lambda v: 255 if v < 60 else 0).getbbox()
+        
+        full_box = [edge / 4 for edge in dark_box(full)]
+        small_box = dark_box(small)
+        assert all(abs(a - b) <= 3 for a, b in zip(full_box, small_box))
+
+class TestDuplicateDetection:
+    """Test perceptual hashes and the near-duplicate cluster listing"""
+    
+    def _gradient(self, size=(320, 240), flip=False):
+        img = Image.linear_gradient('L').resize(size).convert('RGB')
+        return img.transpose(Image.FLIP_LEFT_RIGHT) if flip else img
+    
+    def test_near_duplicates_are_clustered(self, test_client, sample_gallery):
+        """Test that a resized, lightly edited copy clusters with its original and a different image does not"""
+        gallery_id = sample_gallery['id']
+        upload_image(test_client, gallery_id, "dup_original.png", self._gradient())
+        upload_image(test_client, gallery_id, "dup_resized.png", self._gradient((640, 480)))
+        edited = self._gradient()
+        edited.paste((255, 0, 0), (10, 10, 40, 40))
+        upload_image(test_client, gallery_id, "dup_edited.png", edited)
+        upload_image(test_client, gallery_id, "dup_other.png", self._gradient(flip=True).rotate(90))
+        
+        result = test_client.get("/api/duplicates").json()
+        
+        assert result["indexed"] == 4
+        assert len(result["clusters"]) == 1
+        cluster = result["clusters"][0]
+        assert sorted(image["filename"] for image in cluster["images"]) == \
+            ["dup_edited.png", "dup_original.png", "dup_resized.png"]
+        assert cluster["max_distance"] <= result["threshold"]
+    
+    def test_deleted_images_leave_their_cluster(self, test_client, sample_gallery):
+        """Test that a cluster reduced to one surviving image is no longer listed"""
+        gallery_id = sample_gallery['id']
+        upload_image(test_client, gallery_id, "dup_a.png", self._gradient())
+        upload_image(test_client, gallery_id, "dup_b.png", self._gradient((400, 300)))
+        assert len(test_client.get("/api/duplicates").json()["clusters"]) == 1
+        
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        image_id = conn.execute("SELECT id FROM images WHERE filename='dup_b.png'").fetchone()[0]
+        conn.close()
+        test_client.post(f"/image/{image_id}/delete")
+        
+        assert test_client.get("/api/duplicates").json()["clusters"] == []
+    
+    def test_removal_splits_chained_cluster(self):
+        """Test that deleting the image linking two others leaves them unclustered"""
+        index = main.DuplicateIndex()
+        index.add(1, 0)
+        index.add(2, 0b111)
+        index.add(3, 0b1111111)  # 7 bits from image 1, linked only through image 2
+        assert list(index.clusters.values()) == [{1, 2, 3}]
+        
+        index.remove(2)
+        
+        assert index.clusters == {} and index.cluster_of == {}
+        assert sorted(index.table.search(0b111)) == [1, 3]
+    
+    def test_reset_starts_a_fresh_index(self, test_client, sample_gallery):
+        """Test that clusters from before a database reset do not leak onto the new image ids"""
+        upload_image(test_client, sample_gallery['id'], "dup_a.png", self._gradient())
+        upload_image(test_client, sample_gallery['id'], "dup_b.png", self._gradient((400, 300)))
+        assert len(test_client.get("/api/duplicates").json()["clusters"]) == 1
+        
+        test_client.post("/settings/reset")
+        test_client.post("/create-gallery", data={"title": "Fresh", "description": ""})
+        upload_image(test_client, 1, "fresh_a.png", self._gradient())
+        upload_image(test_client, 1, "fresh_b.png", self._gradient(flip=True).rotate(90))
+        
+        result = test_client.get("/api/duplicates").json()
+        assert result["indexed"] == 2 and result["clusters"] == []
+    
+    def test_hash_index_search(self):
+        """Test that the multi-index table finds exactly the hashes within the radius"""
+        values = [0, 0b1, 0b11, 0b111, 0b1111111, 0, 1 << 63 | 1 << 40 | 1 << 20]
+        table = main.MultiIndexHashTable()
+        for item, value in enumerate(values):
+            table.add(value, item)
+        
+        assert sorted(table.search(0, 2)) == [0, 1, 2, 5]
+        assert sorted(table.search(0)) == [0, 1, 2, 3, 5, 6]
+        assert table.search(0b1111111, 0) == [4]
+        assert main.MultiIndexHashTable().search(0) == []
+
+class TestColorPalettes:
+    """Test per-image palettes and searching images by colour"""
+    
+    def _two_tone(self, main_color, accent_color):
+        img = Image.new('RGB', (400, 300), color=main_color)
+        img.paste(accent_color, (0, 0, 400, 100))
+        return img
+    
+    def test_upload_stores_palette(self, test_client, sample_gallery):
+        """Test that uploads record their main colours, most common first"""
+        upload_image(test_client, sample_gallery['id'], "palette_red.png", self._two_tone((220, 20, 20), (20, 20, 220)))
+        
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        palette = json.loads(conn.execute('SELECT palette FROM images').fetchone()[0])
+        swatches = conn.execute('SELECT COUNT(*) FROM image_colors').fetchone()[0]
+        conn.close()
+        
+        assert [color for color, _ in palette[:2]] == ['#dc1414', '#1414dc']
+        assert 0.6 < palette[0][1] < 0.7 and 0.25 < palette[1][1] < 0.34
+        assert swatches == len(palette) <= main.PALETTE_COLORS
+    
+    def test_search_by_color(self, test_client, sample_gallery):
+        """Test that colour search returns images with a nearby swatch, closest first"""
+        gallery_id = sample_gallery['id']
+        upload_image(test_client, gallery_id, "palette_red.png", self._two_tone((220, 20, 20), (240, 240, 240)))
+        upload_image(test_client, gallery_id, "palette_orange.png", self._two_tone((240, 60, 10), (10, 10, 10)))
+        upload_image(test_client, gallery_id, "palette_green.png", self._two_tone((20, 180, 40), (240, 240, 240)))
+        
+        result = test_client.get("/api/images/near-color", params={"color": "#e01010"}).json()
+        assert [image["filename"] for image in result["images"]] == ["palette_red.png", "palette_orange.png"]
+        assert result["images"][0]["swatch"] == "#dc1414"
+        
+        result = test_client.get("/api/images/near-color", params={"color": "f0f0f0", "distance": 10}).json()
+        assert sorted(image["filename"] for image in result["images"]) == ["palette_green.png", "palette_red.png"]
+        
+        result = test_client.get("/api/images/near-color", params={"color": "#e01010", "gallery_id": 99999}).json()
+        assert result["images"] == []
+        
+        assert test_client.get("/api/images/near-color", params={"color": "red"}).json()["success"] is False
+    
+    def test_backfill_and_delete(self, test_client, sample_gallery):
+        """Test that old rows get palettes from their thumbnail and deleting an image drops its swatches"""
+        os.makedirs("static/thumbs", exist_ok=True)
+        Image.new('RGB', (40, 40), color=(0, 0, 255)).save("static/thumbs/old_palette.png")
+        conn = sqlite3.connect(TestConfig.TEST_DB)
+        image_id = conn.execute('INSERT INTO images (gallery_id, filename, enabled, sort_order) VALUES (?, ?, 1, 0)',
+                                (sample_gallery['id'], 'old_palette.png')).lastrowid
+        conn.commit()
+        
+        assert main.backfill_image_palettes() == 1
+        assert main.backfill_image_palettes() == 0
+        result = test_client.get("/api/images/near-color", params={"color": "#0000f0"}).json()
+        assert [image["id"] for image in result["images"]] == [image_id]
+        
+        test_client.post(f"/image/{image_id}/delete")
+        assert conn.execute('SELECT COUNT(*) FROM image_colors').fetchone()[0] == 0
+        conn.close()
 
 class TestSettings:
     """Test settings and admin functionality"""